@@ -0,0 +1,787 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from Crypto.PublicKey import RSA
+from base64 import b64encode
+import checksum
+import config
+import database
+import integrity
+import loadgen
+import protocol
+import server
+import tracing
+import transport
+
+"""
+Microbenchmarks for the server hot paths
+
+every benchmark is a setup function (registered with @benchmark) that returns the callable to time
+results are written as json, and when a baseline file is given every result is compared against it:
+    python bench.py --output bench_results.json
+    python bench.py --baseline bench_results.json        # exit code 1 on a regression
+    python bench.py --filter protocol --quick
+    python bench.py --filter transport      # 1103 uploads over TCP vs the unix socket
+    python bench.py --filter response       # packing and writing every response, see the alloc column
+
+besides the timings, every benchmark reports what one call allocates (alloc_bytes): the peak of the memory
+tracemalloc traced during the call, over what was traced before it. CPython doesn't count allocations
+(outside of --with-pystats builds), the peak shows the packets, padding and copies a request makes
+"""
+
+DEFAULT_OUTPUT = "bench_results.json"
+DEFAULT_THRESHOLD = 0.10  # a benchmark that got slower by more than this is a regression
+MIN_TIME = 0.2  # seconds every repeat should take at least
+REPEAT = 5
+ALLOC_CALLS = 10  # calls traced to measure what a benchmark allocates
+SERVER_START_TIMEOUT = 10  # seconds to wait for the live server to accept connections
+CLIENT_ID = bytes(range(protocol.CLIENT_ID_SIZE))
+SESSION_KEY = bytes(range(protocol.SYMMETRIC_KEY_SIZE))
+# registered on the live server with SESSION_KEY, a stream is decrypted while it's read so it needs the key
+STREAM_CLIENT_ID = bytes(range(protocol.CLIENT_ID_SIZE, 2 * protocol.CLIENT_ID_SIZE))
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    register a benchmark
+    :param name: unique name. the part before the first '.' is the group
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return decorator
+
+
+class Fixtures:
+    """
+    shared state for the benchmarks that need a database or a server
+    everything lives in a temporary directory which is removed at the end
+    """
+    def __init__(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix="mmn15-bench-")
+        self.cwd = os.getcwd()
+        self._server = None
+        self._rsa_key = None
+        self._live_server = None
+        self._loopback = None
+        self.cleanups = []  # called by close()
+
+    @property
+    def server(self):
+        if self._server is None:
+            os.chdir(self.tmp.name)
+            self._server = server.Server(config.ServerConfig(port=0, metrics_port=0))
+        return self._server
+
+    @property
+    def rsa_key(self):
+        if self._rsa_key is None:
+            self._rsa_key = RSA.generate(loadgen.RSA_BITS, e=loadgen.RSA_EXPONENT)
+        return self._rsa_key
+
+    @property
+    def loopback(self):
+        """
+        a server that runs on in-memory connections in this process (see transport.py)
+        :return: transport.LoopbackHarness
+        """
+        if self._loopback is None:
+            os.chdir(self.tmp.name)
+            settings = config.ServerConfig(port=0, metrics_port=0, database="loopback.db")
+            self._loopback = transport.LoopbackHarness(server.Server(settings,
+                                                                     selector=transport.LoopbackSelector()))
+            self.cleanups.append(self._loopback.close)
+        return self._loopback
+
+    @property
+    def live_server(self):
+        """
+        a real server in its own process, listening on TCP and on a unix socket
+        :return: tuple - (tcp address, unix socket path)
+        """
+        if self._live_server is None:
+            directory = os.path.join(self.tmp.name, "live")
+            os.makedirs(directory)
+            with socket.socket() as probe:
+                probe.bind(("127.0.0.1", 0))
+                port = probe.getsockname()[1]
+            unix_path = os.path.join(directory, "server.sock")
+            database.Database(os.path.join(directory, "server.db")).query(
+                "INSERT INTO clients (ID, Name, AESKey) VALUES (?, ?, ?)",
+                [STREAM_CLIENT_ID.hex(), "bench-stream", SESSION_KEY])
+            env = dict(os.environ, MMN15_PORT=str(port), MMN15_UNIX_SOCKET=unix_path, MMN15_METRICS_PORT="0",
+                       MMN15_LOG_LEVEL="ERROR")
+            main = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+            process = subprocess.Popen([sys.executable, main], cwd=directory, env=env)
+            self._live_server = (process, ("127.0.0.1", port), unix_path)
+            deadline = time.monotonic() + SERVER_START_TIMEOUT
+            while not os.path.exists(unix_path):
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("the live server didn't start")
+                time.sleep(0.05)
+        return self._live_server[1:]
+
+    def close(self):
+        for cleanup in self.cleanups:
+            cleanup()
+        if self._live_server is not None:
+            self._live_server[0].terminate()
+            self._live_server[0].wait()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+
+FIXTURES = None
+
+
+def request_header(code, payload_size):
+    return CLIENT_ID + struct.pack("<BHL", loadgen.CLIENT_VERSION, code, payload_size)
+
+
+def name_field(name):
+    return struct.pack(f"<{protocol.NAME_SIZE}s", name.encode("utf-8"))
+
+
+"""
+checksum
+"""
+
+
+def memcrc_benchmark(size):
+    data = os.urandom(size)
+    return lambda: checksum.memcrc(data)
+
+
+for _size_name, _size in (("1k", 1024), ("64k", 64 * 1024), ("1m", 1024 * 1024)):
+    benchmark(f"checksum.memcrc_{_size_name}")(lambda size=_size: memcrc_benchmark(size))
+
+
+def parallel_checksum_benchmark(workers, size):
+    # the same file for every worker count, so the results show how the parallel cksum scales with cores
+    path = os.path.join(FIXTURES.tmp.name, f"parallel-{size}.bin")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+    parallel = checksum.ParallelChecksum(workers, min_size=0)
+    FIXTURES.cleanups.append(parallel.close)
+    # start the pool before timing
+    parallel(path)
+    return lambda: parallel(path)
+
+
+for _workers in sorted({1, 2, 4, 8, os.cpu_count() or 1}):
+    if _workers <= (os.cpu_count() or 1):
+        benchmark(f"checksum.parallel_4m_{_workers}_workers")(
+            lambda workers=_workers: parallel_checksum_benchmark(workers, 4 * 1024 * 1024))
+
+
+def integrity_benchmark(algorithm, size):
+    # what a version 4 client gets instead of memcrc, compare with checksum.memcrc_1m
+    data = os.urandom(size)
+    return lambda: integrity.digest_of(algorithm.value, data)
+
+
+for _algorithm in (protocol.IntegrityAlgorithms.CRC32, protocol.IntegrityAlgorithms.BLAKE2B):
+    benchmark(f"integrity.{_algorithm.name.lower()}_1m")(
+        lambda algorithm=_algorithm: integrity_benchmark(algorithm, 1024 * 1024))
+
+
+"""
+protocol
+"""
+
+
+@benchmark("protocol.request_header_unpack")
+def bench_request_header():
+    data = request_header(protocol.RequestCodes.REQUEST_LOGIN.value, protocol.NAME_SIZE)
+    header = protocol.RequestHeader()
+    return lambda: header.unpack(data)
+
+
+@benchmark("protocol.registration_request_unpack")
+def bench_registration_request():
+    data = request_header(protocol.RequestCodes.REQUEST_REGISTRATION.value, protocol.NAME_SIZE) + name_field("bench")
+    return lambda: protocol.RegistrationRequest().unpack(data)
+
+
+@benchmark("protocol.login_request_unpack")
+def bench_login_request():
+    data = request_header(protocol.RequestCodes.REQUEST_LOGIN.value, protocol.NAME_SIZE) + name_field("bench")
+    return lambda: protocol.LoginRequest().unpack(data)
+
+
+@benchmark("protocol.public_key_request_unpack")
+def bench_public_key_request():
+    data = request_header(protocol.RequestCodes.REQUEST_PUBLIC_KEY.value,
+                          protocol.NAME_SIZE + protocol.PUBLIC_KEY_SIZE)
+    data += name_field("bench") + os.urandom(protocol.PUBLIC_KEY_SIZE)
+    return lambda: protocol.PublicKeyRequest().unpack(data)
+
+
+@benchmark("protocol.file_send_request_unpack")
+def bench_file_send_request():
+    # the whole file fits in the first packet, so there's nothing left to feed()
+    content = next(loadgen.encrypt_chunks(SESSION_KEY, os.urandom(loadgen.FIRST_CHUNK_SIZE)))
+    data = request_header(protocol.RequestCodes.REQUEST_SEND_FILE.value,
+                          protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE + len(content))
+    data += struct.pack("<L", len(content)) + name_field("bench.bin") + content
+    data = data.ljust(loadgen.PACKET_SIZE, b'\0')
+    return lambda: protocol.FileSendRequest().unpack(data)
+
+
+@benchmark("protocol.crc_request_unpack")
+def bench_crc_request():
+    data = request_header(protocol.RequestCodes.REQUEST_VALID_CRC.value, protocol.NAME_SIZE)
+    data += name_field("bench.bin")
+    return lambda: protocol.ValidCRCRequest().unpack(data)
+
+
+@benchmark("protocol.response_header_pack")
+def bench_response_header():
+    header = protocol.ResponseHeader(protocol.ResponseCodes.RESPONSE_RECEIVED.value)
+    return header.pack
+
+
+def response_benchmark(response_class, **fields):
+    def run():
+        response = response_class()
+        for key, value in fields.items():
+            setattr(response, key, value)
+        return response.pack()
+    return run
+
+
+@benchmark("protocol.generic_response_pack")
+def bench_generic_response():
+    return response_benchmark(protocol.GenericResponse, client_id=CLIENT_ID)
+
+
+@benchmark("protocol.registration_response_pack")
+def bench_registration_response():
+    return response_benchmark(protocol.RegistrationResponse, client_id=CLIENT_ID)
+
+
+@benchmark("protocol.registration_failed_response_pack")
+def bench_registration_failed_response():
+    return response_benchmark(protocol.RegistrationFailedResponse)
+
+
+@benchmark("protocol.public_key_response_pack")
+def bench_public_key_response():
+    def run():
+        response = protocol.PublicKeyResponse()
+        response.client_id = CLIENT_ID
+        response.symmetric_key = key
+        response.header.payload_size = protocol.CLIENT_ID_SIZE + len(key)
+        return response.pack()
+    key = os.urandom(128)
+    return run
+
+
+@benchmark("protocol.login_response_pack")
+def bench_login_response():
+    def run():
+        response = protocol.LoginResponse()
+        response.client_id = CLIENT_ID
+        response.symmetric_key = key
+        response.header.payload_size = protocol.CLIENT_ID_SIZE + len(key)
+        return response.pack()
+    key = os.urandom(128)
+    return run
+
+
+@benchmark("protocol.login_failed_response_pack")
+def bench_login_failed_response():
+    return response_benchmark(protocol.LoginFailedResponse, client_id=CLIENT_ID)
+
+
+@benchmark("protocol.crc_response_pack")
+def bench_crc_response():
+    return response_benchmark(protocol.CRCResponse, client_id=CLIENT_ID, content_size=1024,
+                              file_name=b"bench.bin", cksum=0x12345678)
+
+
+@benchmark("protocol.error_response_pack")
+def bench_error_response():
+    return response_benchmark(protocol.ErrorResponse)
+
+
+"""
+responses, packed and written to a connection the way the handlers do it
+"""
+
+
+class NullConnection(transport.LoopbackTransport):
+    """
+    takes whatever is sent and throws it away, so only the server's side of a write is measured
+    """
+    def send(self, data):
+        return len(data)
+
+
+def response_write_benchmark(respond):
+    """
+    :param respond: function(server, conn) writing one response
+    """
+    srv = FIXTURES.server
+    conn = NullConnection()
+    return lambda: respond(srv, conn)
+
+
+@benchmark("response.error_2107")
+def bench_write_error():
+    return response_write_benchmark(lambda srv, conn: srv.write(conn, srv.error_frames[srv.version(conn)]))
+
+
+@benchmark("response.registration_failed_2101")
+def bench_write_registration_failed():
+    return response_write_benchmark(lambda srv, conn: srv.write(conn,
+                                                                srv.registration_failed_frames[srv.version(conn)]))
+
+
+@benchmark("response.generic_2104")
+def bench_write_generic():
+    def respond(srv, conn):
+        response = protocol.GenericResponse()
+        response.client_id = CLIENT_ID
+        return srv.respond(conn, response)
+    return response_write_benchmark(respond)
+
+
+@benchmark("response.login_2105")
+def bench_write_login():
+    def respond(srv, conn):
+        response = protocol.LoginResponse()
+        response.client_id = CLIENT_ID
+        response.symmetric_key = key
+        response.header.payload_size = protocol.CLIENT_ID_SIZE + len(key)
+        return srv.respond(conn, response)
+    key = os.urandom(128)
+    return response_write_benchmark(respond)
+
+
+@benchmark("response.crc_2103")
+def bench_write_crc():
+    def respond(srv, conn):
+        return srv.send_checksum(conn, 0x12345678, 1024, CLIENT_ID, "bench.bin")
+    return response_write_benchmark(respond)
+
+
+"""
+server
+"""
+
+
+def decrypt_benchmark(size):
+    content = list(loadgen.encrypt_chunks(SESSION_KEY, os.urandom(size)))
+    return lambda: server.decrypt_content(SESSION_KEY, content)
+
+
+for _size_name, _size in (("64k", 64 * 1024), ("1m", 1024 * 1024)):
+    benchmark(f"server.decrypt_content_{_size_name}")(lambda size=_size: decrypt_benchmark(size))
+
+
+def decrypt_stream_benchmark(size, chunk_size):
+    client = loadgen.ProtocolClient(None, None, "bench", None, protocol.STREAM_VERSION, chunk_size=chunk_size)
+    client.client_id = CLIENT_ID
+    client.session_key = SESSION_KEY
+    first_packet, chunks = client.file_packets("bench.bin", os.urandom(size))
+    first_packet = first_packet.ljust(loadgen.PACKET_SIZE, b'\0')
+    chunks = list(chunks)
+
+    def run():
+        # what the server does with a stream: decrypt every chunk as it's read, unpad the end
+        request = protocol.FileSendRequest()
+        request.unpack(first_packet)
+        request.cipher = server.stream_cipher(SESSION_KEY)
+        for chunk in chunks:
+            request.feed(chunk)
+        server.unpad_stream(request.content)
+    return run
+
+
+# a version 5 upload of the same size, in 64k chunks
+benchmark("server.decrypt_stream_1m")(lambda: decrypt_stream_benchmark(1024 * 1024, 64 * 1024))
+
+
+@benchmark("server.generate_keys")
+def bench_generate_keys():
+    instance = FIXTURES.server
+    public_key = b64encode(FIXTURES.rsa_key.publickey().export_key("DER"))
+    return lambda: instance.generate_keys(public_key, CLIENT_ID.hex())
+
+
+"""
+tracing
+"""
+
+
+def request_spans_benchmark(tracer):
+    # the spans of a small request: a root with a couple of children, what every traced request pays for
+    def run():
+        root = tracer.start("request", code=1100)
+        with tracing.activate(root):
+            with tracing.span("db.query_with_result"):
+                pass
+            with tracing.span("write", bytes=1024):
+                pass
+        root.end()
+    return run
+
+
+@benchmark("tracing.request_unsampled")
+def bench_tracing_unsampled():
+    return request_spans_benchmark(tracing.Tracer())
+
+
+@benchmark("tracing.request_sampled")
+def bench_tracing_sampled():
+    tracer = tracing.Tracer(os.path.join(FIXTURES.tmp.name, "traces.jsonl"), sample_rate=1)
+    FIXTURES.cleanups.append(tracer.close)
+    return request_spans_benchmark(tracer)
+
+
+"""
+database
+"""
+
+
+@benchmark("database.query_insert")
+def bench_db_query():
+    db = FIXTURES.server.backup_db
+    return lambda: db.query("INSERT INTO files (ID, FileName, FilePath, Verified) VALUES (?, ?, ?, ?)",
+                            [CLIENT_ID.hex(), "bench.bin", "bench/bench.bin", 0])
+
+
+@benchmark("database.query_with_result_select")
+def bench_db_query_with_result():
+    db = FIXTURES.server.backup_db
+    db.query("INSERT INTO clients (ID, Name, LastSeen) VALUES (?, ?, ?)",
+             [CLIENT_ID.hex(), "bench", str(datetime.now())])
+    return lambda: db.query_with_result("SELECT PublicKey FROM clients WHERE ID = ? AND Name = ?",
+                                        [CLIENT_ID.hex(), "bench"])
+
+
+@benchmark("database.provision_1000")
+def bench_db_provision():
+    # new names every run, a thousand 1100 registrations in one go
+    db = FIXTURES.server.backup_db
+    batches = itertools.count()
+
+    def run():
+        batch = next(batches)
+        return db.provision([f"bench-{batch}-{index}" for index in range(1000)])
+    return run
+
+
+"""
+loopback
+the request handlers end to end (framing, database, disk, the response), without sockets
+"""
+
+
+def packet(data):
+    return data.ljust(loadgen.PACKET_SIZE, b'\0')
+
+
+def loopback_request(data):
+    """
+    :param data: (bytes) the whole request, as the client puts it on the wire
+    :return: tuple - (response code, response payload)
+    """
+    conn = FIXTURES.loopback.connect(data)
+    FIXTURES.loopback.run()
+    return conn.response()
+
+
+def loopback_client(name, version=loadgen.CLIENT_VERSION, chunk_size=loadgen.STREAM_CHUNK_SIZE):
+    """
+    :return: loadgen.ProtocolClient registered on the loopback server, with its session key
+    """
+    client = loadgen.ProtocolClient(None, None, name, None, version, chunk_size=chunk_size)
+    code = protocol.RequestCodes.REQUEST_REGISTRATION.value
+    _, payload = loopback_request(packet(client.header(code, protocol.NAME_SIZE) + name_field(name)))
+    client.client_id = payload[:protocol.CLIENT_ID_SIZE]
+    client.rsa_key = FIXTURES.rsa_key
+    code = protocol.RequestCodes.REQUEST_PUBLIC_KEY.value
+    public_key = client.rsa_key.publickey().export_key("DER")
+    _, payload = loopback_request(packet(client.header(code, protocol.NAME_SIZE + protocol.PUBLIC_KEY_SIZE) +
+                                         name_field(name) + loadgen.fixed_str(public_key, protocol.PUBLIC_KEY_SIZE)))
+    client.take_session_key(payload)
+    return client
+
+
+@benchmark("loopback.registration")
+def bench_loopback_registration():
+    code = protocol.RequestCodes.REQUEST_REGISTRATION.value
+    names = itertools.count()
+    return lambda: loopback_request(packet(request_header(code, protocol.NAME_SIZE) +
+                                           name_field(f"loopback-{next(names)}")))
+
+
+@benchmark("loopback.login")
+def bench_loopback_login():
+    client = loopback_client("loopback-login")
+    code = protocol.RequestCodes.REQUEST_LOGIN.value
+    data = packet(client.header(code, protocol.NAME_SIZE) + name_field(client.name))
+    return lambda: loopback_request(data)
+
+
+@benchmark("loopback.login_100_connections")
+def bench_loopback_login_connections():
+    # a hundred clients connected at the same time, all handled by one run()
+    client = loopback_client("loopback-connections")
+    code = protocol.RequestCodes.REQUEST_LOGIN.value
+    data = packet(client.header(code, protocol.NAME_SIZE) + name_field(client.name))
+
+    def run():
+        for _ in range(100):
+            FIXTURES.loopback.connect(data)
+        FIXTURES.loopback.run()
+    return run
+
+
+def loopback_upload_benchmark(name, size, version=loadgen.CLIENT_VERSION):
+    client = loopback_client(name, version)
+    first_packet, chunks = client.file_packets("loopback.bin", os.urandom(size))
+    if version >= protocol.STREAM_VERSION:
+        data = packet(first_packet) + b"".join(chunks)
+    else:
+        data = b"".join(packet(chunk) for chunk in (first_packet, *chunks))
+    # the first upload is new, every one after it replaces it (the CRC is never answered)
+    return lambda: loopback_request(data)
+
+
+benchmark("loopback.upload_64k")(lambda: loopback_upload_benchmark("loopback-upload", 64 * 1024))
+benchmark("loopback.upload_64k_stream")(
+    lambda: loopback_upload_benchmark("loopback-stream", 64 * 1024, protocol.STREAM_VERSION))
+
+
+"""
+transport
+"""
+
+
+def upload_request(size, chunk_size=None):
+    """
+    :param chunk_size: send the file as a version 5 stream in chunks of this size (None for 1k packets)
+    :return: (bytes) a whole 1103 request, as the client puts it on the wire
+    """
+    if chunk_size is None:
+        client = loadgen.ProtocolClient(None, None, "bench", None)
+    else:
+        # crc32 is hashed while the file is written, cksum would read the 16m back in pure python
+        client = loadgen.ProtocolClient(None, None, "bench", None, protocol.STREAM_VERSION,
+                                        algorithm=protocol.IntegrityAlgorithms.CRC32.value, chunk_size=chunk_size)
+    client.client_id = CLIENT_ID if chunk_size is None else STREAM_CLIENT_ID
+    client.session_key = SESSION_KEY
+    first_packet, packets = client.file_packets("bench.bin", os.urandom(size))
+    if chunk_size is not None:
+        return first_packet.ljust(loadgen.PACKET_SIZE, b'\0') + b"".join(packets)
+    return b"".join(packet.ljust(loadgen.PACKET_SIZE, b'\0') for packet in (first_packet, *packets))
+
+
+def upload_benchmark(family, size, chunk_size=None):
+    # CLIENT_ID isn't registered on the live server, so it reads the whole upload and answers 2107
+    # without decrypting or writing anything. what's left to time is moving the bytes.
+    # a stream comes from STREAM_CLIENT_ID, and is decrypted while it's read and then written
+    tcp_address, unix_path = FIXTURES.live_server
+    address = unix_path if family == socket.AF_UNIX else tcp_address
+    data = upload_request(size, chunk_size)
+
+    def run():
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.connect(address)
+            sock.sendall(data)
+            while sock.recv(loadgen.PACKET_SIZE):
+                pass
+    return run
+
+
+if hasattr(socket, "AF_UNIX"):
+    for _size_name, _size in (("1m", 1024 * 1024), ("16m", 16 * 1024 * 1024)):
+        for _transport, _family in (("tcp", socket.AF_INET), ("unix", socket.AF_UNIX)):
+            benchmark(f"transport.upload_{_transport}_{_size_name}")(
+                lambda family=_family, size=_size: upload_benchmark(family, size))
+
+# the same 16m over TCP as one version 5 stream. unlike transport.upload_tcp_16m this includes decrypting it,
+# which happens while the stream is read, and writing the file
+for _chunk_name, _chunk_size in (("64k", 64 * 1024), ("1m", 1024 * 1024)):
+    benchmark(f"transport.upload_tcp_16m_stream_{_chunk_name}")(
+        lambda chunk_size=_chunk_size: upload_benchmark(socket.AF_INET, 16 * 1024 * 1024, chunk_size))
+
+
+"""
+runner
+"""
+
+
+def time_loop(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return time.perf_counter() - start
+
+
+def measure(func, min_time=MIN_TIME, repeat=REPEAT):
+    """
+    time a callable, timeit style
+    the number of calls per repeat grows until a repeat takes at least min_time
+    :return: (dict) per call timings in seconds
+    """
+    number = 1
+    while True:
+        elapsed = time_loop(func, number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / elapsed * 1.2)) if elapsed > 0 else number * 10
+
+    samples = [time_loop(func, number) / number for _ in range(repeat)]
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "mean": statistics.mean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def allocations(func, calls=ALLOC_CALLS):
+    """
+    :return: (int) median bytes one call allocates at its peak (see the docstring at the top)
+    """
+    func()  # anything cached or pooled on the first call doesn't count
+    tracemalloc.start()
+    try:
+        samples = []
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            samples.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return int(statistics.median(samples))
+
+
+def run(name_filter=None, min_time=MIN_TIME, repeat=REPEAT):
+    """
+    :param name_filter: only run benchmarks whose name contains this
+    :return: (dict) results by benchmark name
+    """
+    global FIXTURES
+    FIXTURES = Fixtures()
+    results = {}
+    try:
+        for name, setup in BENCHMARKS:
+            if name_filter and name_filter not in name:
+                continue
+            func = setup()
+            results[name] = measure(func, min_time, repeat)
+            results[name]["alloc_bytes"] = allocations(func)
+            print(f"{name:<45} {format_time(results[name]['median']):>12} "
+                  f"{format_size(results[name]['alloc_bytes']):>12}", flush=True)
+    finally:
+        FIXTURES.close()
+        FIXTURES = None
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.1f} ns"
+
+
+def format_size(size):
+    for unit, scale in (("MB", 1024 * 1024), ("KB", 1024)):
+        if size >= scale:
+            return f"{size / scale:.1f} {unit}"
+    return f"{size} B"
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    compare median timings against a baseline
+    :return: list of names that got slower by more than threshold
+    """
+    regressions = []
+    print(f"\n{'benchmark':<45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<45} {'-':>12} {format_time(result['median']):>12} {'new':>8}")
+            continue
+        old = baseline[name]["median"]
+        change = result["median"] / old - 1 if old else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<45} {format_time(old):>12} {format_time(result['median']):>12} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def save_results(path, results):
+    data = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="microbenchmarks for the mmn15 server")
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the results (json)")
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown counted as a regression (0.1 = 10%%)")
+    parser.add_argument("--quick", action="store_true", help="shorter runs, noisier numbers")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        return 0
+
+    # read the baseline first, --output may point at the same file
+    baseline = load_results(args.baseline) if args.baseline else None
+    min_time, repeat = (MIN_TIME / 4, 3) if args.quick else (MIN_TIME, REPEAT)
+    results = run(args.filter, min_time, repeat)
+    save_results(args.output, results)
+
+    if baseline is not None and compare(results, baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import itertools
+import struct
+import time
+from transport import Transport
+
+"""
+Wire traffic capture
+
+when a capture file is set, every client connection is wrapped in a RecordingConnection that logs whatever
+is received from it and sent to it. replay.py reads the file back and drives a server with the same traffic
+
+file format (little endian):
+    MAGIC, then one record after the other
+    record = connection id (uint32), direction (uint8), time in ns since the capture started (uint64),
+             length (uint32), then length bytes of data
+a CLOSED record (no data) marks the server closing the connection
+a SESSION_KEY record (client id, then the key) is the AES key the server gave a client on that connection (1101 and
+1102). replay.py needs it to re-encrypt the uploads for the keys the replayed server gives out. it also means the
+capture can decrypt every upload in it, keep it as private as the database
+"""
+
+MAGIC = b"MMN15CAP\x01"
+RECORD_HEADER = struct.Struct("<IBQI")
+
+INBOUND = 0
+OUTBOUND = 1
+CLOSED = 2
+SESSION_KEY = 3
+
+
+class Recorder:
+    """
+    writes the capture file. only used from the selector thread, so there's no locking
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start = time.perf_counter_ns()
+        self.ids = itertools.count(1)
+
+    def wrap(self, conn):
+        """
+        :param conn: newly accepted socket
+        :return: RecordingConnection to use instead of the socket
+        """
+        return RecordingConnection(conn, self, next(self.ids))
+
+    def record(self, conn_id, direction, data=b''):
+        self.file.write(RECORD_HEADER.pack(conn_id, direction, time.perf_counter_ns() - self.start, len(data)))
+        if data:
+            self.file.write(data)
+        if direction == CLOSED:
+            # flushing once per connection keeps the file usable if the server is killed
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RecordingConnection(Transport):
+    """
+    wraps a client socket and records the traffic going through it
+    anything that isn't recv/send/close is passed to the socket as is
+    """
+    def __init__(self, conn, recorder, conn_id):
+        self.conn = conn
+        self.recorder = recorder
+        self.conn_id = conn_id
+
+    def recv(self, size, *args):
+        data = self.conn.recv(size, *args)
+        if data:
+            self.recorder.record(self.conn_id, INBOUND, data)
+        return data
+
+    def send(self, data, *args):
+        sent = self.conn.send(data, *args)
+        if sent:
+            self.recorder.record(self.conn_id, OUTBOUND, bytes(data[:sent]))
+        return sent
+
+    def record_session_key(self, client_id, session_key):
+        self.recorder.record(self.conn_id, SESSION_KEY, bytes(client_id) + session_key)
+
+    def close(self):
+        self.recorder.record(self.conn_id, CLOSED)
+        self.conn.close()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __repr__(self):
+        return f"<RecordingConnection {self.conn_id} {self.conn!r}>"
+
+
+def read_capture(path):
+    """
+    :param path: capture file
+    :return: generator of (connection id, direction, time in ns, data)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            conn_id, direction, timestamp, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # the server was stopped in the middle of a record
+                return
+            yield conn_id, direction, timestamp, data
@@ -0,0 +1,147 @@
+import configparser
+import dataclasses
+import logging
+import os
+from dataclasses import dataclass
+import utils
+
+logger = logging.getLogger(__name__)
+
+"""
+Server configuration
+
+all the settings live in one ServerConfig. load_config builds it, later sources overriding earlier ones:
+    1. the defaults below
+    2. port.info, so existing deployments keep their port
+    3. the [server] section of server.ini
+    4. environment variables named MMN15_<SETTING>, e.g. MMN15_BACKLOG=512 or MMN15_TCP_NODELAY=no
+
+a bad value is logged and ignored, the server still starts with whatever it had before that value
+"""
+
+CONFIG_FILE = "server.ini"
+PORT_FILE = "port.info"
+SECTION = "server"
+ENV_PREFIX = "MMN15_"
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+FALSE_VALUES = ("0", "false", "no", "off")
+
+
+@dataclass
+class ServerConfig:
+    # network
+    host: str = ""
+    port: int = 1234
+    backlog: int = 128  # listen() queue of connections not accepted yet
+    reuse_address: bool = True  # SO_REUSEADDR, so a restart doesn't wait for old connections in TIME_WAIT
+    tcp_nodelay: bool = True  # responses are single packets, don't let Nagle hold them back
+    recv_buffer: int = 0  # SO_RCVBUF in bytes, 0 keeps the OS default
+    send_buffer: int = 0  # SO_SNDBUF in bytes, 0 keeps the OS default
+    accept_batch: int = 16  # connections accepted every time the listening socket is ready
+    packet_size: int = 1024  # has to match the clients
+    unix_socket: str = ""  # path of an AF_UNIX socket to listen on as well, for clients on this host (off when empty)
+
+    # event loop and workers
+    select_timeout: float = 1.0  # seconds. the loop wakes up at least this often to handle profiler signals
+    io_workers: int = 4  # threads doing disk I/O for the handlers
+    stream_read_size: int = 64 * 1024  # bytes read from disk (and encrypted) at a time when sending a file back
+    checksum_workers: int = 0  # processes splitting the checksum of big files between them, 0 (or 1) to not use any
+    parallel_checksum_size: int = 8 * 1024 * 1024  # files from this size up are checksummed by those processes
+    # bytes a single upload (or file sent back) may move in one loop turn, so control requests
+    # that became ready meanwhile don't wait behind a large transfer
+    bulk_turn_bytes: int = 64 * 1024
+    response_buffers: int = 64  # free packet buffers kept for packing responses into (see protocol.BufferPool)
+
+    # storage
+    database: str = "server.db"
+    quota_bytes: int = 0  # bytes every user may store, 0 for no limit (the usage table can set one per user)
+    quota_files: int = 0  # files every user may store, 0 for no limit
+    snapshot_file: str = ""  # read only copy of the database for reporting.py (off when empty)
+    snapshot_interval: float = 300.0  # seconds between refreshes of the snapshot
+    snapshot_pages: int = 256  # database pages copied at a time while taking the snapshot
+
+    # observability
+    metrics_port: int = 9315  # prometheus scrape endpoint, only bound on localhost. 0 disables it
+    log_level: str = "INFO"
+    request_log_rate: int = 50  # per-request log lines per second
+    capture_file: str = ""  # record client traffic for replay.py (off when empty)
+    profile_dir: str = "profiles"
+    profile_sample_rate: float = 0.1
+    trace_file: str = ""  # JSONL file for per request tracing spans (off when empty)
+    trace_sample_rate: float = 0.01  # part of the requests that are traced
+    trace_max_bytes: int = 64 * 1024 * 1024  # size the trace file rotates at
+    trace_backups: int = 5  # rotated trace files kept
+
+
+def parse_value(field, text):
+    """
+    convert a setting from its text form to the type of its field
+    :param field: dataclasses.Field of ServerConfig
+    :param text: value as found in the file or the environment
+    :return: the converted value, raises ValueError if it doesn't fit
+    """
+    text = text.strip()
+    if field.type is bool:
+        if text.lower() in TRUE_VALUES:
+            return True
+        if text.lower() in FALSE_VALUES:
+            return False
+        raise ValueError(f"expected one of {TRUE_VALUES + FALSE_VALUES}")
+    if field.type is int:
+        return int(text)
+    if field.type is float:
+        return float(text)
+    return text
+
+
+def apply(config, values, source):
+    """
+    :param config: ServerConfig to update
+    :param values: dict of setting name -> text
+    :param source: where the values came from, for the log
+    """
+    fields = {field.name: field for field in dataclasses.fields(ServerConfig)}
+    for name, text in values.items():
+        field = fields.get(name)
+        if field is None:
+            logger.warning("%s: unknown setting %s", source, name)
+            continue
+        try:
+            setattr(config, name, parse_value(field, text))
+        except ValueError as e:
+            logger.warning("%s: bad value %r for %s (%s), keeping %r", source, text, name, e, getattr(config, name))
+
+
+def load_config(config_file=CONFIG_FILE, port_file=PORT_FILE, environ=None):
+    """
+    :param config_file: ini file to read (it's fine if it doesn't exist)
+    :param port_file: legacy file with only the port number (None to skip it)
+    :param environ: environment mapping (None for os.environ)
+    :return: ServerConfig
+    """
+    config = ServerConfig()
+
+    if port_file is not None and os.path.exists(port_file):
+        port = utils.get_port(port_file)
+        if port is not None:
+            config.port = port
+
+    if config_file is not None and os.path.exists(config_file):
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(config_file)
+        except configparser.Error as e:
+            logger.warning("Could not parse %s: %s", config_file, e)
+        else:
+            if parser.has_section(SECTION):
+                apply(config, dict(parser.items(SECTION)), config_file)
+            for section in parser.sections():
+                if section != SECTION:
+                    logger.warning("%s: ignoring unknown section [%s]", config_file, section)
+
+    environ = os.environ if environ is None else environ
+    names = [field.name for field in dataclasses.fields(ServerConfig)]
+    apply(config, {name: environ[ENV_PREFIX + name.upper()] for name in names if ENV_PREFIX + name.upper() in environ},
+          "environment")
+    return config
@@ -1,4 +1,18 @@
+import argparse
+import csv
+import logging
 import sqlite3
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+import config
+import metrics
+import protocol
+import tracing
+
+logger = logging.getLogger(__name__)
 
 
 """
@@ -12,6 +26,10 @@ def create_files(conn):
             FilePath CHAR(255),
             Verified INTEGER(1));
     """)
+    # databases created before usage accounting don't have the file size column
+    has_size = conn.execute("SELECT COUNT(*) FROM pragma_table_info('files') WHERE name = 'Size'").fetchone()[0]
+    if not has_size:
+        conn.execute("ALTER TABLE files ADD COLUMN Size INTEGER NOT NULL DEFAULT 0")
     conn.commit()
 
 
@@ -27,6 +45,55 @@ def create_clients(conn):
     conn.commit()
 
 
+def create_usage(conn):
+    """
+    bytes and files stored by every user, kept up to date with the files table
+    QuotaBytes / QuotaFiles override the configured quotas for one user (NULL to use the configured ones)
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage'").fetchall()
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS usage(
+            ID CHAR(16) NOT NULL PRIMARY KEY,
+            Bytes INTEGER NOT NULL DEFAULT 0,
+            Files INTEGER NOT NULL DEFAULT 0,
+            QuotaBytes INTEGER,
+            QuotaFiles INTEGER);
+    """)
+    if not exists:
+        # files stored before the table existed. their size wasn't recorded so they only count as files
+        conn.execute("INSERT INTO usage (ID, Bytes, Files) "
+                     "SELECT ID, SUM(Size), COUNT(DISTINCT FileName) FROM files GROUP BY ID")
+    conn.commit()
+
+
+def add_usage(conn, client_id, size, files):
+    """
+    change the usage of a user. meant to run inside the transaction that changed the files table
+    :param conn: connection of the transaction
+    :param client_id: user id (hex)
+    :param size: bytes to add (negative to subtract)
+    :param files: files to add (negative to subtract)
+    """
+    conn.execute("INSERT OR IGNORE INTO usage (ID, Bytes, Files) VALUES (?, 0, 0)", [client_id])
+    conn.execute("UPDATE usage SET Bytes = Bytes + ?, Files = Files + ? WHERE ID = ?", [size, files, client_id])
+
+
+def remove_file(conn, client_id, file_name):
+    """
+    drop the row of a file, and take it off the usage of its user. meant to run inside a transaction
+    :param conn: connection of the transaction
+    :param client_id: user id (hex)
+    :param file_name: name of the file
+    :return: list of the FilePath of the rows that were removed (empty if there were none)
+    """
+    rows = conn.execute(f"SELECT FilePath, Size FROM files WHERE ID = ? AND fileName = ?",
+                        [client_id, file_name]).fetchall()
+    conn.execute(f"DELETE FROM files WHERE ID = ? AND fileName = ?", [client_id, file_name])
+    if rows:
+        add_usage(conn, client_id, -sum(row[1] for row in rows), -1)
+    return [row[0] for row in rows]
+
+
 class Database:
     """
     just some code to make the communication with database easier
@@ -39,6 +106,7 @@ class Database:
         # in case any of the tables don't exist, we create them
         create_clients(conn)
         create_files(conn)
+        create_usage(conn)
         conn.close()
 
     def fetch_data(self, table, column=None):
@@ -48,16 +116,19 @@ class Database:
         :param column: columns to fetch (None for all)
         :return: result from qury
         """
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
+        start = time.perf_counter()
+        with tracing.span("db.fetch_data", table=table):
+            conn = sqlite3.connect(self.db)
+            cur = conn.cursor()
 
-        if column is None:
-            cur.execute(f"SELECT * FROM {table}")
-        else:
-            cur.execute(f"SELECT {column} FROM {table}")
+            if column is None:
+                cur.execute(f"SELECT * FROM {table}")
+            else:
+                cur.execute(f"SELECT {column} FROM {table}")
 
-        result = cur.fetchall()
-        conn.close()
+            result = cur.fetchall()
+            conn.close()
+        metrics.DB_SECONDS.observe(time.perf_counter() - start, "fetch_data")
         return result
 
     def query(self, query, args):
@@ -67,13 +138,19 @@ class Database:
         :param args: array of arguments
         :return: (bool) succeeded?
         """
+        start = time.perf_counter()
+        span = tracing.span("db.query", statement=query)
         conn = sqlite3.connect(self.db)
         try:
             conn.execute(query, args)
             conn.commit()
         except Exception as e:
-            print(f"Exception in query - {e}")
+            logger.error("Exception in query - %s", e)
+            span.set("ok", False)
             return False
+        finally:
+            metrics.DB_SECONDS.observe(time.perf_counter() - start, "query")
+            span.end()
         conn.close()
         return True
 
@@ -84,6 +161,8 @@ class Database:
         :param args: array of arguments
         :return: result from query
         """
+        start = time.perf_counter()
+        span = tracing.span("db.query_with_result", statement=query)
         conn = sqlite3.connect(self.db)
         res = None
         try:
@@ -91,10 +170,82 @@ class Database:
             cur.execute(query, args)
             res = cur.fetchall()
         except Exception as e:
-            print(f"Exception in query - {e}")
+            logger.error("Exception in query - %s", e)
+            span.set("ok", False)
         conn.close()
+        metrics.DB_SECONDS.observe(time.perf_counter() - start, "query_with_result")
+        span.end()
         return res
 
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        run several statements as one transaction
+            with db.transaction() as conn:
+                conn.execute(...)
+        everything is committed when the block ends, or rolled back if it raises (the exception goes on)
+        :param immediate: take the write lock with the first statement, even if it's a read (or a temp table write),
+                          so nothing changes between what the transaction reads and what it writes
+        :return: sqlite3 connection to run the statements on
+        """
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.db, isolation_level="IMMEDIATE" if immediate else "")
+        try:
+            with tracing.span("db.transaction"), conn:
+                yield conn
+        finally:
+            conn.close()
+            metrics.DB_SECONDS.observe(time.perf_counter() - start, "transaction")
+
+    def provision(self, names, quota_bytes=None, quota_files=None):
+        """
+        register many users at once, the bulk version of 1100 for setting up a new site
+        it's all one transaction, and the names that are taken are found with a single query
+        the users still have to send 1101 with their public key (and the id they were given) before logging in
+        a running server only knows about users it loaded on start or registered itself, so provision before
+        starting it (or restart it after)
+
+        :param names: list of user names
+        :param quota_bytes: QuotaBytes of the new users (None for the configured quota)
+        :param quota_files: QuotaFiles of the new users (None for the configured quota)
+        :return: tuple - (list of (name, id hex) that were created, list of (name, reason) that were skipped)
+        """
+        start = time.perf_counter()
+        skipped = []
+        wanted = []
+        seen = set()
+        for name in names:
+            if not name:
+                skipped.append((name, "empty"))
+            elif len(name.encode("utf-8")) >= protocol.NAME_SIZE:
+                # the name field of the protocol ends with a null
+                skipped.append((name, "too long"))
+            elif name in seen:
+                skipped.append((name, "duplicate"))
+            else:
+                seen.add(name)
+                wanted.append(name)
+
+        with self.transaction(immediate=True) as conn:
+            conn.execute("CREATE TEMP TABLE provision (Name CHAR(255) NOT NULL PRIMARY KEY)")
+            conn.executemany("INSERT INTO provision (Name) VALUES (?)", [(name,) for name in wanted])
+            taken = {row[0] for row in conn.execute("SELECT Name FROM clients "
+                                                    "WHERE Name IN (SELECT Name FROM provision)")}
+            now = str(datetime.now())
+            created = [(name, uuid.uuid4().hex) for name in wanted if name not in taken]
+            conn.executemany("INSERT INTO clients (ID, Name, LastSeen) VALUES (?, ?, ?)",
+                             [(user_id, name, now) for name, user_id in created])
+            if quota_bytes is not None or quota_files is not None:
+                conn.executemany("INSERT INTO usage (ID, Bytes, Files, QuotaBytes, QuotaFiles) VALUES (?, 0, 0, ?, ?)",
+                                 [(user_id, quota_bytes, quota_files) for _, user_id in created])
+            conn.execute("DROP TABLE provision")
+
+        skipped += [(name, "taken") for name in wanted if name in taken]
+        metrics.DB_SECONDS.observe(time.perf_counter() - start, "provision")
+        logger.info("Provisioned %d users (%d skipped) in %.2fs", len(created), len(skipped),
+                    time.perf_counter() - start)
+        return created, skipped
+
     def print_data(self, table):
         """
         unused in the code, but this just prints data from the database
@@ -105,3 +256,64 @@ class Database:
         cur.execute(f"SELECT * FROM {table}")
         print(cur.fetchall())
         conn.close()
+
+
+def read_names(f):
+    """
+    :param f: text file with a user name on every line. blank lines and lines starting with # are skipped
+    :return: list of names
+    """
+    names = []
+    for line in f:
+        name = line.strip()
+        if name and not name.startswith("#"):
+            names.append(name)
+    return names
+
+
+def main(argv=None):
+    """
+    command line tools for the server database. run them from the directory the server runs in
+        python database.py provision new-site.txt --output new-site-ids.csv [--database server.db]
+    """
+    parser = argparse.ArgumentParser(description="mmn15 server database tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    provision = commands.add_parser("provision", help="register a list of users in one transaction "
+                                                      "(while the server is stopped)")
+    provision.add_argument("names", help="file with one user name per line, - for stdin")
+    provision.add_argument("--output", default="-", help="where to write the name,id CSV of the new users "
+                                                         "(- for stdout)")
+    provision.add_argument("--quota-bytes", type=int, default=None, help="storage quota of the new users")
+    provision.add_argument("--quota-files", type=int, default=None, help="file quota of the new users")
+    provision.add_argument("--database", default=None, help="database file (the server's setting by default)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    database = args.database
+    if database is None:
+        database = config.load_config().database
+
+    if args.names == "-":
+        names = read_names(sys.stdin)
+    else:
+        with open(args.names, encoding="utf-8") as f:
+            names = read_names(f)
+
+    created, skipped = Database(database).provision(names, args.quota_bytes, args.quota_files)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    try:
+        writer = csv.writer(output)
+        writer.writerow(["name", "id"])
+        writer.writerows(created)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    for name, reason in skipped:
+        logger.warning("Skipped %r: %s", name, reason)
+    return 1 if skipped else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
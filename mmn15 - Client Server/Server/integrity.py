@@ -0,0 +1,58 @@
+import hashlib
+import struct
+import zlib
+from checksum import memcrc
+from protocol import IntegrityAlgorithms
+
+"""
+Integrity checks a client can ask for in 1103 (protocol version 4 and up)
+
+cksum stays what older clients get, and is still calculated by checksum.py after the file is written
+(so big files can use the process pool). the others are much faster and are fed the decrypted content
+while it's being written, see Storage.write
+
+every hasher here has update(bytes) and digest() -> bytes, like the hashlib ones
+"""
+
+BLAKE2B_DIGEST_SIZE = 32  # bytes
+
+
+class Crc32:
+    """
+    zlib crc32 with the hashlib interface. the digest is the value as a little endian uint32,
+    same as the cksum value in 2103
+    """
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return struct.pack("<L", self.value)
+
+
+def new_hasher(algorithm):
+    """
+    :param algorithm: IntegrityAlgorithms value
+    :return: a new hasher, or None for cksum (which isn't calculated while writing)
+    """
+    if algorithm == IntegrityAlgorithms.CRC32.value:
+        return Crc32()
+    if algorithm == IntegrityAlgorithms.BLAKE2B.value:
+        return hashlib.blake2b(digest_size=BLAKE2B_DIGEST_SIZE)
+    return None
+
+
+def digest_of(algorithm, data):
+    """
+    digest of some content in one go, the way it's sent in 2103. used by clients to check the response
+    :param algorithm: IntegrityAlgorithms value
+    :param data: (bytes) the whole file
+    :return: bytes
+    """
+    hasher = new_hasher(algorithm)
+    if hasher is None:
+        return struct.pack("<L", memcrc(data))
+    hasher.update(data)
+    return hasher.digest()
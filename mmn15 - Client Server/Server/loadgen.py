@@ -0,0 +1,545 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import struct
+import time
+import uuid
+from collections import defaultdict
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Util.Padding import pad, unpad
+from checksum import memcrc
+import integrity
+import protocol
+import server
+
+"""
+Load generator for the server
+
+speaks the same protocol as the C++ client (1100 - 1106) and runs many simulated clients on one asyncio loop
+every simulated client registers, exchanges keys, logs in and uploads files, answering the CRC with 1104 - 1106
+with --fetch every verified file is also downloaded again (1107) and compared
+at the end a report with throughput and p50/p99 latency per request code is printed
+
+only talks to the server it's pointed at, nothing else is needed. example:
+    python loadgen.py --port 8080 --clients 2000 --concurrency 200 --sizes lognormal:64k:1.5
+    python loadgen.py --unix /run/mmn15/server.sock --clients 8 --sizes fixed:16m     # over the unix socket
+    python loadgen.py --port 8080 --integrity blake2b   # protocol version 4, ask for blake2b instead of cksum
+    python loadgen.py --port 8080 --chunk-size 256k      # protocol version 5, uploads as one stream in 256k chunks
+"""
+
+PACKET_SIZE = server.Server.PACKET_SIZE
+RSA_BITS = 1024
+RSA_EXPONENT = 17  # crypto++ uses 17 as well, which makes the X.509 key exactly PUBLIC_KEY_SIZE bytes
+RESPONSE_HEADER_SIZE = protocol.HEADER_SIZE
+CLIENT_VERSION = protocol.LEGACY_VERSION  # same as the C++ client, unless an integrity algorithm is asked for
+MAX_CRC_ATTEMPTS = 3
+
+# the client sends the file in chunks that are encrypted separately (each with its own padding)
+# the first one shares the packet with the request header, the others fill a packet once padded
+FIRST_CHUNK_SIZE = PACKET_SIZE - protocol.REQUEST_HEADER_SIZE - protocol.NAME_SIZE - protocol.CONTENT_SIZE_SIZE
+FIRST_CHUNK_SIZE = ((FIRST_CHUNK_SIZE // AES.block_size) - 1) * AES.block_size
+CHUNK_SIZE = PACKET_SIZE - AES.block_size
+DRAIN_BYTES = 64 * 1024  # bytes written before waiting for the socket to take them
+STREAM_CHUNK_SIZE = 64 * 1024  # chunk size of version 5 uploads, unless asked otherwise
+
+SIZE_SUFFIXES = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def parse_size(text):
+    """
+    :param text: size like 512, 64k or 2m
+    :return: size in bytes
+    """
+    text = text.strip().lower()
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def size_distribution(spec):
+    """
+    parse a file size distribution
+        fixed:SIZE
+        uniform:MIN:MAX
+        lognormal:MEDIAN:SIGMA
+        choice:SIZE,SIZE,...
+    :param spec: distribution string
+    :return: function that takes a random.Random and returns a size in bytes
+    """
+    kind, _, args = spec.partition(":")
+    parts = args.split(":") if args else []
+    if kind == "fixed":
+        size = parse_size(parts[0])
+        return lambda rng: size
+    if kind == "uniform":
+        low, high = parse_size(parts[0]), parse_size(parts[1])
+        return lambda rng: rng.randint(low, high)
+    if kind == "lognormal":
+        median, sigma = parse_size(parts[0]), float(parts[1])
+        mu = 0.0 if median <= 0 else math.log(median)
+        return lambda rng: max(1, int(rng.lognormvariate(mu, sigma)))
+    if kind == "choice":
+        sizes = [parse_size(size) for size in args.split(",")]
+        return lambda rng: rng.choice(sizes)
+    raise ValueError(f"unknown size distribution {spec}")
+
+
+def percentile(sorted_values, pct):
+    """
+    nearest rank percentile
+    :param sorted_values: sorted list of numbers
+    :param pct: percentile between 0 and 100
+    """
+    if not sorted_values:
+        return 0.0
+    # multiplied before dividing, so 99% of 100 is exactly 99 and not a hair over it
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100) - 1))
+    return sorted_values[rank]
+
+
+def fixed_str(value, size):
+    return struct.pack(f"<{size}s", value.encode("utf-8") if isinstance(value, str) else value)
+
+
+def encrypt_chunks(key, data):
+    """
+    encrypt file content the same way the C++ client does
+    :param key: AES session key
+    :param data: file content
+    :return: generator of encrypted chunks
+    """
+    iv = AES.block_size * b'\0'
+    yield AES.new(key, AES.MODE_CBC, iv).encrypt(pad(data[:FIRST_CHUNK_SIZE], AES.block_size))
+    for offset in range(FIRST_CHUNK_SIZE, len(data), CHUNK_SIZE):
+        yield AES.new(key, AES.MODE_CBC, iv).encrypt(pad(data[offset:offset + CHUNK_SIZE], AES.block_size))
+
+
+def encrypt_stream(key, data, chunk_size):
+    """
+    encrypt file content as one CBC stream (protocol version 5 and up)
+    :param key: AES session key
+    :param data: file content
+    :param chunk_size: size of the encrypted chunks (a multiple of the AES block size)
+    :return: generator of encrypted chunks, all chunk_size bytes but the last one
+    """
+    cipher = AES.new(key, AES.MODE_CBC, AES.block_size * b'\0')
+    whole = len(data) // chunk_size * chunk_size
+    for offset in range(0, whole, chunk_size):
+        yield cipher.encrypt(data[offset:offset + chunk_size])
+    # what's left is shorter than a chunk, so it still fits in one once padded (a block of padding alone if empty)
+    yield cipher.encrypt(pad(data[whole:], AES.block_size))
+
+
+def encrypted_size(size, stream=False):
+    """
+    :param size: plain file size
+    :param stream: was the file encrypted as one stream?
+    :return: sum of all encrypted chunk sizes (content size field of 1103)
+    """
+    if stream:
+        return (size // AES.block_size + 1) * AES.block_size
+    total = (min(size, FIRST_CHUNK_SIZE) // AES.block_size + 1) * AES.block_size
+    for offset in range(FIRST_CHUNK_SIZE, size, CHUNK_SIZE):
+        total += (min(CHUNK_SIZE, size - offset) // AES.block_size + 1) * AES.block_size
+    return total
+
+
+class Stats:
+    """
+    latencies and errors per request code
+    """
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.uploaded = 0
+        self.clients_done = 0
+        self.clients_failed = 0
+
+    def record(self, code, seconds, ok=True):
+        if ok:
+            self.latencies[code].append(seconds)
+        else:
+            self.errors[code] += 1
+
+    def report(self, elapsed):
+        """
+        :param elapsed: wall time of the run in seconds
+        :return: (dict) summary of the run
+        """
+        codes = {}
+        for code in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(code, []))
+            codes[str(code)] = {
+                "count": len(values),
+                "errors": self.errors.get(code, 0),
+                "rate": len(values) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": (values[-1] if values else 0.0) * 1000,
+            }
+        return {
+            "elapsed_s": elapsed,
+            "clients_done": self.clients_done,
+            "clients_failed": self.clients_failed,
+            "requests": sum(len(values) for values in self.latencies.values()),
+            "errors": sum(self.errors.values()),
+            "upload_mb": self.uploaded / 1_000_000,
+            "upload_mbps": self.uploaded / 1_000_000 / elapsed if elapsed else 0.0,
+            "codes": codes,
+        }
+
+
+def print_report(report):
+    print(f"elapsed {report['elapsed_s']:.2f}s, clients done {report['clients_done']}, "
+          f"failed {report['clients_failed']}")
+    print(f"requests {report['requests']}, errors {report['errors']}, "
+          f"uploaded {report['upload_mb']:.2f} MB ({report['upload_mbps']:.2f} MB/s)")
+    print(f"{'code':>6} {'count':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for code, row in report["codes"].items():
+        print(f"{code:>6} {row['count']:>8} {row['errors']:>7} {row['rate']:>9.1f} "
+              f"{row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}")
+
+
+class ProtocolClient:
+    """
+    one simulated client. every request opens a new connection, just like the C++ client
+    """
+    def __init__(self, host, port, name, stats, version=CLIENT_VERSION, unix_path=None, algorithm=None,
+                 chunk_size=STREAM_CHUNK_SIZE):
+        """
+        :param unix_path: connect to the server's unix socket at this path instead of host:port
+        :param algorithm: IntegrityAlgorithms value to ask for in 1103 (needs version INTEGRITY_VERSION and up)
+        :param chunk_size: chunks uploads are sent in (needs version STREAM_VERSION and up)
+        """
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.name = name
+        self.stats = stats
+        self.version = version
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        if self.version >= protocol.INTEGRITY_VERSION and self.algorithm is None:
+            self.algorithm = protocol.IntegrityAlgorithms.CKSUM.value
+        self.client_id = protocol.CLIENT_ID_SIZE * b'\0'
+        self.rsa_key = None
+        self.session_key = None
+
+    async def connect(self):
+        if self.unix_path is not None:
+            return await asyncio.open_unix_connection(self.unix_path)
+        return await asyncio.open_connection(self.host, self.port)
+
+    def header(self, code, payload_size):
+        return self.client_id + struct.pack("<BHL", self.version, code, payload_size)
+
+    async def request(self, code, first_packet, packets=(), pad_packets=True):
+        """
+        send a request and read the response until the server closes the connection
+        :param code: request code (used for the stats)
+        :param first_packet: header + payload of the request
+        :param packets: iterable of extra data sent after the first packet
+        :param pad_packets: pad every one of them to a full packet? (not for version 5 upload streams)
+        :return: tuple - (response code, response payload). code is None if the server didn't respond
+        """
+        start = time.perf_counter()
+        writer = None
+        try:
+            reader, writer = await self.connect()
+            writer.write(first_packet.ljust(PACKET_SIZE, b'\0'))
+            buffered = 0
+            for packet in packets:
+                if pad_packets:
+                    packet = packet.ljust(PACKET_SIZE, b'\0')
+                writer.write(packet)
+                buffered += len(packet)
+                if buffered >= DRAIN_BYTES:
+                    await writer.drain()
+                    buffered = 0
+            await writer.drain()
+            data = await reader.read()
+        except (OSError, asyncio.IncompleteReadError):
+            self.stats.record(code, time.perf_counter() - start, ok=False)
+            raise
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if not data:
+            self.stats.record(code, time.perf_counter() - start)
+            return None, b''
+
+        _, response_code, payload_size = struct.unpack("<BHL", data[:RESPONSE_HEADER_SIZE])
+        payload = data[RESPONSE_HEADER_SIZE:RESPONSE_HEADER_SIZE + payload_size]
+        self.stats.record(code, time.perf_counter() - start,
+                          ok=response_code != protocol.ResponseCodes.RESPONSE_ERROR.value)
+        return response_code, payload
+
+    def expect(self, response_code, *expected):
+        if response_code not in expected:
+            raise ProtocolError(f"{self.name} got {response_code}, expected {expected}")
+
+    async def register(self):
+        code = protocol.RequestCodes.REQUEST_REGISTRATION.value
+        response_code, payload = await self.request(code, self.header(code, protocol.NAME_SIZE) +
+                                                    fixed_str(self.name, protocol.NAME_SIZE))
+        self.expect(response_code, protocol.ResponseCodes.RESPONSE_REGISTRATION.value)
+        self.client_id = payload[:protocol.CLIENT_ID_SIZE]
+
+    def take_session_key(self, payload):
+        self.session_key = PKCS1_OAEP.new(self.rsa_key).decrypt(payload[protocol.CLIENT_ID_SIZE:])
+
+    async def exchange_keys(self, rsa_key):
+        self.rsa_key = rsa_key
+        public_key = rsa_key.publickey().export_key("DER")
+        code = protocol.RequestCodes.REQUEST_PUBLIC_KEY.value
+        response_code, payload = await self.request(
+            code, self.header(code, protocol.NAME_SIZE + protocol.PUBLIC_KEY_SIZE) +
+            fixed_str(self.name, protocol.NAME_SIZE) + fixed_str(public_key, protocol.PUBLIC_KEY_SIZE))
+        self.expect(response_code, protocol.ResponseCodes.RESPONSE_PUBLIC_KEY.value)
+        self.take_session_key(payload)
+
+    async def login(self):
+        code = protocol.RequestCodes.REQUEST_LOGIN.value
+        response_code, payload = await self.request(code, self.header(code, protocol.NAME_SIZE) +
+                                                    fixed_str(self.name, protocol.NAME_SIZE))
+        self.expect(response_code, protocol.ResponseCodes.RESPONSE_LOGIN.value,
+                    protocol.ResponseCodes.RESPONSE_FAILED_LOGIN.value)
+        if response_code == protocol.ResponseCodes.RESPONSE_LOGIN.value:
+            self.take_session_key(payload)
+        else:
+            # same as the C++ client, a failed login is followed by a new key exchange
+            self.client_id = payload[:protocol.CLIENT_ID_SIZE]
+            await self.exchange_keys(self.rsa_key)
+
+    def file_packets(self, file_name, data):
+        """
+        :return: tuple - (first packet, generator of the other packets) of a 1103 request, before padding
+        """
+        code = protocol.RequestCodes.REQUEST_SEND_FILE.value
+        stream = self.version >= protocol.STREAM_VERSION
+        fields = fixed_str(file_name, protocol.NAME_SIZE)
+        if self.version >= protocol.INTEGRITY_VERSION:
+            fields += struct.pack("<B", self.algorithm)
+        if stream:
+            # only the fields go in the first packet, the stream starts after it
+            fields += struct.pack("<L", self.chunk_size)
+            chunks = encrypt_stream(self.session_key, data, self.chunk_size)
+            first_chunk = b''
+        else:
+            chunks = encrypt_chunks(self.session_key, data)
+            first_chunk = next(chunks)
+        first_packet = self.header(code, protocol.CONTENT_SIZE_SIZE + len(fields) + len(first_chunk))
+        first_packet += struct.pack("<L", encrypted_size(len(data), stream)) + fields + first_chunk
+        return first_packet, chunks
+
+    async def send_file(self, file_name, data):
+        """
+        1103
+        :return: the checksum the server calculated. an int (cksum) for older versions, the digest bytes from version 4
+        """
+        code = protocol.RequestCodes.REQUEST_SEND_FILE.value
+        first_packet, chunks = self.file_packets(file_name, data)
+        response_code, payload = await self.request(code, first_packet, chunks,
+                                                    self.version < protocol.STREAM_VERSION)
+        self.expect(response_code, protocol.ResponseCodes.RESPONSE_FILE.value)
+        self.stats.uploaded += len(data)
+        offset = protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE
+        if self.version < protocol.INTEGRITY_VERSION:
+            return struct.unpack("<L", payload[offset:offset + protocol.CHECK_SUM_SIZE])[0]
+        if payload[offset] != self.algorithm:
+            raise ProtocolError(f"{self.name} asked for algorithm {self.algorithm}, got {payload[offset]}")
+        return bytes(payload[offset + protocol.ALGORITHM_SIZE:])
+
+    async def crc_reply(self, code, file_name):
+        response_code, _ = await self.request(code, self.header(code, protocol.NAME_SIZE) +
+                                              fixed_str(file_name, protocol.NAME_SIZE))
+        if code != protocol.RequestCodes.REQUEST_WARNING_CRC.value:
+            self.expect(response_code, protocol.ResponseCodes.RESPONSE_RECEIVED.value)
+
+    async def fetch_file(self, file_name):
+        """
+        1107
+        :return: the decrypted file content the server sent back
+        """
+        code = protocol.RequestCodes.REQUEST_GET_FILE.value
+        response_code, payload = await self.request(code, self.header(code, protocol.NAME_SIZE) +
+                                                    fixed_str(file_name, protocol.NAME_SIZE))
+        self.expect(response_code, protocol.ResponseCodes.RESPONSE_GET_FILE.value)
+        offset = protocol.CLIENT_ID_SIZE
+        content_size = struct.unpack("<L", payload[offset:offset + protocol.CONTENT_SIZE_SIZE])[0]
+        offset += protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE
+        iv = payload[offset:offset + protocol.IV_SIZE]
+        offset += protocol.IV_SIZE
+        content = payload[offset:offset + content_size]
+        return unpad(AES.new(self.session_key, AES.MODE_CBC, iv).decrypt(content), AES.block_size)
+
+    async def upload(self, file_name, data, expected_cksum):
+        """
+        upload a file and answer the CRC the way the C++ client does (up to 3 attempts)
+        :return: (bool) did the CRC match?
+        """
+        for attempt in range(MAX_CRC_ATTEMPTS):
+            if await self.send_file(file_name, data) == expected_cksum:
+                await self.crc_reply(protocol.RequestCodes.REQUEST_VALID_CRC.value, file_name)
+                return True
+            if attempt < MAX_CRC_ATTEMPTS - 1:
+                await self.crc_reply(protocol.RequestCodes.REQUEST_WARNING_CRC.value, file_name)
+        await self.crc_reply(protocol.RequestCodes.REQUEST_ERROR_CRC.value, file_name)
+        return False
+
+
+class FileContent:
+    """
+    file contents for the simulated uploads
+    every file is a prefix of one random blob so we only pay for the (pure python) cksum once per size
+    """
+    def __init__(self, seed=0, algorithm=None):
+        """
+        :param algorithm: IntegrityAlgorithms value the clients ask for, None for older clients (cksum as an int)
+        """
+        self.rng = random.Random(seed)
+        self.algorithm = algorithm
+        self.blob = b''
+        self.cksums = {}
+
+    def get(self, size):
+        """
+        :return: tuple - (content, what the server should answer in 2103 for it)
+        """
+        if size > len(self.blob):
+            self.blob += self.rng.randbytes(size - len(self.blob))
+        data = self.blob[:size]
+        if size not in self.cksums:
+            if self.algorithm is None:
+                self.cksums[size] = memcrc(data)
+            else:
+                self.cksums[size] = integrity.digest_of(self.algorithm, data)
+        return data, self.cksums[size]
+
+
+class LoadGenerator:
+    def __init__(self, host, port, clients, concurrency, files_per_client, sizes, size_step=1024,
+                 key_pool=8, seed=None, version=CLIENT_VERSION, fetch=False, unix_path=None, algorithm=None,
+                 chunk_size=STREAM_CHUNK_SIZE):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.clients = clients
+        self.concurrency = concurrency
+        self.files_per_client = files_per_client
+        self.sizes = sizes
+        self.size_step = size_step
+        self.version = version
+        self.algorithm = algorithm
+        if version >= protocol.INTEGRITY_VERSION and algorithm is None:
+            self.algorithm = protocol.IntegrityAlgorithms.CKSUM.value
+        self.chunk_size = chunk_size
+        self.fetch = fetch
+        self.rng = random.Random(seed)
+        self.content = FileContent(seed or 0, self.algorithm)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.stats = Stats()
+        # RSA key generation is slow and isn't what we're measuring, so clients share a small pool of keys
+        self.keys = [RSA.generate(RSA_BITS, e=RSA_EXPONENT) for _ in range(max(1, key_pool))]
+
+    def make_client(self, index):
+        return ProtocolClient(self.host, self.port, f"load-{self.run_id}-{index}", self.stats, self.version,
+                              self.unix_path, self.algorithm, self.chunk_size)
+
+    def file_size(self):
+        size = self.sizes(self.rng)
+        if self.size_step > 1:
+            size = max(self.size_step, (size // self.size_step) * self.size_step)
+        return size
+
+    async def run_client(self, index):
+        client = self.make_client(index)
+        await client.register()
+        await client.exchange_keys(self.keys[index % len(self.keys)])
+        await client.login()
+        for file_index in range(self.files_per_client):
+            data, cksum = self.content.get(self.file_size())
+            file_name = f"file-{file_index}.bin"
+            if await client.upload(file_name, data, cksum) and self.fetch:
+                if await client.fetch_file(file_name) != data:
+                    raise ProtocolError(f"{client.name} got different content back for {file_name}")
+
+    async def worker(self, queue):
+        while True:
+            try:
+                index = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await self.run_client(index)
+                self.stats.clients_done += 1
+            except (OSError, ProtocolError, ValueError, asyncio.IncompleteReadError):
+                self.stats.clients_failed += 1
+
+    async def run(self):
+        """
+        :return: (dict) report of the run
+        """
+        queue = asyncio.Queue()
+        for index in range(self.clients):
+            queue.put_nowait(index)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(self.worker(queue) for _ in range(min(self.concurrency, self.clients))))
+        return self.stats.report(time.perf_counter() - start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="protocol speaking load generator for the mmn15 server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", dest="unix_path", default=None,
+                        help="connect to this unix socket (the server's unix_socket setting) instead of host:port")
+    parser.add_argument("--clients", type=int, default=100, help="number of simulated clients")
+    parser.add_argument("--concurrency", type=int, default=50, help="clients running at the same time")
+    parser.add_argument("--files", type=int, default=1, help="files uploaded by every client")
+    parser.add_argument("--sizes", default="lognormal:16k:1.0",
+                        help="file size distribution: fixed:S, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA, choice:S,S")
+    parser.add_argument("--size-step", type=parse_size, default="1k",
+                        help="round file sizes down to this step (limits how many different checksums we compute)")
+    parser.add_argument("--key-pool", type=int, default=8, help="RSA keys shared by the clients")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--fetch", action="store_true", help="download every verified file again (1107)")
+    parser.add_argument("--integrity", choices=[algorithm.name.lower() for algorithm in protocol.IntegrityAlgorithms],
+                        default=None, help="speak protocol version 4 and ask for this integrity check "
+                                           "(by default the clients are version 3, like the C++ one, and get cksum)")
+    parser.add_argument("--chunk-size", type=parse_size, default=None,
+                        help="speak protocol version 5 and upload every file as one stream in chunks of this size")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    version, algorithm, chunk_size = CLIENT_VERSION, None, STREAM_CHUNK_SIZE
+    if args.integrity is not None:
+        version = protocol.INTEGRITY_VERSION
+        algorithm = protocol.IntegrityAlgorithms[args.integrity.upper()].value
+    if args.chunk_size is not None:
+        version = protocol.STREAM_VERSION
+        chunk_size = args.chunk_size
+    generator = LoadGenerator(args.host, args.port, args.clients, args.concurrency, args.files,
+                              size_distribution(args.sizes), args.size_step, args.key_pool, args.seed,
+                              version, args.fetch, args.unix_path, algorithm, chunk_size)
+    report = asyncio.run(generator.run())
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
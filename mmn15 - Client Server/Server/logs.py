@@ -0,0 +1,119 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+"""
+Logging setup for the server
+
+records are put on a queue by the selector thread and a QueueListener thread formats and writes them,
+so a slow stdout (or whatever is reading it) can't stall the event loop
+
+lines that are logged for every request go through their own logger with a rate limit on it
+"""
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+DEFAULT_LEVEL = "INFO"
+DEFAULT_REQUEST_RATE = 50  # per request lines allowed every second (0 for unlimited)
+REQUEST_LOGGER_SUFFIX = ".requests"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    token bucket filter.
+    lets through up to rate records a second (with bursts of up to rate) and drops the rest
+    the next record that passes mentions how many were dropped before it
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.rate), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar lines suppressed)"
+        return True
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    the stock QueueHandler formats the record before putting it on the queue (so it can be pickled)
+    our queue never leaves the process, so we skip that and let the listener thread do the formatting
+    """
+    def prepare(self, record):
+        return record
+
+
+def request_logger(name):
+    """
+    :param name: module name of the caller
+    :return: the rate limited logger for lines written on every request
+    """
+    return logging.getLogger(name + REQUEST_LOGGER_SUFFIX)
+
+
+def setup_logging(level=DEFAULT_LEVEL, request_rate=DEFAULT_REQUEST_RATE, request_loggers=("server",),
+                  stream=None):
+    """
+    route all logging through a queue and start the thread that writes it out
+    :param level: log level name or number
+    :param request_rate: per request lines allowed every second (0 for unlimited)
+    :param request_loggers: modules whose per request logger should be rate limited
+    :param stream: where to write the logs (stdout by default)
+    :return: the running QueueListener. call stop() on it to flush the remaining records
+    """
+    log_queue = queue.SimpleQueue()
+
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(LocalQueueHandler(log_queue))
+    configure(level, request_rate, request_loggers)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def configure(level=DEFAULT_LEVEL, request_rate=DEFAULT_REQUEST_RATE, request_loggers=("server",)):
+    """
+    set the level and the per request rate limit, e.g. once the settings are loaded
+    (logging is set up before that, so warnings about the settings go through it too)
+    :param level: log level name or number. an unknown name is logged and the level is left as it is
+    :param request_rate: per request lines allowed every second (0 for unlimited)
+    :param request_loggers: modules whose per request logger should be rate limited
+    """
+    root = logging.getLogger()
+    try:
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+    except ValueError:
+        logging.getLogger(__name__).warning("Unknown log level %r, keeping %s", level,
+                                            logging.getLevelName(root.level))
+
+    for name in request_loggers:
+        logger = request_logger(name)
+        for old_filter in list(logger.filters):
+            if isinstance(old_filter, RateLimitFilter):
+                logger.removeFilter(old_filter)
+        logger.addFilter(RateLimitFilter(request_rate))
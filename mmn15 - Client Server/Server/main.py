@@ -1,9 +1,6 @@
 import server
-import utils
-import database
-
-DEFAULT_PORT = 1234
-PORT_FILE = "port.info"
+import config
+import logs
 
 """
    code for mmn15 - Defensive System Programing
@@ -17,15 +14,21 @@ PORT_FILE = "port.info"
 """
 
 if __name__ == "__main__":
-    # parse port (or go to default)
-    port = utils.get_port(PORT_FILE)
-    if port is None:
-        port = DEFAULT_PORT
-
-    # start up the server
-    server = server.Server(port)
-    server.start()
-
-
+    # logs are written by a background thread, stopping the listener flushes whatever is left
+    # it's set up with the defaults first, so problems with the settings are logged like everything else
+    log_listener = logs.setup_logging()
 
+    # server.ini, port.info and MMN15_* environment variables (see config.py)
+    settings = config.load_config()
+    logs.configure(settings.log_level, settings.request_log_rate)
 
+    # start up the server
+    server = server.Server(settings)
+    try:
+        server.start()
+    finally:
+        server.close()
+        server.tracer.close()
+        if server.snapshots is not None:
+            server.snapshots.stop()
+        log_listener.stop()
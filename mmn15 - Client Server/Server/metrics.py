@@ -0,0 +1,215 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Built in metrics for the server
+
+counters, gauges and histograms are kept in memory and rendered in the prometheus text format
+a small http server running on its own thread exposes them, so scraping never touches the selector loop
+
+every metric has its own lock. the loop thread only holds it for a dictionary update
+"""
+
+# in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# in seconds, for waits inside the loop that are usually well under a millisecond
+DELAY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025) + LATENCY_BUCKETS
+# in MB/s
+THROUGHPUT_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNKNOWN_LABEL = "unknown"
+
+
+def format_labels(names, values, extra=None):
+    """
+    :param names: label names
+    :param values: label values (same order as names)
+    :param extra: optional (name, value) pair appended at the end (used for histogram buckets)
+    :return: label string in prometheus format, e.g. {code="1100"}
+    """
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = ""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.TYPE}"]
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # per bucket counts (not cumulative), sum, count
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[labels] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted((labels, (list(entry[0]), entry[1], entry[2])) for labels, entry in self.values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                label_str = format_labels(self.labels, labels, ("le", format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = format_labels(self.labels, labels, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{label_str} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: (str) all registered metrics in the prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter("mmn15_requests_total", "Requests handled by request code", ("code",)))
+REQUEST_LATENCY = REGISTRY.register(Histogram("mmn15_request_duration_seconds",
+                                              "Time spent handling a request by request code", ("code",)))
+BYTES_RECEIVED = REGISTRY.register(Counter("mmn15_received_bytes_total", "Bytes read from clients"))
+BYTES_SENT = REGISTRY.register(Counter("mmn15_sent_bytes_total", "Bytes written to clients"))
+UPLOAD_THROUGHPUT = REGISTRY.register(Histogram("mmn15_upload_throughput_mbps",
+                                                "Upload receive rate of 1103 requests in MB/s",
+                                                buckets=THROUGHPUT_BUCKETS))
+CRC_SECONDS = REGISTRY.register(Histogram("mmn15_crc_duration_seconds", "Time spent calculating a file checksum"))
+AES_SECONDS = REGISTRY.register(Histogram("mmn15_aes_duration_seconds", "Time spent decrypting an uploaded file"))
+DB_SECONDS = REGISTRY.register(Histogram("mmn15_db_query_duration_seconds", "SQLite query latency by call",
+                                         ("call",)))
+QUOTA_REJECTIONS = REGISTRY.register(Counter("mmn15_quota_rejections_total",
+                                            "Uploads refused because the user is over quota"))
+TRACE_SPANS_DROPPED = REGISTRY.register(Counter("mmn15_trace_spans_dropped_total",
+                                                 "Spans dropped because the trace writer fell behind"))
+SNAPSHOT_SECONDS = REGISTRY.register(Histogram("mmn15_snapshot_duration_seconds",
+                                              "Time spent refreshing the reporting snapshot of the database"))
+SNAPSHOT_FALLBACKS = REGISTRY.register(Counter("mmn15_snapshot_fallbacks_total",
+                                               "Snapshots copied in one step, the server's writes kept restarting "
+                                               "the incremental backup"))
+OPEN_CONNECTIONS = REGISTRY.register(Gauge("mmn15_open_connections", "Client connections currently open"))
+LOOP_LAG = REGISTRY.register(Histogram("mmn15_loop_lag_seconds",
+                                       "Time between the selector waking up and being polled again"))
+QUEUE_DELAY = REGISTRY.register(Histogram("mmn15_queue_delay_seconds",
+                                          "Time a ready connection waited for its turn in the loop, by class",
+                                          ("class",), buckets=DELAY_BUCKETS))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes happen every few seconds, no need to log them
+        pass
+
+
+class MetricsServer:
+    """
+    serves REGISTRY over http on a daemon thread
+    binds to localhost by default so the endpoint isn't exposed outside the machine
+    """
+    def __init__(self, port, host="127.0.0.1"):
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,185 @@
+import cProfile
+import logging
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+"""
+On demand profiling for a running server
+
+off by default. SIGUSR1 turns it on (and off again), SIGUSR2 writes what was collected so far
+while it's on, a sample of the dispatched requests runs under cProfile with one profile per request code:
+every piece of work of a sampled request is profiled, on the selector thread and on the I/O pool (the rest of
+an upload, writing it, streaming a file back...), until the request is done
+the sampled 1103 requests also take tracemalloc snapshots around unpacking and decrypting the file
+
+profiles are written with dump_stats (open with pstats, snakeviz...) and snapshots with Snapshot.dump
+(open with tracemalloc.Snapshot.load)
+
+signals only set flags, the actual work happens in poll() which the server loop calls
+"""
+
+DEFAULT_OUTPUT_DIR = "profiles"
+DEFAULT_SAMPLE_RATE = 0.1  # part of the requests that are profiled
+DEFAULT_MAX_SNAPSHOTS = 40  # tracemalloc snapshots written every time profiling is turned on
+TRACE_FRAMES = 10
+
+
+class Profiler:
+    def __init__(self, output_dir=DEFAULT_OUTPUT_DIR, sample_rate=DEFAULT_SAMPLE_RATE,
+                 max_snapshots=DEFAULT_MAX_SNAPSHOTS):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.max_snapshots = max_snapshots
+
+        self.enabled = False
+        self.local = threading.local()  # sampling: True while this thread runs work of a sampled request
+        # (request code, thread name) -> cProfile.Profile. a profile is only ever enabled on its own thread
+        self.profiles = {}
+        self.running = set()  # profiles enabled right now, dump() leaves them for the next time
+        self.lock = threading.Lock()
+        self.snapshot_count = 0
+        self.toggle_requested = False
+        self.dump_requested = False
+
+    def install_signals(self):
+        """
+        hook SIGUSR1 (toggle) and SIGUSR2 (dump). has to be called from the main thread
+        :return: (bool) were the signals installed? (not available on windows)
+        """
+        if not hasattr(signal, "SIGUSR1"):
+            return False
+        try:
+            signal.signal(signal.SIGUSR1, self.request_toggle)
+            signal.signal(signal.SIGUSR2, self.request_dump)
+        except ValueError:
+            # not the main thread (e.g. the server is running inside a test harness)
+            return False
+        return True
+
+    def request_toggle(self, signum=None, frame=None):
+        self.toggle_requested = True
+
+    def request_dump(self, signum=None, frame=None):
+        self.dump_requested = True
+
+    def poll(self):
+        """
+        called by the server loop between events. does whatever the signals asked for
+        """
+        if self.toggle_requested:
+            self.toggle_requested = False
+            if self.enabled:
+                self.stop()
+            else:
+                self.start()
+        if self.dump_requested:
+            self.dump_requested = False
+            self.dump()
+
+    def start(self):
+        self.enabled = True
+        self.snapshot_count = 0
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        logger.warning("Profiling enabled, sampling %.0f%% of requests into %s",
+                       self.sample_rate * 100, self.output_dir)
+
+    def stop(self):
+        """
+        write the collected profiles and go back to zero overhead
+        """
+        self.dump()
+        self.enabled = False
+        self.profiles = {}
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        logger.warning("Profiling disabled")
+
+    @property
+    def sampling(self):
+        return getattr(self.local, "sampling", False)
+
+    def sample(self):
+        """
+        should a request that's dispatched now be profiled? only call this when enabled is True
+        :return: (bool)
+        """
+        return random.random() < self.sample_rate
+
+    def run(self, code, func, *args):
+        """
+        run a piece of work of a sampled request under cProfile, on whatever thread this is
+        :param code: request code, every code gets its own profile
+        :param func: handler function, or whatever continues the request later
+        :return: whatever func returned
+        """
+        if self.sampling:
+            # already inside a profiled piece of work on this thread
+            return func(*args)
+
+        key = (code, threading.current_thread().name)
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile is None:
+                profile = self.profiles[key] = cProfile.Profile()
+            self.running.add(profile)
+
+        self.local.sampling = True
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            self.local.sampling = False
+            with self.lock:
+                self.running.discard(profile)
+
+    def snapshot(self, label):
+        """
+        write a tracemalloc snapshot. only call this for requests that were sampled (sampling was True)
+        :param label: what the snapshot was taken around, e.g. "unpack-before"
+        """
+        if self.snapshot_count >= self.max_snapshots or not tracemalloc.is_tracing():
+            return
+        self.snapshot_count += 1
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{self.timestamp()}-{self.snapshot_count:04d}-{label}.tracemalloc")
+        tracemalloc.take_snapshot().dump(path)
+
+    def dump(self):
+        """
+        write one pstats file for every request code profiled so far
+        :return: list of written paths
+        """
+        paths = []
+        with self.lock:
+            # the profiles of every thread, merged by request code
+            merged = {}
+            for (code, _), profile in self.profiles.items():
+                if profile in self.running:
+                    continue
+                if code in merged:
+                    merged[code].add(profile)
+                else:
+                    merged[code] = pstats.Stats(profile)
+        if not merged:
+            return paths
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = self.timestamp()
+        for code, stats in merged.items():
+            path = os.path.join(self.output_dir, f"{stamp}-{code}.prof")
+            stats.dump_stats(path)
+            paths.append(path)
+        logger.warning("Wrote %d profiles to %s", len(paths), self.output_dir)
+        return paths
+
+    @staticmethod
+    def timestamp():
+        return time.strftime("%Y%m%d-%H%M%S")
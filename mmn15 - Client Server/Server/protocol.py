@@ -1,6 +1,11 @@
+import collections
+import logging
 import struct
+import time
 from enum import Enum
 
+logger = logging.getLogger(__name__)
+
 """
 Handles all protocols for the program
 
@@ -10,7 +15,12 @@ there aren't many comments here because the code is fairly repetitive
 
 DEFAULT = 0
 DEFAULT_STR = b""
-SERVER_VERSION = 3
+SERVER_VERSION = 5
+LEGACY_VERSION = 3  # what the C++ client sends
+INTEGRITY_VERSION = 4  # from this version 1103 says which integrity check it wants, and 2103 carries its digest
+# from this version the content of 1103 is one CBC stream (padded once, at its end) that starts right after the
+# first packet and is sent in chunks of a size the client picks, instead of a packet per separately padded chunk
+STREAM_VERSION = 5
 CLIENT_ID_SIZE = 16
 HEADER_SIZE = 7
 REQUEST_HEADER_SIZE = (CLIENT_ID_SIZE + HEADER_SIZE)  # in bytes
@@ -20,6 +30,18 @@ PUBLIC_KEY_SIZE = 160
 CONTENT_SIZE_SIZE = 4  # post encryption
 CHECK_SUM_SIZE = 4
 SYMMETRIC_KEY_SIZE = 16  # byte
+IV_SIZE = 16  # byte
+ALGORITHM_SIZE = 1  # byte
+CHUNK_SIZE_SIZE = 4  # byte
+BLOCK_SIZE = 16  # AES block, a stream is decrypted a whole number of them at a time
+
+BUFFER_POOL_LIMIT = 64  # free response buffers kept around for reuse
+
+# responses are packed with these (pack_into) straight into a packet buffer
+HEADER = struct.Struct("<BHL")
+CLIENT_ID_FIELD = struct.Struct(f"<{CLIENT_ID_SIZE}s")
+CRC_FIELDS = struct.Struct(f"<{CLIENT_ID_SIZE}sL{NAME_SIZE}s")
+CHECK_SUM_FIELD = struct.Struct("<L")
 
 
 class RequestCodes(Enum):
@@ -30,6 +52,7 @@ class RequestCodes(Enum):
     REQUEST_VALID_CRC = 1104
     REQUEST_WARNING_CRC = 1105
     REQUEST_ERROR_CRC = 1106
+    REQUEST_GET_FILE = 1107
 
 
 class ResponseCodes(Enum):
@@ -41,6 +64,13 @@ class ResponseCodes(Enum):
     RESPONSE_LOGIN = 2105
     RESPONSE_FAILED_LOGIN = 2106
     RESPONSE_ERROR = 2107
+    RESPONSE_GET_FILE = 2108
+
+
+class IntegrityAlgorithms(Enum):
+    CKSUM = 0  # POSIX cksum, what older clients always get
+    CRC32 = 1  # zlib crc32
+    BLAKE2B = 2  # blake2b with a 32 byte digest
 
 
 class RequestHeader:
@@ -75,6 +105,10 @@ class ResponseHeader:
         except:
             return DEFAULT_STR
 
+    def pack_into(self, buffer):
+        HEADER.pack_into(buffer, 0, self.version, self.code, self.payload_size)
+        return HEADER_SIZE
+
 
 """
 ==================
@@ -140,10 +174,26 @@ class FileSendRequest:
         self.header = RequestHeader()
         self.content_size = DEFAULT
         self.file_name = DEFAULT_STR
+        # the encrypted chunks. a stream (STREAM_VERSION and up) is decrypted as it arrives instead,
+        # this is then a bytearray of the plaintext, still padded
         self.content = []
+        self.algorithm = None  # IntegrityAlgorithms value the client asked for, None for older clients
+        self.chunk_size = DEFAULT  # size of the chunks the content comes in, STREAM_VERSION and up
+        self.cipher = None  # AES-CBC cipher of the user, has to be set before a stream is fed
+        self.decrypt_seconds = 0.0  # time the cipher took so far
+        self.bytes_received = DEFAULT  # bytes read from the connection on top of the first packet
+        self.packet_size = DEFAULT
+        self.content_read = DEFAULT
+        self.remaining = DEFAULT  # bytes the client still has to send, padding of the last packet included
+        self.buffer = bytearray()
 
-    def unpack(self, conn, payload):
-        packet_size = len(payload)
+    def unpack(self, payload):
+        """
+        unpack the first packet of the request. the rest of the content is given to feed() as it arrives
+        :param payload: the whole first packet
+        :return: (bool) succeeded?
+        """
+        self.packet_size = len(payload)
         if not self.header.unpack(payload):
             return False
 
@@ -157,25 +207,74 @@ class FileSendRequest:
             self.file_name = struct.unpack(f"<{NAME_SIZE}s", file_name_data)[0].partition(b'\0')[0].decode('utf-8')
             offset += NAME_SIZE
 
+            if self.header.version >= INTEGRITY_VERSION:
+                self.algorithm = IntegrityAlgorithms(payload[offset]).value
+                offset += ALGORITHM_SIZE
+
+            if self.header.version >= STREAM_VERSION:
+                # the first packet only has the fields, the whole content follows it as is (no padding)
+                self.chunk_size = struct.unpack("<L", payload[offset:offset + CHUNK_SIZE_SIZE])[0]
+                if self.chunk_size <= 0:
+                    raise ValueError(f"bad chunk size {self.chunk_size}")
+                self.remaining = self.content_size
+                self.content = bytearray()
+                return True
+
             bytes_read = min(REQUEST_HEADER_SIZE + self.header.payload_size - offset, self.content_size)
-            # because the size of message content varies, as long as we have more content to read we'll do so
             self.content.append(struct.unpack(f"<{bytes_read}s", payload[offset:offset + bytes_read])[0])
-            while bytes_read < self.content_size:
-                data = conn.recv(packet_size)
-                data_size = len(data)
-                # because we know the content size,
-                # we can make sure the server won't read any spam by limiting data_size to content size - bytes read
-                data_size = min(data_size, self.content_size - bytes_read)
-                self.content.append(struct.unpack(f"<{data_size}s", data[:data_size])[0])
-                bytes_read += data_size
+            self.content_read = bytes_read
+
+            # the client sends every other encrypted chunk in a packet of its own, the last one padded with zeros
+            self.chunk_size = self.packet_size
+            left = self.content_size - bytes_read
+            self.remaining = -(-left // self.packet_size) * self.packet_size
             return True
         except Exception as e:
-            print(f"Exception while unpacking file request - {e}")
+            logger.error("Exception while unpacking file request - %s", e)
             self.content_size = DEFAULT
             self.file_name = DEFAULT_STR
             self.content = []
+            self.algorithm = None
+            self.chunk_size = DEFAULT
             return False
 
+    def feed(self, data):
+        """
+        add data read from the connection after the first packet
+        :param data: (bytes) at most remaining bytes
+        :return: (bool) is the whole request here?
+        """
+        self.bytes_received += len(data)
+        self.remaining -= len(data)
+        # because we know the content size,
+        # we can make sure the server won't read any spam by ignoring whatever comes after it (the padding)
+        data = data[:self.content_size - self.content_read]
+        self.content_read += len(data)
+
+        if self.header.version >= STREAM_VERSION:
+            # one CBC stream, whatever the client's chunks are. decrypt the whole blocks that are here,
+            # the rest of a block waits in the buffer for the next read
+            if self.buffer:
+                self.buffer += data
+                data = self.buffer
+            whole = len(data) - len(data) % BLOCK_SIZE
+            if whole:
+                start = time.perf_counter()
+                self.content += self.cipher.decrypt(memoryview(data)[:whole])
+                self.decrypt_seconds += time.perf_counter() - start
+            self.buffer = bytearray(data[whole:])
+            return self.remaining <= 0
+
+        # every packet is a chunk that was encrypted (and padded) on its own
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.content.append(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        if self.content_read == self.content_size and self.buffer:
+            self.content.append(bytes(self.buffer))
+            self.buffer.clear()
+        return self.remaining <= 0
+
 
 class CRCRequest:
     def __init__(self):
@@ -211,6 +310,11 @@ class ErrorCRCRequest(CRCRequest):
     pass
 
 
+class GetFileRequest(CRCRequest):
+    # the payload is just the file name, same as the CRC requests
+    pass
+
+
 """
 ==================
 
@@ -231,9 +335,14 @@ class GenericResponse:  # 2104
             data += struct.pack(f"<{CLIENT_ID_SIZE}s", self.client_id)
             return data
         except Exception as e:
-            print(f"Error when packing: {e}")
+            logger.error("Error when packing: %s", e)
             return DEFAULT_STR
 
+    def pack_into(self, buffer):
+        offset = self.header.pack_into(buffer)
+        CLIENT_ID_FIELD.pack_into(buffer, offset, self.client_id)
+        return offset + CLIENT_ID_SIZE
+
 
 class RegistrationResponse(GenericResponse):  # 2100
     def __init__(self):
@@ -251,6 +360,9 @@ class RegistrationFailedResponse:  # 2101
         except:
             return DEFAULT_STR
 
+    def pack_into(self, buffer):
+        return self.header.pack_into(buffer)
+
 
 class PublicKeyResponse:  # 2102
     def __init__(self):
@@ -267,6 +379,12 @@ class PublicKeyResponse:  # 2102
         except:
             return DEFAULT_STR
 
+    def pack_into(self, buffer):
+        offset = self.header.pack_into(buffer)
+        key_size = self.header.payload_size - CLIENT_ID_SIZE
+        struct.pack_into(f"<{CLIENT_ID_SIZE}s{key_size}s", buffer, offset, self.client_id, self.symmetric_key)
+        return offset + self.header.payload_size
+
 
 class CRCResponse:  # 2103
     def __init__(self):
@@ -275,6 +393,8 @@ class CRCResponse:  # 2103
         self.content_size = DEFAULT
         self.file_name = DEFAULT_STR
         self.cksum = DEFAULT_STR
+        self.algorithm = None  # set for clients of INTEGRITY_VERSION and up, which get digest instead of cksum
+        self.digest = DEFAULT_STR
 
     def pack(self):
         try:
@@ -282,12 +402,25 @@ class CRCResponse:  # 2103
             data += struct.pack(f"<{CLIENT_ID_SIZE}s", self.client_id)
             data += struct.pack(f"<L", self.content_size)
             data += struct.pack(f"<{NAME_SIZE}s", self.file_name)
-            data += struct.pack(f"<L", self.cksum)
+            if self.algorithm is None:
+                data += struct.pack(f"<L", self.cksum)
+            else:
+                data += struct.pack(f"<B{len(self.digest)}s", self.algorithm, self.digest)
             return data
         except Exception as e:
-            print(f"Exception while packing CRC - {e}")
+            logger.error("Exception while packing CRC - %s", e)
             return DEFAULT_STR
 
+    def pack_into(self, buffer):
+        offset = self.header.pack_into(buffer)
+        CRC_FIELDS.pack_into(buffer, offset, self.client_id, self.content_size, self.file_name)
+        offset += CRC_FIELDS.size
+        if self.algorithm is None:
+            CHECK_SUM_FIELD.pack_into(buffer, offset, self.cksum)
+            return offset + CHECK_SUM_SIZE
+        struct.pack_into(f"<B{len(self.digest)}s", buffer, offset, self.algorithm, self.digest)
+        return offset + ALGORITHM_SIZE + len(self.digest)
+
 
 class LoginResponse(PublicKeyResponse):  # 2105
     def __init__(self):
@@ -311,3 +444,85 @@ class ErrorResponse:
             return self.header.pack()
         except:
             return DEFAULT_STR
+
+    def pack_into(self, buffer):
+        return self.header.pack_into(buffer)
+
+
+class GetFileResponse:  # 2108
+    """
+    only packs the fields before the file content
+    the content itself (content_size bytes, encrypted with the session key) is streamed right after it
+    """
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCodes.RESPONSE_GET_FILE.value)
+        self.client_id = DEFAULT_STR
+        self.content_size = DEFAULT
+        self.file_name = DEFAULT_STR
+        self.iv = DEFAULT_STR
+
+    def pack(self):
+        try:
+            self.header.payload_size = CLIENT_ID_SIZE + CONTENT_SIZE_SIZE + NAME_SIZE + IV_SIZE + self.content_size
+            data = self.header.pack()
+            data += struct.pack(f"<{CLIENT_ID_SIZE}s", self.client_id)
+            data += struct.pack(f"<L", self.content_size)
+            data += struct.pack(f"<{NAME_SIZE}s", self.file_name)
+            data += struct.pack(f"<{IV_SIZE}s", self.iv)
+            return data
+        except Exception as e:
+            logger.error("Exception while packing file response - %s", e)
+            return DEFAULT_STR
+
+
+def negotiated_version(client_version):
+    """
+    :param client_version: version in the header of a request
+    :return: version of the responses to it. the client's own, unless it's newer than the server
+    """
+    return min(client_version, SERVER_VERSION)
+
+
+def frame(response, packet_size, version=SERVER_VERSION):
+    """
+    pack a response that never changes once, padded to a whole packet, so it can be sent as is every time
+    :param version: version in its header
+    :return: bytes
+    """
+    response.header.version = version
+    return bytes(response.pack().ljust(packet_size, b'\0'))
+
+
+class BufferPool:
+    """
+    packet sized buffers responses are packed into (see the pack_into methods above)
+    a buffer is taken for one response and given back once it was sent, so answering a request
+    doesn't allocate a new packet (and its padding) every time
+    """
+    def __init__(self, packet_size, limit=BUFFER_POOL_LIMIT):
+        """
+        :param packet_size: size of every buffer
+        :param limit: free buffers kept, anything given back past that is left to the garbage collector
+        """
+        self.packet_size = packet_size
+        self.limit = limit
+        self.free = collections.deque()  # append / pop are atomic, no lock needed
+        self.zeros = memoryview(bytes(packet_size))
+
+    def take(self):
+        """
+        :return: bytearray of packet_size zeros
+        """
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.packet_size)
+
+    def give(self, buffer, used):
+        """
+        :param buffer: bytearray from take()
+        :param used: bytes at its start that were written. they're zeroed again so the buffer is all padding
+        """
+        if len(self.free) < self.limit:
+            buffer[:used] = self.zeros[:used]
+            self.free.append(buffer)
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import struct
+import time
+from collections import defaultdict
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+import capture
+import loadgen
+import protocol
+import server
+from loadgen import percentile
+
+"""
+Deterministic replay of a capture file (see capture.py)
+
+every recorded connection is opened again at the same offset from the start of the capture,
+and its inbound frames are sent with their original timing (divided by --speed)
+for each connection we compare the recorded response time with the one we get now, and print a report
+per request code. example:
+    MMN15_CAPTURE_FILE=prod.cap python main.py      # record
+    python replay.py prod.cap --port 8080 --speed 4
+
+the frames can't be sent as they were recorded, the replayed server gives out its own client ids and session keys:
+    - the client id in every request is swapped for the one the replayed server gave in 2100
+    - 1101 carries a public key of the replayer instead of the client's, so it can read the new session key
+    - 1103 is decrypted with the key in the capture and encrypted again with the new one
+    - the connections of a client are replayed one after the other, in their recorded order, at any --speed.
+      different clients still run side by side
+clients that registered (or got their key) before the capture started keep their requests as they are,
+so replay against a server that starts from a copy of the database taken when the capture started.
+the report counts what still differs: responses with a different code, and responses whose payload
+differs where it doesn't change from one run to the next (see DETERMINISTIC_RESPONSES)
+"""
+
+CODE_OFFSET = protocol.CLIENT_ID_SIZE + 1  # the request code comes right after the client id and version
+PUBLIC_KEY_OFFSET = protocol.REQUEST_HEADER_SIZE + protocol.NAME_SIZE  # in 1101
+# responses that are the same every time for the same request and server state. the others carry a new
+# client id (2100), a session key (2102, 2105) or a random IV (2108)
+DETERMINISTIC_RESPONSES = {
+    protocol.ResponseCodes.RESPONSE_FAILED_REGISTRATION.value,
+    protocol.ResponseCodes.RESPONSE_FILE.value,
+    protocol.ResponseCodes.RESPONSE_RECEIVED.value,
+    protocol.ResponseCodes.RESPONSE_FAILED_LOGIN.value,
+    protocol.ResponseCodes.RESPONSE_ERROR.value,
+}
+
+
+def parse_response(data):
+    """
+    :param data: (bytes) everything the server sent on a connection (padded to whole packets)
+    :return: tuple - (response code, payload). code is None if there's no whole header
+    """
+    if len(data) < protocol.HEADER_SIZE:
+        return None, b''
+    _, code, payload_size = struct.unpack("<BHL", data[:protocol.HEADER_SIZE])
+    return code, bytes(data[protocol.HEADER_SIZE:protocol.HEADER_SIZE + payload_size])
+
+
+def reencrypt_upload(request_data, recorded_key, client_id, session_key):
+    """
+    :param request_data: (bytes) a whole recorded 1103 request
+    :param recorded_key: session key the recorded request was encrypted with
+    :param client_id: client id to send it as
+    :param session_key: session key to encrypt it with
+    :return: (bytes) the same request, framed the same way, for client_id and session_key
+    """
+    request = protocol.FileSendRequest()
+    if not request.unpack(request_data[:loadgen.PACKET_SIZE]):
+        raise ValueError("bad 1103 request")
+    stream = request.header.version >= protocol.STREAM_VERSION
+    if stream:
+        request.cipher = server.stream_cipher(recorded_key)
+    request.feed(request_data[loadgen.PACKET_SIZE:loadgen.PACKET_SIZE + max(0, request.remaining)])
+    content = bytes(server.unpad_stream(request.content)) if stream else \
+        server.decrypt_content(recorded_key, request.content)
+
+    client = loadgen.ProtocolClient(None, None, "", None, request.header.version, algorithm=request.algorithm,
+                                    chunk_size=request.chunk_size)
+    client.client_id = client_id
+    client.session_key = session_key
+    first_packet, chunks = client.file_packets(request.file_name, content)
+    if stream:
+        return first_packet.ljust(loadgen.PACKET_SIZE, b'\0') + b"".join(chunks)
+    return b"".join(packet.ljust(loadgen.PACKET_SIZE, b'\0') for packet in (first_packet, *chunks))
+
+
+class RecordedConnection:
+    def __init__(self, conn_id):
+        self.conn_id = conn_id
+        self.inbound = []  # (time in ns, data)
+        self.outbound = []
+        self.closed = None
+        self.session_key = None  # (client id, key) the server gave out on this connection
+
+    @property
+    def start(self):
+        return self.inbound[0][0]
+
+    @property
+    def request(self):
+        """
+        :return: (bytes) everything the client sent
+        """
+        return b''.join(data for _, data in self.inbound)
+
+    @property
+    def code(self):
+        request = self.request
+        if len(request) < CODE_OFFSET + 2:
+            return None
+        return struct.unpack("<H", request[CODE_OFFSET:CODE_OFFSET + 2])[0]
+
+    @property
+    def client_id(self):
+        """
+        :return: (bytes) the client the connection belongs to, the new one for a registration.
+        None for a registration that failed
+        """
+        if self.code == protocol.RequestCodes.REQUEST_REGISTRATION.value:
+            code, payload = self.response
+            if code != protocol.ResponseCodes.RESPONSE_REGISTRATION.value:
+                return None
+            return payload[:protocol.CLIENT_ID_SIZE]
+        return self.request[:protocol.CLIENT_ID_SIZE]
+
+    @property
+    def recorded_latency(self):
+        """
+        :return: seconds from the last inbound frame to the end of the response
+        """
+        end = self.outbound[-1][0] if self.outbound else self.closed
+        if end is None:
+            return None
+        return max(0, end - self.inbound[-1][0]) / 1e9
+
+    @property
+    def response(self):
+        """
+        :return: tuple - (response code, payload) the server sent when it was recorded
+        """
+        return parse_response(b''.join(data for _, data in self.outbound))
+
+
+def load_connections(path):
+    """
+    :param path: capture file
+    :return: list of RecordedConnection (only those with inbound data), ordered by start time
+    """
+    connections = {}
+    for conn_id, direction, timestamp, data in capture.read_capture(path):
+        conn = connections.setdefault(conn_id, RecordedConnection(conn_id))
+        if direction == capture.INBOUND:
+            conn.inbound.append((timestamp, data))
+        elif direction == capture.OUTBOUND:
+            conn.outbound.append((timestamp, data))
+        elif direction == capture.SESSION_KEY:
+            conn.session_key = (data[:protocol.CLIENT_ID_SIZE], data[protocol.CLIENT_ID_SIZE:])
+        else:
+            conn.closed = timestamp
+    return sorted((conn for conn in connections.values() if conn.inbound), key=lambda conn: conn.start)
+
+
+class Replayer:
+    def __init__(self, connections, host, port, speed=1.0):
+        """
+        :param connections: list of RecordedConnection
+        :param speed: time scale. 1 is the original timing, 2 twice as fast, 0 sends everything right away
+        (a client's connections still wait for each other)
+        """
+        self.connections = connections
+        self.host = host
+        self.port = port
+        self.speed = speed
+        # (code, recorded latency, replayed latency, recorded response code, replayed response code, payload differs?)
+        self.results = []
+        self.failed = 0
+        self.rsa_key = RSA.generate(loadgen.RSA_BITS, e=loadgen.RSA_EXPONENT)  # the new session keys come with it
+        self.client_ids = {}  # recorded client id -> the one the replayed server gave
+        self.recorded_keys = {}  # recorded client id -> its session key in the capture
+        self.session_keys = {}  # recorded client id -> the session key the replayed server gave
+        self.sent_as_recorded = 0  # uploads of clients whose keys aren't known, sent without re-encrypting
+
+    async def wait_until(self, origin, offset_ns):
+        if self.speed <= 0:
+            return
+        delay = origin + offset_ns / 1e9 / self.speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def rewrite(self, conn):
+        """
+        :param conn: RecordedConnection
+        :return: list of (time in ns, data) - its inbound frames, for the client id and keys of the replayed server
+        """
+        request = conn.request
+        recorded_id = request[:protocol.CLIENT_ID_SIZE]
+        client_id = self.client_ids.get(recorded_id, recorded_id)
+        if conn.code == protocol.RequestCodes.REQUEST_SEND_FILE.value:
+            try:
+                request = reencrypt_upload(request, self.recorded_keys[recorded_id], client_id,
+                                           self.session_keys[recorded_id])
+            except (KeyError, ValueError):
+                # no keys for this client in the capture, or an upload the server couldn't have decrypted either
+                self.sent_as_recorded += 1
+        elif conn.code == protocol.RequestCodes.REQUEST_PUBLIC_KEY.value:
+            public_key = loadgen.fixed_str(self.rsa_key.publickey().export_key("DER"), protocol.PUBLIC_KEY_SIZE)
+            request = request[:PUBLIC_KEY_OFFSET] + public_key + request[PUBLIC_KEY_OFFSET + protocol.PUBLIC_KEY_SIZE:]
+        request = client_id + request[protocol.CLIENT_ID_SIZE:]
+
+        # the same cuts as the recorded frames (the request is as long as it was), anything past them with the last
+        frames = []
+        offset = 0
+        for i, (timestamp, data) in enumerate(conn.inbound):
+            end = offset + len(data) if i < len(conn.inbound) - 1 else len(request)
+            frames.append((timestamp, request[offset:end]))
+            offset = end
+        return frames
+
+    def learn(self, conn, replayed_code, replayed_payload):
+        """
+        keep the client id and session key the replayed server gave out in response to conn
+        """
+        if replayed_code == protocol.ResponseCodes.RESPONSE_REGISTRATION.value and conn.client_id is not None:
+            self.client_ids[conn.client_id] = replayed_payload[:protocol.CLIENT_ID_SIZE]
+        elif replayed_code in (protocol.ResponseCodes.RESPONSE_PUBLIC_KEY.value,
+                               protocol.ResponseCodes.RESPONSE_LOGIN.value) and conn.session_key is not None:
+            recorded_id, recorded_key = conn.session_key
+            try:
+                session_key = PKCS1_OAEP.new(self.rsa_key).decrypt(replayed_payload[protocol.CLIENT_ID_SIZE:])
+            except ValueError:
+                # a login encrypted for the client's own public key, given before the capture started
+                return
+            self.recorded_keys[recorded_id] = recorded_key
+            self.session_keys[recorded_id] = session_key
+
+    async def replay_client(self, connections, origin, capture_start):
+        """
+        replay the connections of one client, every one after the previous one is done
+        """
+        for conn in connections:
+            await self.replay(conn, origin, capture_start)
+
+    async def replay(self, conn, origin, capture_start):
+        await self.wait_until(origin, conn.start - capture_start)
+        writer = None
+        try:
+            frames = self.rewrite(conn)
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            for timestamp, data in frames:
+                await self.wait_until(origin, timestamp - capture_start)
+                writer.write(data)
+                await writer.drain()
+            last_sent = time.perf_counter()
+            response = await reader.read()
+            latency = time.perf_counter() - last_sent
+        except OSError:
+            self.failed += 1
+            return
+        finally:
+            if writer is not None:
+                writer.close()
+        recorded_code, recorded_payload = conn.response
+        replayed_code, replayed_payload = parse_response(response)
+        self.learn(conn, replayed_code, replayed_payload)
+        # the payloads that carry a client id carry the new one, compare them as if it was the recorded one
+        recorded_id = conn.client_id
+        if recorded_id is not None and replayed_payload[:protocol.CLIENT_ID_SIZE] == self.client_ids.get(recorded_id):
+            replayed_payload = recorded_id + replayed_payload[protocol.CLIENT_ID_SIZE:]
+        payload_differs = (recorded_code == replayed_code and recorded_code in DETERMINISTIC_RESPONSES and
+                           recorded_payload != replayed_payload)
+        self.results.append((conn.code, conn.recorded_latency, latency, recorded_code, replayed_code,
+                             payload_differs))
+
+    async def run(self):
+        if not self.connections:
+            return 0.0
+        capture_start = self.connections[0].start
+        # the connections are in start order, so every client's list is too. a failed registration is on its own
+        clients = defaultdict(list)
+        for conn in self.connections:
+            client_id = conn.client_id
+            clients[client_id if client_id is not None else conn.conn_id].append(conn)
+        origin = time.perf_counter()
+        await asyncio.gather(*(self.replay_client(connections, origin, capture_start)
+                               for connections in clients.values()))
+        return time.perf_counter() - origin
+
+    def report(self, elapsed):
+        by_code = defaultdict(list)
+        for result in self.results:
+            by_code[result[0]].append(result)
+
+        codes = {}
+        for code, results in sorted(by_code.items(), key=lambda item: str(item[0])):
+            recorded = sorted(result[1] for result in results if result[1] is not None)
+            replayed = sorted(result[2] for result in results)
+            codes[str(code)] = {
+                "count": len(results),
+                "recorded_p50_ms": percentile(recorded, 50) * 1000,
+                "recorded_p99_ms": percentile(recorded, 99) * 1000,
+                "replayed_p50_ms": percentile(replayed, 50) * 1000,
+                "replayed_p99_ms": percentile(replayed, 99) * 1000,
+                # either usually means the server state doesn't match the capture
+                "code_mismatches": sum(1 for result in results if result[3] != result[4]),
+                "payload_mismatches": sum(1 for result in results if result[5]),
+            }
+            row = codes[str(code)]
+            row["delta_p50_ms"] = row["replayed_p50_ms"] - row["recorded_p50_ms"]
+            row["delta_p99_ms"] = row["replayed_p99_ms"] - row["recorded_p99_ms"]
+        return {"elapsed_s": elapsed, "connections": len(self.results), "failed": self.failed,
+                "sent_as_recorded": self.sent_as_recorded, "codes": codes}
+
+
+def print_report(report):
+    print(f"replayed {report['connections']} connections in {report['elapsed_s']:.2f}s, "
+          f"{report['failed']} failed to connect")
+    if report["sent_as_recorded"]:
+        print(f"{report['sent_as_recorded']} uploads sent as they were recorded, "
+              f"their clients got their session key before the capture started")
+    print(f"{'code':>6} {'count':>7} {'rec p50':>9} {'now p50':>9} {'delta':>9} "
+          f"{'rec p99':>9} {'now p99':>9} {'delta':>9} {'code !=':>8} {'data !=':>8}")
+    for code, row in report["codes"].items():
+        print(f"{code:>6} {row['count']:>7} {row['recorded_p50_ms']:>9.2f} {row['replayed_p50_ms']:>9.2f} "
+              f"{row['delta_p50_ms']:>+9.2f} {row['recorded_p99_ms']:>9.2f} {row['replayed_p99_ms']:>9.2f} "
+              f"{row['delta_p99_ms']:>+9.2f} {row['code_mismatches']:>8} {row['payload_mismatches']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="replay a traffic capture against a local mmn15 server")
+    parser.add_argument("capture", help="capture file written by the server (MMN15_CAPTURE_FILE)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 keeps the original timing, 2 is twice as fast, 0 sends everything at once "
+                             "(every client's requests still go one after the other)")
+    parser.add_argument("--limit", type=int, default=None, help="only replay the first N connections")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    connections = load_connections(args.capture)
+    if args.limit is not None:
+        connections = connections[:args.limit]
+
+    replayer = Replayer(connections, args.host, args.port, args.speed)
+    report = replayer.report(asyncio.run(replayer.run()))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
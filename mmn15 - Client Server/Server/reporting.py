@@ -0,0 +1,230 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+Reporting off a snapshot of the server database
+
+reports (unverified files, users that haven't been seen for a while, files per user...) shouldn't run against
+server.db itself, a long query there holds a read lock the server's writes have to wait behind
+instead the server keeps a copy, the snapshot, and refreshes it every snapshot_interval seconds:
+    - on a thread of its own, never on the selector loop
+    - with SQLite's online backup, snapshot_pages pages at a time. the lock on server.db is let go between
+      steps, so the server's writes go in between them. but a write restarts the backup, and on a busy server
+      it may never get to the end. after MAX_RESTARTS it starts over and copies everything in one step,
+      the writes wait for that one instead (the read lock is held for as long as copying the file takes)
+    - into a temporary file that replaces the snapshot once it's complete, so a report never sees half a copy
+the session keys are cleared from the copy, the snapshot is for reporting and may be read by anyone running one
+
+Reports opens the snapshot read only, with a connection of its own for every report. example:
+    python reporting.py unverified
+    python reporting.py stale --days 30
+    python reporting.py files --json
+"""
+
+DEFAULT_INTERVAL = 300.0  # seconds
+DEFAULT_PAGES = 256  # pages copied in every step of the backup
+STEP_SLEEP = 0.005  # seconds the backup waits between steps, for the server's writes to get the lock
+MAX_RESTARTS = 3  # restarts of the backup (by the server's writes) before it's copied in one step
+DEFAULT_STALE_DAYS = 30
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+class RestartLimit:
+    """
+    progress callback of the backup, it gives up (raises TooManyRestarts) once the backup restarted too many times
+    """
+    def __init__(self, restarts=MAX_RESTARTS):
+        self.restarts = restarts
+        self.remaining = None
+
+    def __call__(self, status, remaining, total):
+        # the pages left only go down, unless a write restarted the backup
+        if self.remaining is not None and remaining >= self.remaining:
+            self.restarts -= 1
+            if self.restarts < 0:
+                raise TooManyRestarts()
+        self.remaining = remaining
+
+
+class SnapshotWriter:
+    def __init__(self, database, snapshot, interval=DEFAULT_INTERVAL, pages=DEFAULT_PAGES):
+        """
+        :param database: path of the server database
+        :param snapshot: path of the snapshot to keep
+        :param interval: seconds between refreshes
+        :param pages: pages copied in every step of the backup
+        """
+        self.database = database
+        self.snapshot = snapshot
+        self.interval = interval
+        self.pages = pages
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="snapshot", daemon=True)
+        self.thread.start()
+        logger.info("Refreshing the reporting snapshot %s every %.0fs", self.snapshot, self.interval)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        # the first snapshot right away, so reports work soon after the server starts
+        while not self.stopping.is_set():
+            try:
+                self.refresh()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("Failed to refresh the reporting snapshot - %s", e)
+            self.stopping.wait(self.interval)
+
+    def refresh(self):
+        """
+        take a new snapshot and put it in place of the old one
+        """
+        start = time.perf_counter()
+        temporary = self.snapshot + ".tmp"
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+        source = sqlite3.connect(self.database)
+        target = sqlite3.connect(temporary)
+        try:
+            try:
+                source.backup(target, pages=self.pages, progress=RestartLimit(), sleep=STEP_SLEEP)
+            except TooManyRestarts:
+                logger.info("The server's writes keep restarting the snapshot, copying it in one step")
+                metrics.SNAPSHOT_FALLBACKS.inc()
+                source.backup(target)
+            # overwrite the keys in place, not only unlink them from the table
+            target.execute("PRAGMA secure_delete = ON")
+            target.execute("UPDATE clients SET AESKey = NULL")
+            target.commit()
+        finally:
+            target.close()
+            source.close()
+
+        os.replace(temporary, self.snapshot)
+        metrics.SNAPSHOT_SECONDS.observe(time.perf_counter() - start)
+
+
+class Reports:
+    """
+    read only queries on the snapshot. every call opens (and closes) its own connection,
+    so a report always reads the latest complete snapshot
+    """
+    def __init__(self, snapshot):
+        """
+        :param snapshot: path of the snapshot the server keeps (the snapshot_file setting)
+        """
+        self.snapshot = snapshot
+
+    def query(self, query, args=()):
+        """
+        :param query: SQL statement, anything that writes fails
+        :param args: arguments of the statement
+        :return: tuple - (column names, list of rows)
+        """
+        if not os.path.exists(self.snapshot):
+            raise FileNotFoundError(f"no snapshot at {self.snapshot}, is snapshot_file set for the server?")
+        conn = sqlite3.connect(f"file:{self.snapshot}?mode=ro", uri=True)
+        try:
+            conn.execute("PRAGMA query_only = ON")
+            cur = conn.execute(query, args)
+            return [column[0] for column in cur.description], cur.fetchall()
+        finally:
+            conn.close()
+
+    def unverified_files(self):
+        """
+        files whose CRC was never confirmed by the client
+        """
+        return self.query("SELECT files.ID, clients.Name, files.FileName, files.Size FROM files "
+                          "LEFT JOIN clients ON clients.ID = files.ID WHERE files.Verified = 0 "
+                          "ORDER BY files.ID, files.FileName")
+
+    def stale_users(self, days=DEFAULT_STALE_DAYS):
+        """
+        users that haven't been seen for days
+        """
+        cutoff = str(datetime.now() - timedelta(days=days))
+        return self.query("SELECT ID, Name, LastSeen FROM clients WHERE LastSeen IS NULL OR LastSeen < ? "
+                          "ORDER BY LastSeen", [cutoff])
+
+    def files_per_user(self):
+        """
+        files (verified and all), bytes and quotas of every user
+        """
+        return self.query("SELECT clients.ID, clients.Name, COUNT(files.FileName) AS Files, "
+                          "COALESCE(SUM(files.Verified), 0) AS Verified, COALESCE(SUM(files.Size), 0) AS Bytes, "
+                          "usage.QuotaBytes, usage.QuotaFiles FROM clients "
+                          "LEFT JOIN files ON files.ID = clients.ID LEFT JOIN usage ON usage.ID = clients.ID "
+                          "GROUP BY clients.ID ORDER BY Bytes DESC")
+
+
+def printable(value):
+    """
+    :return: value the way a report shows it, ids (stored as bytes) in hex
+    """
+    return value.hex() if isinstance(value, bytes) else value
+
+
+def print_table(columns, rows):
+    rows = [["" if value is None else str(printable(value)) for value in row] for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="reports on the mmn15 server, read from its snapshot")
+    parser.add_argument("--snapshot", default=None, help="snapshot file (the server's snapshot_file by default)")
+    parser.add_argument("--json", action="store_true", help="print the rows as JSON")
+    reports = parser.add_subparsers(dest="report", required=True)
+    reports.add_parser("unverified", help="files whose CRC was never confirmed")
+    stale = reports.add_parser("stale", help="users that haven't been seen for a while")
+    stale.add_argument("--days", type=float, default=DEFAULT_STALE_DAYS)
+    reports.add_parser("files", help="files and bytes of every user")
+    args = parser.parse_args(argv)
+
+    snapshot = args.snapshot if args.snapshot is not None else config.load_config().snapshot_file
+    if not snapshot:
+        parser.error("the server has no snapshot_file set, give one with --snapshot")
+
+    report = Reports(snapshot)
+    if args.report == "unverified":
+        columns, rows = report.unverified_files()
+    elif args.report == "stale":
+        columns, rows = report.stale_users(args.days)
+    else:
+        columns, rows = report.files_per_user()
+
+    if args.json:
+        json.dump([{column: printable(value) for column, value in zip(columns, row)} for row in rows], sys.stdout,
+                  indent=2, default=str)
+        print()
+    else:
+        print_table(columns, rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
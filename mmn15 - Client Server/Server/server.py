@@ -1,17 +1,158 @@
+import logging
 import os.path
+import queue
+import signal
+import stat
+import struct
 from pathlib import Path
 from datetime import datetime
 import socket
 import selectors
+import sqlite3
+import time
+from functools import partial
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
-from Crypto.Util.Padding import unpad
+from Crypto.Util.Padding import pad, unpad
 from base64 import b64decode, b64encode
-from checksum import checksum
+import capture
+import config
 import database
+import integrity
+import logs
+import metrics
+import profiling
 import protocol
+import reporting
+import storage
+import tracing
+import transport
+
+logger = logging.getLogger(__name__)
+request_log = logs.request_logger(__name__)  # rate limited, for lines written on every request
+
+
+def decrypt_content(session_key, content):
+    """
+    decrypt the content of a 1103 request
+    every chunk is encrypted (and padded) on its own by the client, using a zeroed IV
+    :param session_key: AES session key of the user
+    :param content: list of encrypted chunks
+    :return: (bytes) the decrypted file
+    """
+    iv = AES.block_size * b'\0'
+    dec_bytes = b''
+    for chunk in content:
+        base64_chunk = b64encode(chunk)
+        cipher = AES.new(session_key, AES.MODE_CBC, iv)
+        dec_bytes += unpad(cipher.decrypt(b64decode(base64_chunk)), AES.block_size)
+    return dec_bytes
+
+
+def stream_cipher(session_key):
+    """
+    :param session_key: AES session key of the user
+    :return: cipher that decrypts the content of a 1103 request of protocol version STREAM_VERSION and up,
+    one CBC stream with a zeroed IV (see FileSendRequest.feed)
+    """
+    return AES.new(session_key, AES.MODE_CBC, AES.block_size * b'\0')
+
+
+def unpad_stream(content):
+    """
+    strip the padding off the end of a decrypted stream, in place (it's the whole file, so no copy of it)
+    :param content: bytearray - the decrypted stream, padded once at its end
+    :return: content
+    """
+    padding = content[-1] if content else 0
+    if not 1 <= padding <= AES.block_size or content[-padding:] != bytes([padding]) * padding:
+        raise ValueError("Padding is incorrect.")
+    del content[-padding:]
+    return content
+
+
+class EncryptedFileStream:
+    """
+    sends a response followed by a file encrypted with AES-CBC, a piece at a time
+    only a piece or two of the file are in memory at any moment, and sending never blocks the selector loop:
+    the file is read by read_ahead (on the I/O pool), the next piece while the current one is sent
+    the data ends with zeros up to a full packet, just like responses sent with Server.write
+    """
+    def __init__(self, file, cipher, header, read_size, packet_size, read_ahead):
+        """
+        :param file: file object opened for binary reading
+        :param cipher: AES cipher object (CBC mode) used for the whole file
+        :param header: (bytes) the packed response, sent before the file content
+        :param read_size: bytes to read from the file at a time (a multiple of the AES block size)
+        :param packet_size: the stream is padded to a multiple of this
+        :param read_ahead: function(file, size) that starts reading from the file, returns a Future of the bytes
+        """
+        self.file = file
+        self.cipher = cipher
+        self.read_size = read_size
+        self.packet_size = packet_size
+        self.read_ahead = read_ahead
+        self.pending = memoryview(header)
+        self.sent = 0
+        self.eof = False
+        # the first piece is read while the header is sent
+        self.reading = read_ahead(file, read_size)
+
+    def refill(self):
+        """
+        :return: True if there's something to send, False once everything was sent,
+                 None while the next piece is still being read
+        """
+        if self.eof:
+            return False
+        if not self.reading.done():
+            return None
+        chunk = self.reading.result()
+        if len(chunk) < self.read_size:
+            # last piece, pad the cipher text and then the packet
+            self.eof = True
+            self.reading = None
+            data = self.cipher.encrypt(pad(chunk, AES.block_size))
+            data += bytes(-(self.sent + len(data)) % self.packet_size)
+        else:
+            self.reading = self.read_ahead(self.file, self.read_size)
+            data = self.cipher.encrypt(chunk)
+        self.pending = memoryview(data)
+        return True
+
+    def send(self, conn: transport.Transport, budget=None):
+        """
+        send as much as the socket takes right now
+        :param budget: most bytes to send in this call (None for no limit)
+        :return: True once the whole stream is sent, False if there's more to send,
+                 None if the next piece is still being read (wait for reading to be done)
+        """
+        while True:
+            if not self.pending:
+                more = self.refill()
+                if not more:
+                    return True if more is False else None
+            if budget is not None and budget <= 0:
+                return False
+            try:
+                sent = conn.send(self.pending if budget is None else self.pending[:budget])
+            except BlockingIOError:
+                return False
+            self.sent += sent
+            metrics.BYTES_SENT.inc(sent)
+            self.pending = self.pending[sent:]
+            if budget is not None:
+                budget -= sent
+
+    def close(self):
+        # a piece may still be on its way from the disk, the file is closed once it's read
+        if self.reading is not None:
+            self.reading.add_done_callback(lambda done: self.file.close())
+        else:
+            self.file.close()
 
 
 class Server:
@@ -25,23 +166,65 @@ class Server:
     @author yonatan tzukerman
     @date 23/03/2023
     """
-    DATABASE = "server.db"
-    PACKET_SIZE = 1024
+    PACKET_SIZE = config.ServerConfig.packet_size  # what the clients use, a server may be configured otherwise
     BLOCK_FLAG = False
+    DETACHED = object()  # returned by handlers that keep the connection open after they return
+    # scheduling classes. every loop turn runs the ready control connections before the bulk ones
+    CONTROL = "control"  # accepting, first packets of requests, internal wake ups
+    BULK = "bulk"  # the content of 1103 uploads and files streamed back by 1107
 
-    def __init__(self, port, host=''):
+    def __init__(self, settings=None, file_storage=None, selector=None):
         """
         set up server parameters
-        :param host: hosting ip
-        :param port: port number for server to be hosted on
+        :param settings: config.ServerConfig (None for the defaults)
+        :param file_storage: storage.Storage used for all disk access (None for the default one)
+        :param selector: selector the loop runs on (None for the default one, see transport.py for the loopback one)
         """
-        self.host = host
-        self.port = port
+        self.settings = settings if settings is not None else config.ServerConfig()
+        self.host = self.settings.host
+        self.port = self.settings.port
+        self.packet_size = self.settings.packet_size
+        # responses that never change are packed and padded once (for every version a client can be answered with),
+        # the rest are packed into pooled packets
+        self.error_frames = [protocol.frame(protocol.ErrorResponse(), self.packet_size, version)  # 2107
+                             for version in range(protocol.SERVER_VERSION + 1)]
+        self.registration_failed_frames = [protocol.frame(protocol.RegistrationFailedResponse(),  # 2101
+                                                          self.packet_size, version)
+                                           for version in range(protocol.SERVER_VERSION + 1)]
+        self.buffers = protocol.BufferPool(self.packet_size, self.settings.response_buffers)
+        self.metrics_server = metrics.MetricsServer(self.settings.metrics_port) if self.settings.metrics_port else None
+        self.recorder = capture.Recorder(self.settings.capture_file) if self.settings.capture_file else None
+        self.profiler = profiling.Profiler(self.settings.profile_dir, self.settings.profile_sample_rate)
+        self.tracer = tracing.Tracer(self.settings.trace_file, self.settings.trace_sample_rate,
+                                     self.settings.trace_max_bytes, self.settings.trace_backups)
+        self.snapshots = None
+        if self.settings.snapshot_file:
+            self.snapshots = reporting.SnapshotWriter(self.settings.database, self.settings.snapshot_file,
+                                                      self.settings.snapshot_interval, self.settings.snapshot_pages)
+        self.traces = {}  # connection -> root span of the traced request it's handling
+        # connection -> (request code, perf_counter() it was dispatched at, profiled?) of the request it's handling,
+        # until it's closed. the latency is observed then, so it covers work done after the handler returned
+        self.requests = {}
+        self.versions = {}  # connection -> version its responses carry (see protocol.negotiated_version), until closed
         self.users = []  # stores UUID of all users
-        self.sel = selectors.DefaultSelector()
+        self.sel = selector if selector is not None else selectors.DefaultSelector()
+        self.listeners = []  # listening sockets, see listen()
+        self.stopping = False  # set by stop(), the loop ends at its next turn
+        self.bulk_connections = set()  # connections in the middle of a transfer, scheduled as BULK
+
+        # disk work runs on a small thread pool. when a job is done, its completion is put on a queue
+        # and the selector loop is woken up (through a socket pair) to run it
+        if file_storage is None:
+            file_storage = storage.Storage(self.settings.checksum_workers, self.settings.parallel_checksum_size)
+        self.storage = file_storage
+        self.io_pool = ThreadPoolExecutor(max_workers=self.settings.io_workers, thread_name_prefix="io")
+        self.completions = queue.SimpleQueue()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
 
         # connect to the database and restore any previous data
-        self.backup_db = database.Database(Server.DATABASE)
+        self.backup_db = database.Database(self.settings.database)
         self.load_backup_data()
 
         # keeps track of all files pending crc approval
@@ -55,7 +238,8 @@ class Server:
             protocol.RequestCodes.REQUEST_SEND_FILE.value: self.file_request,
             protocol.RequestCodes.REQUEST_VALID_CRC.value: self.valid_crc,
             protocol.RequestCodes.REQUEST_WARNING_CRC.value: self.wrong_crc,
-            protocol.RequestCodes.REQUEST_ERROR_CRC.value: self.failed_crc
+            protocol.RequestCodes.REQUEST_ERROR_CRC.value: self.failed_crc,
+            protocol.RequestCodes.REQUEST_GET_FILE.value: self.get_file
         }
 
     def load_backup_data(self):
@@ -65,86 +249,342 @@ class Server:
         data = self.backup_db.fetch_data("clients", "ID, Name")
         self.users = data
 
-        print("Printing user list:")
+        logger.info("Loaded %d users from the database", len(self.users))
         for user in self.users:
-            print(f"User name - {user[1]}, \nID - {user[0]}\n")
+            logger.debug("User name - %s, ID - %s", user[1], user[0])
 
     def start(self):
         """
         Start up the server
-        contains an infinite loop for listening to connections
+        runs the loop listening to connections until stop() is called (on SIGTERM too)
         """
         try:
-            # just some socket code to setup the server
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.bind((self.host, self.port))
-            sock.listen()
-            sock.setblocking(Server.BLOCK_FLAG)
-            # register the accept connection function for the selector
-            self.sel.register(sock, selectors.EVENT_READ, self.accept_connection)
+            self.listen(socket.AF_INET, (self.host, self.port))
+            if self.settings.unix_socket:
+                if hasattr(socket, "AF_UNIX"):
+                    # clients on this machine can skip the TCP stack. same loop, same handlers
+                    self.listen(socket.AF_UNIX, self.settings.unix_socket)
+                else:
+                    logger.warning("Unix sockets aren't supported here, ignoring %s", self.settings.unix_socket)
+            self.sel.register(self.wake_reader, selectors.EVENT_READ, self.run_completions)
+            if self.snapshots is not None:
+                self.snapshots.start()
+            self.profiler.install_signals()
+            try:
+                # a service manager stops us with SIGTERM, finish the turn and clean up (see close)
+                signal.signal(signal.SIGTERM, self.stop)
+            except ValueError:
+                # not the main thread
+                pass
         except Exception as e:
-            print(f"Error while setting up server: {e}")
+            logger.error("Error while setting up server: %s", e)
             return
 
-        print(f"Server up and listening in {self.port}!")
+        # the scrape endpoint is optional, a taken port shouldn't keep the server down
+        if self.metrics_server is not None:
+            try:
+                self.metrics_server.start()
+            except OSError as e:
+                logger.warning("Could not serve metrics on port %s, running without them - %s",
+                               self.metrics_server.port, e)
+                self.metrics_server = None
+
+        logger.info("Server up and listening in %s!", self.port)
+        if self.settings.unix_socket and hasattr(socket, "AF_UNIX"):
+            logger.info("Also listening on %s", self.settings.unix_socket)
 
         # the main loop
-        while True:
+        while not self.stopping:
             try:
-                events = self.sel.select()
-                for key, mask in events:
-                    try:
-                        callback = key.data
-                        callback(key.fileobj)
-                    except:
-                        self.sel.unregister(key.fileobj)
+                events = self.sel.select(self.settings.select_timeout)
+                woke_up = time.perf_counter()
+                self.run_events(events, woke_up)
+                # how long a socket that became ready meanwhile had to wait for us to poll again
+                metrics.LOOP_LAG.observe(time.perf_counter() - woke_up)
+                self.profiler.poll()
             except Exception as e:
-                print(f"Error while listening: {e}")
+                logger.error("Error while listening: %s", e)
+        logger.info("Server stopped")
+
+    def stop(self, signum=None, frame=None):
+        """
+        end the main loop after the turn it's in, safe to call from a signal handler or any thread
+        """
+        self.stopping = True
+        try:
+            self.wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        """
+        stop listening, and remove the unix socket file so the next run (or a client) doesn't find it stale
+        """
+        for sock in self.listeners:
+            try:
+                self.sel.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            if sock.family != socket.AF_INET:
+                path = sock.getsockname()
+                if path and os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                    os.remove(path)
+            sock.close()
+        self.listeners = []
+
+    def listen(self, family, address):
+        """
+        create a listening socket and register it with the selector
+        :param family: socket.AF_INET or socket.AF_UNIX
+        :param address: (host, port) tuple, or a path for AF_UNIX
+        :return: the socket
+        """
+        # just some socket code to setup the server
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET and self.settings.reuse_address:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family != socket.AF_INET and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            # left behind by a previous run, bind() fails while it's there
+            os.remove(address)
+        # buffer sizes set on the listening socket are inherited by the accepted ones,
+        # and the receive buffer has to be set before listen() for the window scale to match it
+        if self.settings.recv_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.settings.recv_buffer)
+        if self.settings.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.settings.send_buffer)
+        sock.bind(address)
+        sock.listen(self.settings.backlog)
+        sock.setblocking(Server.BLOCK_FLAG)
+        # register the accept connection function for the selector
+        self.sel.register(sock, selectors.EVENT_READ, self.accept_connection)
+        self.listeners.append(sock)
+        return sock
+
+    def run_events(self, events, woke_up):
+        """
+        run the callbacks of one select() call, control connections first
+        bulk callbacks move at most bulk_turn_bytes each, whatever is left waits for the next turn
+        so a login that shows up in the middle of a large upload waits for one turn, not the whole upload
+        :param events: what select() returned
+        :param woke_up: perf_counter() time select() returned at
+        """
+        control = []
+        bulk = []
+        for key, mask in events:
+            (bulk if key.fileobj in self.bulk_connections else control).append(key)
+
+        for cls, keys in ((Server.CONTROL, control), (Server.BULK, bulk)):
+            for key in keys:
+                # an earlier callback may have closed this connection already (or changed what it waits for)
+                if self.sel.get_map().get(key.fd) is not key:
+                    continue
+                metrics.QUEUE_DELAY.observe(time.perf_counter() - woke_up, cls)
+                try:
+                    # a request continuing on a later turn (the rest of an upload...) is still part of
+                    # its trace, and of its profile
+                    callback = self.profiled(key.fileobj, key.data)
+                    with tracing.activate(self.traces.get(key.fileobj)):
+                        callback(key.fileobj)
+                except:
+                    self.sel.unregister(key.fileobj)
 
     def accept_connection(self, sock):
         """
         This function is called whenever there's a new connection
         :param sock: the socket setup in start
         """
-        # accept the connection, log it and send to read()
-        conn, addr = sock.accept()
-        conn.setblocking(Server.BLOCK_FLAG)
-        print(f"connection from {addr}")
-        self.sel.register(conn, selectors.EVENT_READ, self.read)
+        # accept whatever is waiting (up to accept_batch), log it and send to read()
+        for _ in range(self.settings.accept_batch):
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(Server.BLOCK_FLAG)
+            if self.settings.tcp_nodelay and conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            request_log.info("connection from %s", addr or sock.getsockname())
+            self.add_connection(conn)
+
+    def add_connection(self, conn: transport.Transport):
+        """
+        start reading requests from a new connection
+        :param conn: an accepted socket, or any other transport.Transport
+        """
+        if self.recorder is not None:
+            # everything read from and written to this connection goes into the capture file
+            conn = self.recorder.wrap(conn)
+        self.sel.register(conn, selectors.EVENT_READ, partial(self.read, bytearray()))
+        metrics.OPEN_CONNECTIONS.inc()
 
-    def read(self, conn: socket.socket):
+    def read(self, packet, conn: transport.Transport):
         """
         this is called to read the data from any connection
+        the request is handled once its whole first packet is here (clients always send full packets)
+        :param packet: (bytearray) what was read of the first packet so far
         :param conn: socket connection
         :return: communicates back to the client if needed
         """
-        data = conn.recv(Server.PACKET_SIZE)
+        try:
+            data = conn.recv(self.packet_size - len(packet))
+        except BlockingIOError:
+            return
         if data:
+            metrics.BYTES_RECEIVED.inc(len(data))
+            packet += data
+            if len(packet) < self.packet_size:
+                return
+            data = bytes(packet)
             try:
                 # read the code from the header and send to the proper handler function
                 req = protocol.RequestHeader()
                 req.unpack(data)
-                print(f"Received code: {req.code}")
+                request_log.info("Received code: %s", req.code)
                 if req.code in self.requestHandler.keys():
-                    result = self.requestHandler[req.code](conn, data)
-
-                    # try to respond with 2107 if an error happened
-                    if not result:
-                        try:
-                            response = protocol.ErrorResponse()
-                            self.write(conn, response.pack())
-                        except Exception as e:
-                            print(f"failed to deliver exception message - {e}")
+                    # the root span and the latency last until the connection is closed, see close_connection
+                    self.requests[conn] = (req.code, time.perf_counter(),
+                                           self.profiler.enabled and self.profiler.sample())
+                    self.versions[conn] = protocol.negotiated_version(req.version)
+                    span = self.tracer.start("request", code=req.code, client_id=req.client_id.hex())
+                    if span.recording:
+                        self.traces[conn] = span
+                    with tracing.activate(span):
+                        result = self.profiled(conn, self.requestHandler[req.code])(conn, data)
+
+                    metrics.REQUESTS.inc(1, str(req.code))
+
+                    # the handler took over the connection (streaming a response or waiting for disk I/O),
+                    # it closes it when it's done
+                    if result is Server.DETACHED:
+                        return
+
+                    with tracing.activate(span):
+                        self.finish(conn, result)
+                    return
+                else:
+                    metrics.REQUESTS.inc(1, metrics.UNKNOWN_LABEL)
             except Exception as e:
-                print(f"Exception while reading data from request - {e}")
+                logger.error("Exception while reading data from request - %s", e)
         else:
-            print("No data in connection")
+            request_log.info("No data in connection")
+
+        self.close_connection(conn)
+
+    def finish(self, conn: transport.Transport, result):
+        """
+        end a request. respond with 2107 if the handler failed, then close the connection
+        :param conn: socket connection
+        :param result: (bool) what the handler returned
+        """
+        span = self.traces.get(conn)
+        if span is not None:
+            span.set("ok", bool(result))
+        # try to respond with 2107 if an error happened
+        if not result:
+            try:
+                self.write(conn, self.error_frames[self.version(conn)])
+            except Exception as e:
+                logger.warning("failed to deliver exception message - %s", e)
+        self.close_connection(conn)
 
-        # closing things
-        self.sel.unregister(conn)
+    def profiled(self, conn, func):
+        """
+        :param conn: connection of the request func is a piece of
+        :return: func, running under the profiler if the request was sampled
+        """
+        request = self.requests.get(conn)
+        if request is None or not request[2]:
+            return func
+        return partial(self.profiler.run, request[0], func)
+
+    def offload(self, conn: transport.Transport, then, func, *args):
+        """
+        run blocking (disk) work on the I/O pool and continue the request when it's done
+        the connection is taken off the selector meanwhile, and closed by finish() once then() returns
+        (unless then() returns DETACHED, it took the connection over)
+
+        :param conn: connection of the request
+        :param then: called on the selector thread with the finished future. returns the handler result
+        :param func: function to run on the pool
+        :return: DETACHED, for the handler to return
+        """
+        try:
+            self.sel.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        self.bulk_connections.discard(conn)
+        future = self.io_pool.submit(tracing.wrap(self.profiled(conn, func)), *args)
+        future.add_done_callback(lambda done: self.call_soon(partial(self.complete, conn, then, done)))
+        return Server.DETACHED
+
+    def complete(self, conn: transport.Transport, then, future):
+        with tracing.activate(self.traces.get(conn)):
+            try:
+                result = self.profiled(conn, then)(future)
+            except Exception as e:
+                logger.error("Exception while completing request - %s", e)
+                result = False
+            if result is not Server.DETACHED:
+                self.finish(conn, result)
+
+    def call_soon(self, callback):
+        """
+        run a callback on the selector thread. safe to call from any thread
+        :param callback: function without arguments
+        """
+        self.completions.put(callback)
+        try:
+            self.wake_writer.send(b'\0')
+        except BlockingIOError:
+            # the socket is full of wake ups already, the loop is bound to notice
+            pass
+
+    def run_completions(self, sock):
+        """
+        selector callback of the wake up socket, runs everything call_soon() queued
+        """
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                callback = self.completions.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Exception in completion - %s", e)
+
+    def close_connection(self, conn: transport.Transport):
+        """
+        unregister a client connection from the selector and close it
+        :param conn: socket connection
+        """
+        try:
+            self.sel.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        self.bulk_connections.discard(conn)
         conn.close()
+        metrics.OPEN_CONNECTIONS.dec()
+        span = self.traces.pop(conn, None)
+        if span is not None:
+            span.end()
+        self.versions.pop(conn, None)
+        request = self.requests.pop(conn, None)
+        if request is not None:
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - request[1], str(request[0]))
+
+    def version(self, conn: transport.Transport):
+        """
+        :param conn: connection of a request
+        :return: version to answer it with
+        """
+        return self.versions.get(conn, protocol.SERVER_VERSION)
 
-    def write(self, conn: socket.socket, data):
+    def write(self, conn: transport.Transport, data):
         """
         Write data to client
         :param conn: connection to write back to
@@ -153,27 +593,53 @@ class Server:
         """
         size = len(data)
         sent = 0
+        span = tracing.span("write", bytes=size)
 
         # in case data is somehow bigger than packet size (it shouldn't be), we send it in chunks
         while sent < size:
-            send_size = min(size - sent, Server.PACKET_SIZE)
-            send_data = data[sent:sent + send_size]
+            send_size = min(size - sent, self.packet_size)
+            # a prebuilt frame or a pooled buffer is exactly one packet, sent as is
+            send_data = data if send_size == size else data[sent:sent + send_size]
 
             # padding data with 0 until reached packet size
-            if len(send_data) < Server.PACKET_SIZE:
-                send_data += bytearray(Server.PACKET_SIZE - len(send_data))
+            if len(send_data) < self.packet_size:
+                send_data = bytes(send_data).ljust(self.packet_size, b'\0')
 
             # try writing to client
             try:
                 conn.send(send_data)
                 sent += len(send_data)
+                metrics.BYTES_SENT.inc(len(send_data))
             except:
-                print(f"Failed to respond to {conn}")
+                logger.warning("Failed to respond to %s", conn)
+                span.set("ok", False)
+                span.end()
                 return False
-        print("Response sent")
+        span.end()
+        request_log.debug("Response sent")
         return True
 
-    def registration(self, conn: socket.socket, data):
+    def respond(self, conn: transport.Transport, response):
+        """
+        pack a response into a packet from the pool and write it, the packet goes back to the pool once it's sent
+        :param conn: connection to write back to
+        :param response: one of the protocol responses with pack_into
+        :return: True if sent, False if failed
+        """
+        response.header.version = self.version(conn)
+        buffer = self.buffers.take()
+        try:
+            used = response.pack_into(buffer)
+        except struct.error:
+            # doesn't fit in a packet (a small packet_size), pack it the old way
+            self.buffers.give(buffer, self.packet_size)
+            return self.write(conn, response.pack())
+        try:
+            return self.write(conn, buffer)
+        finally:
+            self.buffers.give(buffer, used)
+
+    def registration(self, conn: transport.Transport, data):
         """
         CODE = 1100
 
@@ -189,7 +655,7 @@ class Server:
         try:
             request = protocol.RegistrationRequest()
             request.unpack(data)
-            print(f"client trying to register as {request.name}")
+            request_log.info("client trying to register as %s", request.name)
 
             # check if name already registered:
             name_used = False
@@ -200,7 +666,7 @@ class Server:
             if not name_used:
                 # username isn't taken. generate UUID and write him down
                 user_id = uuid.uuid4()
-                print(f"registration accepted. Generated UUID: {user_id.hex}")
+                logger.info("registration accepted. Generated UUID: %s", user_id.hex)
 
                 if not self.backup_db.query(f"INSERT INTO clients (ID, Name, LastSeen) VALUES (?, ?, ?)",
                                             [user_id.hex, request.name, str(datetime.now())]):
@@ -212,15 +678,14 @@ class Server:
                 response.client_id = user_id.bytes
                 response.header.payload_size = len(response.client_id)
 
-                return self.write(conn, response.pack())
+                return self.respond(conn, response)
             else:
                 # username already taken. send 2101
-                response = protocol.RegistrationFailedResponse()
-                return self.write(conn, response.pack())
+                return self.write(conn, self.registration_failed_frames[self.version(conn)])
 
         except Exception as e:
             # print and fall back on exception
-            print(f"Exception in registration: {e}")
+            logger.error("Exception in registration: %s", e)
             return False
 
     def generate_keys(self, public_key, user_id):
@@ -233,7 +698,7 @@ class Server:
         :return: tuple - (encrypted session key, session key)
         """
         try:
-            print(f"Generating session key for user {user_id}")
+            request_log.debug("Generating session key for user %s", user_id)
 
             # using Crypto (pycrypto) generate a random session key and encrypt it with public RSA key
             session_key = get_random_bytes(protocol.SYMMETRIC_KEY_SIZE)
@@ -241,13 +706,24 @@ class Server:
             rsa_cipher = PKCS1_OAEP.new(rsa_key)
             enc_session_key = rsa_cipher.encrypt(session_key)
 
-            print(f"Public key is {public_key} \nSession key is {session_key.hex()}")
+            # never log the session key itself, anyone reading the logs could decrypt the uploads
+            logger.debug("Public key is %s", public_key)
             return enc_session_key, session_key
 
         except Exception as e:
-            print(f"Exception while generating keys {e}")
+            logger.error("Exception while generating keys %s", e)
             return None
 
+    def record_session_key(self, conn, client_id, session_key):
+        """
+        put a session key in the capture (if there is one), replay needs it to re-encrypt the uploads
+        :param conn: connection the key is sent on, a capture.RecordingConnection while capturing
+        :param client_id: (bytes) the user the key is for
+        :param session_key: (bytes) the AES key
+        """
+        if self.recorder is not None:
+            conn.record_session_key(client_id, session_key)
+
     def public_key_request(self, conn, data):
         """
         CODE = 1101
@@ -286,6 +762,7 @@ class Server:
                                         f"VALUES (?, ?, ?, ?, ?)",
                                         [user_id, user_name, request.public_key, str(datetime.now()), session_key]):
                 return False
+            self.record_session_key(conn, request.header.client_id, session_key)
 
             # load data into response and send it
             response = protocol.PublicKeyResponse()  # 2102
@@ -293,11 +770,11 @@ class Server:
             response.symmetric_key = enc_session_key
             response.header.payload_size = len(response.client_id) + len(response.symmetric_key)
 
-            return self.write(conn, response.pack())
+            return self.respond(conn, response)
 
         except Exception as e:
             # print and fall back on exception
-            print(f"Exception in public key request: {e}")
+            logger.error("Exception in public key request: %s", e)
             return False
 
     def login_request(self, conn, data):
@@ -333,6 +810,7 @@ class Server:
                 if not self.backup_db.query(f"UPDATE clients SET AESKey = ?, LastSeen = ? WHERE ID = ? AND Name = ?",
                                             [session_key, str(datetime.now()), user_id, user_name]):
                     return False
+                self.record_session_key(conn, request.header.client_id, session_key)
 
                 # load data into response and send
                 response = protocol.LoginResponse()  # 2105
@@ -340,47 +818,53 @@ class Server:
                 response.symmetric_key = enc_session_key
                 response.header.payload_size = protocol.CLIENT_ID_SIZE + len(response.symmetric_key)
 
-                return self.write(conn, response.pack())
+                return self.respond(conn, response)
             else:
                 # if no data found, we send 2106
-                print(f"No data found for user {user_name}, {user_id} during login attempt. sending 2106")
+                logger.info("No data found for user %s, %s during login attempt. sending 2106", user_name, user_id)
                 response = protocol.LoginFailedResponse()  # 2106
                 response.client_id = request.header.client_id
 
-                return self.write(conn, response.pack())
+                return self.respond(conn, response)
 
         except Exception as e:
             # print and fall back on exception
-            print(f"Exception in login request: {e}")
+            logger.error("Exception in login request: %s", e)
             return False
 
-    def send_checksum(self, conn, file_path, client_id, file_name):
+    def send_checksum(self, conn, cksum, content_size, client_id, file_name, algorithm=None):
         """
-        "private" function to calculate and send the checksum
-        this is seperated just in case we ever want to calculate and send the checksum in other functions
+        "private" function to send the checksum
+        this is seperated just in case we ever want to send the checksum in other functions
+        the checksum itself is calculated on the I/O pool (see store_file)
 
         :param conn: connection to write back to
-        :param file_path: path to the file we're doing the checksum for
+        :param cksum: checksum of the file (int for cksum, digest bytes for the other algorithms)
+        :param content_size: size of the file
         :param client_id: client id that owns the file
         :param file_name: name of the actual file
+        :param algorithm: IntegrityAlgorithms value the client asked for, None for older clients
         :return: (bool) succeeded?
         """
         try:
-            # check the checksum
-            cksum, content_size = checksum(str(file_path))
-            print(f"check sum is {cksum}")
+            request_log.debug("check sum is %s", cksum)
 
             # create and pack the response
             response = protocol.CRCResponse()  # 2103
             response.client_id = client_id
             response.content_size = content_size
             response.file_name = bytearray(file_name, 'utf-8')
-            response.cksum = cksum
-
-            response.header.payload_size = protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE
-            response.header.payload_size += protocol.NAME_SIZE + protocol.CHECK_SUM_SIZE
+            response.header.payload_size = protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE
+            if algorithm is None:
+                response.cksum = cksum
+                response.header.payload_size += protocol.CHECK_SUM_SIZE
+            else:
+                response.algorithm = algorithm
+                response.digest = cksum if isinstance(cksum, bytes) else cksum.to_bytes(protocol.CHECK_SUM_SIZE,
+                                                                                         "little")
+                response.header.payload_size += protocol.ALGORITHM_SIZE + len(response.digest)
 
-            return self.write(conn, response.pack())
+            return self.respond(conn, response)
         except:
             # if an error happened, we fall back
             return False
@@ -396,6 +880,13 @@ class Server:
         CRC is the error detecting code. a hashed version of the file data to make sure we (by very high probability)
         got the same file that the client sent us
         CRC is calculated in the same way it does in linux cksum command
+        (clients of protocol version 4 and up can ask for crc32 or blake2b instead, see integrity.py)
+
+        framing:
+        up to version 4 the content comes in packets, each one a chunk the client encrypted and padded on its own
+        from version 5 (protocol.STREAM_VERSION) the first packet only has the fields, and the content is
+        one CBC stream that follows it in chunks of the size the client put in the request (see valid_stream).
+        the stream is decrypted while it's read, so only the decrypted file is kept in memory
 
         important note:
         this function can be very memory heavy
@@ -412,71 +903,294 @@ class Server:
         :return: (bool) succeeded?
         """
         try:
-            # unpacking the data. because the file size can be very large,
-            # we block other connections while reading and unpacking
-            conn.setblocking(True)
+            # the first packet is here, the rest of the content is read by read_upload
+            # a piece at a time, without blocking the other connections
+            start = time.perf_counter()
             request = protocol.FileSendRequest()  # 1103
-            request.unpack(conn, data)
-            conn.setblocking(False)
-            user_id_hex = request.header.client_id.hex()
+            sampled = self.profiler.sampling
+            if sampled:
+                self.profiler.snapshot("unpack-before")
+            with tracing.span("unpack"):
+                if not request.unpack(data):
+                    return False
+            if request.header.version >= protocol.STREAM_VERSION and not self.valid_stream(request):
+                return False
+            # refuse the upload before reading any of it
+            if not self.within_quota(request):
+                return False
+            if request.header.version >= protocol.STREAM_VERSION:
+                session_key = self.session_key(request.header.client_id.hex())
+                if session_key is None:
+                    return False
+                request.cipher = stream_cipher(session_key)
+            # reading the rest of the content, over as many loop turns as it takes
+            framing = tracing.span("framing", content_size=request.content_size, chunk_size=request.chunk_size)
+            if request.remaining <= 0:
+                framing.end()
+                return self.file_received(conn, request, start, sampled)
 
-            print(f"1103 request from user id is = {user_id_hex} \nFile name is {request.file_name} and size is {request.content_size}")
+            self.bulk_connections.add(conn)
+            self.sel.modify(conn, selectors.EVENT_READ, partial(self.read_upload, request, start, sampled, framing))
+            return Server.DETACHED
 
-            # get AES key from db
-            query = self.backup_db.query_with_result(f"SELECT AESKey FROM clients WHERE ID = ?",
-                                                     [user_id_hex])
-            if not query:
-                print("Missing user session key for file decryption")
-                return False
+        except Exception as e:
+            logger.error("Error while receiving file - %s", e)
+            return False
 
-            session_key = query[0][0]
+    def valid_stream(self, request):
+        """
+        can we take the content of this upload as the client wants to send it?
+        the stream is decrypted as it arrives whatever its chunks are, but a chunk that isn't whole AES blocks
+        means the client doesn't frame it the way the protocol says
+        :param request: protocol.FileSendRequest of STREAM_VERSION and up, with its first packet unpacked
+        :return: (bool)
+        """
+        if request.chunk_size % AES.block_size:
+            logger.warning("Refusing upload of %s in chunks of %d bytes (has to be a multiple of %d)",
+                           request.file_name, request.chunk_size, AES.block_size)
+            return False
+        if not request.content_size or request.content_size % AES.block_size:
+            logger.warning("Refusing upload of %s, %d bytes isn't a padded AES stream", request.file_name,
+                           request.content_size)
+            return False
+        return True
 
-            # create a directory named after the user id (if non is there)
+    def session_key(self, user_id_hex):
+        """
+        :param user_id_hex: id of the user, in hex
+        :return: (bytes) AES session key of the user, None if they don't have one
+        """
+        query = self.backup_db.query_with_result(f"SELECT AESKey FROM clients WHERE ID = ?", [user_id_hex])
+        if not query or query[0][0] is None:
+            logger.warning("Missing user session key for file decryption")
+            return None
+        return query[0][0]
+
+    def within_quota(self, request):
+        """
+        would storing this upload keep the user within their quota?
+        content_size is the encrypted size, a little more than the file itself, so this errs on the strict side
+        a rewrite of a file that's pending its CRC replaces the previous attempt, which doesn't count then
+        :param request: protocol.FileSendRequest with its first packet unpacked
+        :return: (bool)
+        """
+        user_id_hex = request.header.client_id.hex()
+        query = self.backup_db.query_with_result(f"SELECT Bytes, Files, QuotaBytes, QuotaFiles FROM usage WHERE ID = ?",
+                                                 [user_id_hex])
+        used_bytes, used_files, quota_bytes, quota_files = query[0] if query else (0, 0, None, None)
+        # a quota set for the user wins over the configured one. 0 means no limit
+        quota_bytes = self.settings.quota_bytes if quota_bytes is None else quota_bytes
+        quota_files = self.settings.quota_files if quota_files is None else quota_files
+        if not quota_bytes and not quota_files:
+            return True
+
+        file_path = os.path.join(Path().resolve(), user_id_hex, request.file_name)
+        if file_path in self.pending_crc:
+            query = self.backup_db.query_with_result(f"SELECT SUM(Size), COUNT(*) FROM files "
+                                                     f"WHERE ID = ? AND FileName = ?", [user_id_hex, request.file_name])
+            if query and query[0][1]:
+                used_bytes -= query[0][0]
+                used_files -= 1
+
+        if quota_bytes and used_bytes + request.content_size > quota_bytes:
+            logger.warning("User %s is over the storage quota (%d + %d > %d bytes)", user_id_hex, used_bytes,
+                           request.content_size, quota_bytes)
+        elif quota_files and used_files + 1 > quota_files:
+            logger.warning("User %s is over the file quota (%d files)", user_id_hex, quota_files)
+        else:
+            return True
+        metrics.QUOTA_REJECTIONS.inc()
+        return False
+
+    def read_upload(self, request, start, sampled, framing, conn):
+        """
+        selector callback of a connection that's sending the content of a 1103 request
+        reads at most bulk_turn_bytes every time, so a large upload doesn't hold up the loop
+        :param request: protocol.FileSendRequest with its first packet unpacked
+        :param start: perf_counter() time the request started at
+        :param sampled: was the request sampled by the profiler?
+        :param framing: tracing span, ended once the whole content is here
+        :param conn: connection of the request
+        """
+        budget = self.settings.bulk_turn_bytes
+        try:
+            while budget > 0:
+                try:
+                    data = conn.recv(min(budget, request.remaining))
+                except BlockingIOError:
+                    return
+                if not data:
+                    request_log.info("Connection closed in the middle of an upload")
+                    framing.set("bytes", request.bytes_received)
+                    framing.set("ok", False)
+                    framing.end()
+                    self.close_connection(conn)
+                    return
+                metrics.BYTES_RECEIVED.inc(len(data))
+                budget -= len(data)
+                if request.feed(data):
+                    break
+            else:
+                # out of budget for this turn, the selector brings us back here
+                return
+
+            self.bulk_connections.discard(conn)
+            framing.set("bytes", request.bytes_received)
+            framing.end()
+            result = self.file_received(conn, request, start, sampled)
+        except Exception as e:
+            logger.error("Error while receiving file - %s", e)
+            result = False
+        if result is not Server.DETACHED:
+            self.finish(conn, result)
+
+    def file_received(self, conn, request, start, sampled):
+        """
+        the whole 1103 request is here. decrypt it and hand it to the I/O pool to write
+        :return: (bool) succeeded? or DETACHED once the file is on its way to the disk
+        """
+        try:
+            if sampled:
+                self.profiler.snapshot("unpack-after")
+            receive_time = time.perf_counter() - start
+            if receive_time > 0:
+                metrics.UPLOAD_THROUGHPUT.observe(request.content_size / receive_time / 1_000_000)
+            user_id_hex = request.header.client_id.hex()
+
+            request_log.info("1103 request from user id is = %s. File name is %s and size is %s",
+                             user_id_hex, request.file_name, request.content_size)
+
+            # a stream was decrypted while it was read (see file_request), the other versions need the key now
+            session_key = None
+            if request.header.version < protocol.STREAM_VERSION:
+                session_key = self.session_key(user_id_hex)
+                if session_key is None:
+                    return False
+
+            # files go in a directory named after the user id
             path = os.path.join(Path().resolve(), user_id_hex)
             file_path = os.path.join(path, request.file_name)
-            if not os.path.exists(user_id_hex):
-                os.makedirs(path)
 
             # check if it's a file that's pending checksum result. in which case we need to check again
-            if file_path not in self.pending_crc:
-                # make sure user doesn't already have a file by this name another way to handle duplicate files is by
-                # adding (1), (2) and so on.. but in that way we'll need to return the new name with the protocol
-                # which as per my understanding of the assignment means changing the protocol,
-                # and we're not allowed to do that
-                if os.path.exists(file_path):
-                    print(f"User already has a file by the name {request.file_name}")
-                    return False
+            # (the path is added to the pending list right away so a second upload of it counts as a rewrite)
+            rewrite = file_path in self.pending_crc
+            if not rewrite:
                 self.pending_crc.append(file_path)
-            else:
-                # remove the file to rewrite it again before the checksum
-                print(f"file path is {file_path}")
-                os.remove(file_path)
 
             # decrypt file content
-            iv = AES.block_size * b'\0'
-            dec_bytes = b''
-            for chunk in request.content:
-                base64_chunk = b64encode(chunk)
-                cipher = AES.new(session_key, AES.MODE_CBC, iv)
-                dec_bytes += unpad(cipher.decrypt(b64decode(base64_chunk)), AES.block_size)
-
-            # write the file
-            # I'm writing it here and not after making sure the CRC is valid to not store everything in memory
-            with open(file_path, "wb") as f:
-                f.write(dec_bytes)
-
-            # writing the file in database
-            self.backup_db.query(f"INSERT INTO files (ID, FileName, FilePath, Verified) VALUES (?, ?, ?, ?)",
-                                 [user_id_hex, request.file_name, file_path, 0])
-            self.backup_db.query(f"UPDATE clients SET LastSeen = ? WHERE ID = ?",
-                                 [str(datetime.now()), request.header.client_id.hex()])
-
-            return self.send_checksum(conn, file_path, request.header.client_id, request.file_name)
+            if sampled:
+                self.profiler.snapshot("decrypt-before")
+            start = time.perf_counter()
+            with tracing.span("decrypt", size=request.content_size):
+                if request.header.version >= protocol.STREAM_VERSION:
+                    # decrypted while it was read, only the padding is left
+                    dec_bytes = unpad_stream(request.content)
+                else:
+                    dec_bytes = decrypt_content(session_key, request.content)
+            metrics.AES_SECONDS.observe(time.perf_counter() - start + request.decrypt_seconds)
+            if sampled:
+                self.profiler.snapshot("decrypt-after")
+
+            # writing the file and its checksum happen on the I/O pool, file_stored continues from there
+            return self.offload(conn, partial(self.file_stored, conn, request, file_path, rewrite),
+                                self.store_file, path, file_path, dec_bytes, rewrite, request.algorithm)
 
         except Exception as e:
-            print(f"Error while receiving file - {e}")
+            logger.error("Error while receiving file - %s", e)
             return False
 
+    def store_file(self, path, file_path, content, rewrite, algorithm=None):
+        """
+        runs on the I/O pool.
+        write an uploaded file and calculate its checksum
+
+        :param path: directory of the user
+        :param file_path: path of the file
+        :param content: (bytes) decrypted file content
+        :param rewrite: is this a new attempt of a file that's pending its CRC?
+        :param algorithm: IntegrityAlgorithms value the client asked for, None (or cksum) for the cksum value
+        :return: tuple - (checksum, file size). the checksum is digest bytes for algorithms other than cksum
+        """
+        # create a directory named after the user id (if non is there)
+        self.storage.makedirs(path)
+
+        # make sure user doesn't already have a file by this name another way to handle duplicate files is by
+        # adding (1), (2) and so on.. but in that way we'll need to return the new name with the protocol
+        # which as per my understanding of the assignment means changing the protocol,
+        # and we're not allowed to do that
+        if not rewrite and self.storage.exists(file_path):
+            raise FileExistsError(file_path)
+
+        # write the file (a rewrite replaces the previous attempt)
+        # I'm writing it here and not after making sure the CRC is valid to not store everything in memory
+        # faster algorithms hash the content while it's written, cksum reads the file back (maybe in parallel)
+        hasher = integrity.new_hasher(algorithm)
+        with tracing.span("file_write", size=len(content), hashed=hasher is not None):
+            self.storage.write(file_path, content, hasher)
+        if hasher is None:
+            with tracing.span("checksum", size=len(content)):
+                return self.storage.checksum(file_path)
+        return hasher.digest(), len(content)
+
+    def file_stored(self, conn, request, file_path, rewrite, future):
+        """
+        second half of file_request, runs on the selector thread once store_file is done
+        :return: (bool) succeeded?
+        """
+        try:
+            cksum, content_size = future.result()
+        except Exception as e:
+            if isinstance(e, FileExistsError):
+                logger.info("User already has a file by the name %s", request.file_name)
+            else:
+                logger.error("Error while storing file - %s", e)
+            if not rewrite:
+                self.pending_crc.remove(file_path)
+            return False
+
+        user_id_hex = request.header.client_id.hex()
+
+        # writing the file in database. a rewrite replaces the row of the previous attempt,
+        # and the usage of the user changes by the difference, all in one transaction
+        try:
+            with self.backup_db.transaction() as db:
+                old_size, old_files = db.execute(f"SELECT COALESCE(SUM(Size), 0), COUNT(*) FROM files "
+                                                 f"WHERE ID = ? AND FileName = ?",
+                                                 [user_id_hex, request.file_name]).fetchone()
+                db.execute(f"DELETE FROM files WHERE ID = ? AND FileName = ?", [user_id_hex, request.file_name])
+                db.execute(f"INSERT INTO files (ID, FileName, FilePath, Verified, Size) VALUES (?, ?, ?, ?, ?)",
+                           [user_id_hex, request.file_name, file_path, 0, content_size])
+                database.add_usage(db, user_id_hex, content_size - old_size, 0 if old_files else 1)
+                db.execute(f"UPDATE clients SET LastSeen = ? WHERE ID = ?", [str(datetime.now()), user_id_hex])
+        except sqlite3.Error as e:
+            # answering 2103 would have the client think the file is stored, while neither the files table
+            # nor the usage of the user know about it. it's removed and the client gets 2107
+            logger.error("Failed to record file %s - %s", request.file_name, e)
+            return self.offload(conn, partial(self.file_discarded, conn, request, file_path, rewrite),
+                                self.storage.remove, file_path)
+
+        return self.send_checksum(conn, cksum, content_size, request.header.client_id, request.file_name,
+                                  request.algorithm)
+
+    def file_discarded(self, conn, request, file_path, rewrite, future):
+        """
+        runs on the selector thread once an upload that couldn't be recorded was removed
+        :return: (bool) always False, the client gets 2107
+        """
+        try:
+            future.result()
+        except OSError as e:
+            logger.error("Failed to remove %s - %s", file_path, e)
+        self.pending_crc.remove(file_path)
+        if rewrite:
+            # the row of the previous attempt is for the file that was just removed
+            try:
+                with self.backup_db.transaction() as db:
+                    database.remove_file(db, request.header.client_id.hex(), request.file_name)
+            except sqlite3.Error as e:
+                logger.error("Failed to remove the previous attempt of %s - %s", request.file_name, e)
+        return False
+
     def valid_crc(self, conn, data):
         """
         CODE = 1104
@@ -496,7 +1210,7 @@ class Server:
             file_name = request.file_name
             user_id = request.header.client_id.hex()
 
-            print(f"CRC is VALID for file {file_name} by user {user_id}")
+            logger.info("CRC is VALID for file %s by user %s", file_name, user_id)
 
             # update db (and make sure it worked)
             db_flag_1 = self.backup_db.query(f"UPDATE clients SET LastSeen = ? WHERE ID = ?",
@@ -513,10 +1227,10 @@ class Server:
             # create and pack the response
             response = protocol.GenericResponse()  # 2104
             response.client_id = request.header.client_id
-            return self.write(conn, response.pack())
+            return self.respond(conn, response)
 
         except Exception as e:
-            print(f"Exception in valid CRC - {e}")
+            logger.error("Exception in valid CRC - %s", e)
             return False
 
     def wrong_crc(self, conn, data):
@@ -541,7 +1255,7 @@ class Server:
             user_id = request.header.client_id.hex()
             file_name = request.file_name
 
-            print(f"CRC is WRONG for file {file_name} by user {user_id}")
+            logger.info("CRC is WRONG for file %s by user %s", file_name, user_id)
 
             # update last seen
             if not self.backup_db.query(f"UPDATE clients SET LastSeen = ? WHERE ID = ?",
@@ -549,7 +1263,7 @@ class Server:
                 return False
             return True
         except Exception as e:
-            print(f"Exception in failed CRC - {e}")
+            logger.error("Exception in wrong CRC - %s", e)
             return False
 
     def failed_crc(self, conn, data):
@@ -572,31 +1286,137 @@ class Server:
             file_name = request.file_name
             user_id = request.header.client_id.hex()
 
-            print(f"CRC is WRONG. Checksum failed for file {file_name} by user {user_id}")
+            logger.warning("CRC is WRONG. Checksum failed for file %s by user %s", file_name, user_id)
 
-            db_flag_1 = self.backup_db.query(f"UPDATE clients SET LastSeen = ? WHERE ID = ?",
-                                             [str(datetime.now()), user_id])
-            query = self.backup_db.query_with_result(f"SELECT FilePath FROM files WHERE ID = ? AND fileName = ?",
-                                                     [user_id, file_name])
-            # no need to keep the file
-            db_flag_2 = self.backup_db.query(f"DELETE FROM files WHERE ID = ? AND fileName = ?",
-                                             [user_id, file_name])
+            # no need to keep the file. it stops counting for the user's usage in the same transaction
+            with self.backup_db.transaction() as db:
+                db.execute(f"UPDATE clients SET LastSeen = ? WHERE ID = ?", [str(datetime.now()), user_id])
+                paths = database.remove_file(db, user_id, file_name)
 
-            if not db_flag_1 or not db_flag_2 or not query:
+            if not paths:
                 return False
-            file_path = query[0][0]
+            file_path = paths[0]
 
             # TODO: validate that this is safe and we're not deleting anything important
             # it should be because it's ID based but it's always good to double check
-            print(f"file path is {file_path}")
-            os.remove(file_path)
-            self.pending_crc.remove(file_path)
+            request_log.debug("file path is %s", file_path)
+            return self.offload(conn, partial(self.file_removed, conn, request, file_path),
+                                self.storage.remove, file_path)
 
-            # pack and send response
-            response = protocol.GenericResponse()  # 2104
-            response.client_id = request.header.client_id
-            return self.write(conn, response.pack())
+        except Exception as e:
+            logger.error("Exception in failed CRC - %s", e)
+            return False
 
+    def file_removed(self, conn, request, file_path, future):
+        """
+        second half of failed_crc, runs on the selector thread once the file is removed
+        :return: (bool) succeeded?
+        """
+        future.result()
+        self.pending_crc.remove(file_path)
+
+        # pack and send response
+        response = protocol.GenericResponse()  # 2104
+        response.client_id = request.header.client_id
+        return self.respond(conn, response)
+
+    def get_file(self, conn, data):
+        """
+        CODE = 1107
+
+        a user wants one of their (verified) files back
+        payload is the file name
+
+        respond with 2108 followed by the file content, encrypted with the current session key (AES-CBC)
+        the IV is random and sent in the response.
+        the file is opened and read on the I/O pool, and encrypted and sent a piece at a time whenever
+        the socket is writable, so big files (or a slow disk) don't block other connections or sit in memory
+
+        :param conn: connection to write back to
+        :param data: Get File Request header + payload in bytes (packed)
+        :return: DETACHED if streaming started, False if failed
+        """
+        try:
+            request = protocol.GetFileRequest()  # 1107
+            request.unpack(data)
+            file_name = request.file_name
+            user_id = request.header.client_id.hex()
+
+            # files are looked up by owner, so users can only get their own files back
+            query = self.backup_db.query_with_result(f"SELECT FilePath FROM files "
+                                                     f"WHERE ID = ? AND FileName = ? AND Verified = ?",
+                                                     [user_id, file_name, 1])
+            if not query:
+                logger.info("User %s has no verified file named %s", user_id, file_name)
+                return False
+            file_path = query[0][0]
+
+            key_query = self.backup_db.query_with_result(f"SELECT AESKey FROM clients WHERE ID = ?", [user_id])
+            if not key_query or not key_query[0][0]:
+                logger.warning("Missing user session key for file encryption")
+                return False
+            session_key = key_query[0][0]
+
+            # opening the file happens on the I/O pool, file_opened continues from there
+            return self.offload(conn, partial(self.file_opened, conn, request, session_key),
+                                self.storage.open_read, file_path)
+
+        except Exception as e:
+            logger.error("Exception in get file - %s", e)
+            return False
+
+    def file_opened(self, conn, request, session_key, future):
+        """
+        second half of get_file, runs on the selector thread once the file is open
+        :return: DETACHED once the file is being streamed, False if failed
+        """
+        try:
+            file, file_size = future.result()
         except Exception as e:
-            print(f"Exception in failed CRC - {e}")
+            logger.error("Exception in get file - %s", e)
             return False
+
+        response = protocol.GetFileResponse()  # 2108
+        # the header goes out with the stream, not through respond(), so it's stamped here
+        response.header.version = self.version(conn)
+        response.client_id = request.header.client_id
+        response.file_name = bytearray(request.file_name, 'utf-8')
+        response.content_size = (file_size // AES.block_size + 1) * AES.block_size
+        response.iv = get_random_bytes(AES.block_size)
+
+        stream = EncryptedFileStream(file, AES.new(session_key, AES.MODE_CBC, response.iv), response.pack(),
+                                     self.settings.stream_read_size, self.packet_size,
+                                     partial(self.read_ahead, conn))
+        request_log.info("Sending file %s to user %s", request.file_name, request.header.client_id.hex())
+        self.bulk_connections.add(conn)
+        self.sel.register(conn, selectors.EVENT_WRITE, partial(self.send_stream, stream))
+        return Server.DETACHED
+
+    def read_ahead(self, conn, file, size):
+        """
+        start reading a piece of a file that's streamed back
+        :return: Future of the bytes read
+        """
+        return self.io_pool.submit(tracing.wrap(self.profiled(conn, self.storage.read)), file, size)
+
+    def send_stream(self, stream, conn):
+        """
+        selector callback for connections that are streaming a file back
+        :param stream: EncryptedFileStream of the connection
+        :param conn: connection to write to
+        """
+        try:
+            done = stream.send(conn, self.settings.bulk_turn_bytes)
+        except Exception as e:
+            logger.warning("Failed to stream file to %s - %s", conn, e)
+            done = True
+        if done is None:
+            # the next piece is still being read, the connection waits off the selector until it's here
+            self.sel.unregister(conn)
+            stream.reading.add_done_callback(
+                lambda reading: self.call_soon(partial(self.sel.register, conn, selectors.EVENT_WRITE,
+                                                       partial(self.send_stream, stream))))
+            return
+        if done:
+            stream.close()
+            self.close_connection(conn)
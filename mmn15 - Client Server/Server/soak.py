@@ -0,0 +1,378 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from Crypto.PublicKey import RSA
+import config
+import loadgen
+import logs
+import protocol
+import server
+
+"""
+Soak test for the server
+
+runs a server inside this process (on a thread) for a long time, while a child process drives it with a fixed
+population of clients doing the whole protocol over and over:
+    first round: register, exchange keys, upload a file that is kept (1104)
+    every round: login, upload a scratch file, answer 1105, upload it again, answer 1106, fetch the kept file (1107)
+so once every client went through a round the server has nothing new to remember, and memory should stay flat
+
+every --interval the harness samples tracemalloc, RSS, open file descriptors and the size of the server's
+own state (users, pending CRCs, selector). samples taken during --warmup are ignored
+the run fails (exit code 1) if, after the warmup, the median of the last third of the samples grew past a
+threshold compared to the first third, or if the server is left with pending CRCs or connections when the
+traffic stops. example:
+    python soak.py --duration 4h --clients 100 --concurrency 20
+    python soak.py --duration 10m --warmup 1m --interval 10s      # quick check
+"""
+
+DEFAULT_DURATION = 2 * 60 * 60
+DEFAULT_WARMUP = 5 * 60
+DEFAULT_INTERVAL = 30
+DEFAULT_MAX_RSS_GROWTH = 64  # MB
+DEFAULT_MAX_TRACED_GROWTH = 32  # MB
+DEFAULT_MAX_FD_GROWTH = 16
+MIN_SAMPLES = 6  # after the warmup, fewer than that and growth can't be told from noise
+TRACE_FRAMES = 10
+TOP_GROWTH = 10  # allocation sites listed in the report
+QUIESCE_TIMEOUT = 30  # seconds the server gets to finish what's in flight once the traffic stops
+
+DURATION_SUFFIXES = {"s": 1, "m": 60, "h": 60 * 60}
+
+
+def parse_duration(text):
+    """
+    :param text: duration like 90, 30s, 5m or 2h
+    :return: seconds
+    """
+    text = text.strip().lower()
+    if text and text[-1] in DURATION_SUFFIXES:
+        return float(text[:-1]) * DURATION_SUFFIXES[text[-1]]
+    return float(text)
+
+
+"""
+traffic (runs in the child process)
+"""
+
+
+class SoakClient:
+    def __init__(self, client, keep_name, scratch_name):
+        self.client = client
+        self.keep_name = keep_name
+        self.scratch_name = scratch_name
+        self.registered = False
+        self.kept = False
+
+
+async def soak_round(soak, rsa_key, data, cksum):
+    client = soak.client
+    if not soak.registered:
+        await client.register()
+        soak.registered = True
+        await client.exchange_keys(rsa_key)
+    else:
+        # a client without a key yet (its first round failed half way) gets 2106 and exchanges keys
+        client.rsa_key = rsa_key
+        await client.login()
+
+    if not soak.kept:
+        soak.kept = await client.upload(soak.keep_name, data, cksum)
+
+    # a file that is rejected twice, so it's written, rewritten and removed again every round
+    await client.send_file(soak.scratch_name, data)
+    await client.crc_reply(protocol.RequestCodes.REQUEST_WARNING_CRC.value, soak.scratch_name)
+    await client.send_file(soak.scratch_name, data)
+    await client.crc_reply(protocol.RequestCodes.REQUEST_ERROR_CRC.value, soak.scratch_name)
+
+    if soak.kept and await client.fetch_file(soak.keep_name) != data:
+        raise loadgen.ProtocolError(f"{client.name} got different content back for {soak.keep_name}")
+
+
+async def drive(host, port, clients, concurrency, size, duration, seed=0):
+    """
+    run the soak traffic until duration is over
+    :return: (dict) loadgen style report, plus the number of rounds
+    """
+    stats = loadgen.Stats()
+    data, cksum = loadgen.FileContent(seed).get(size)
+    keys = [RSA.generate(loadgen.RSA_BITS, e=loadgen.RSA_EXPONENT) for _ in range(min(clients, 8))]
+    run_id = uuid.uuid4().hex[:8]
+    population = [SoakClient(loadgen.ProtocolClient(host, port, f"soak-{run_id}-{index}", stats),
+                             "keep.bin", "scratch.bin") for index in range(clients)]
+    rounds = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(members):
+        nonlocal rounds
+        while time.perf_counter() < deadline:
+            for index, soak in members:
+                if time.perf_counter() >= deadline:
+                    return
+                try:
+                    await soak_round(soak, keys[index % len(keys)], data, cksum)
+                    rounds += 1
+                except (OSError, loadgen.ProtocolError, ValueError, asyncio.IncompleteReadError):
+                    stats.clients_failed += 1
+
+    start = time.perf_counter()
+    members = list(enumerate(population))
+    await asyncio.gather(*(worker(members[i::concurrency]) for i in range(min(concurrency, clients))))
+    report = stats.report(time.perf_counter() - start)
+    report["rounds"] = rounds
+    return report
+
+
+"""
+sampling (runs in the harness, next to the server)
+"""
+
+
+def rss_bytes():
+    """
+    :return: resident set size of this process, None if we can't tell
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def fd_count():
+    """
+    :return: open file descriptors of this process, None if we can't tell
+    """
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return None
+
+
+def take_sample(instance, start):
+    gc.collect()
+    return {
+        "time_s": time.perf_counter() - start,
+        "traced_bytes": tracemalloc.get_traced_memory()[0],
+        "rss_bytes": rss_bytes(),
+        "fds": fd_count(),
+        "users": len(instance.users),
+        "pending_crc": len(instance.pending_crc),
+        "selector_keys": len(instance.sel.get_map()),
+        "bulk_connections": len(instance.bulk_connections),
+    }
+
+
+def growth(samples, field):
+    """
+    :return: median of the last third minus median of the first third, None if the field wasn't sampled
+    """
+    values = [sample[field] for sample in samples if sample[field] is not None]
+    if len(values) < MIN_SAMPLES:
+        return None
+    third = len(values) // 3
+    return statistics.median(values[-third:]) - statistics.median(values[:third])
+
+
+def top_growth(before, after):
+    """
+    :return: list of the allocation sites that grew the most between two snapshots
+    """
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    stats.sort(key=lambda stat: stat.size_diff, reverse=True)
+    return [str(stat) for stat in stats[:TOP_GROWTH]]
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class Soak:
+    def __init__(self, args):
+        self.args = args
+        self.samples = []
+        self.baseline = None  # tracemalloc snapshot at the end of the warmup
+        self.failures = []
+        self.log_listener = None
+        self.idle_keys = 0  # selector keys of the server without any client (listening socket, wake up socket)
+
+    def start_server(self):
+        settings = config.ServerConfig(host="127.0.0.1", port=free_port(), metrics_port=0, log_level="ERROR")
+        self.log_listener = logs.setup_logging(settings.log_level, settings.request_log_rate)
+        instance = server.Server(settings)
+        threading.Thread(target=instance.start, name="server", daemon=True).start()
+        deadline = time.monotonic() + QUIESCE_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", settings.port), timeout=1).close()
+                return instance
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def start_traffic(self, port, report_path):
+        args = self.args
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--drive-port", str(port),
+                                 "--duration", str(args.duration), "--clients", str(args.clients),
+                                 "--concurrency", str(args.concurrency), "--size", str(args.size),
+                                 "--drive-report", report_path])
+
+    def run(self):
+        """
+        :return: (dict) report of the run
+        """
+        args = self.args
+        tracemalloc.start(TRACE_FRAMES)
+        instance = self.start_server()
+        # give the server a moment to close the probe connection
+        time.sleep(0.1)
+        self.idle_keys = len(instance.sel.get_map())
+        report_path = os.path.join(os.getcwd(), "traffic.json")
+        traffic = self.start_traffic(instance.port, report_path)
+
+        start = time.perf_counter()
+        final = None
+        while traffic.poll() is None:
+            time.sleep(min(args.interval, 1.0))
+            elapsed = time.perf_counter() - start
+            if self.samples and elapsed - self.samples[-1]["time_s"] < args.interval:
+                continue
+            sample = take_sample(instance, start)
+            self.samples.append(sample)
+            if self.baseline is None and elapsed >= args.warmup:
+                self.baseline = tracemalloc.take_snapshot()
+            print(f"[{elapsed / 60:7.1f}m] traced {sample['traced_bytes'] / 1e6:8.2f} MB, "
+                  f"rss {(sample['rss_bytes'] or 0) / 1e6:8.2f} MB, fds {sample['fds']}, users {sample['users']}, "
+                  f"pending {sample['pending_crc']}, selector {sample['selector_keys']}", flush=True)
+
+        # the traffic is done, whatever the server is still holding now is a leak
+        deadline = time.monotonic() + QUIESCE_TIMEOUT
+        while time.monotonic() < deadline:
+            final = take_sample(instance, start)
+            if not final["pending_crc"] and not final["bulk_connections"] and final["selector_keys"] <= self.idle_keys:
+                break
+            time.sleep(0.5)
+        top = top_growth(self.baseline, tracemalloc.take_snapshot()) if self.baseline else []
+        if final["pending_crc"]:
+            self.failures.append(f"{final['pending_crc']} files still pending their CRC")
+        if final["bulk_connections"] or final["selector_keys"] > self.idle_keys:
+            self.failures.append(f"{final['selector_keys']} selector keys and {final['bulk_connections']} "
+                                 f"transfers left open")
+
+        steady = [sample for sample in self.samples if sample["time_s"] >= args.warmup]
+        growths = {field: growth(steady, field) for field in ("traced_bytes", "rss_bytes", "fds", "users")}
+        for field, limit, scale, unit in (("traced_bytes", args.max_traced_growth, 1e6, "MB"),
+                                          ("rss_bytes", args.max_rss_growth, 1e6, "MB"),
+                                          ("fds", args.max_fd_growth, 1, "")):
+            if growths[field] is None:
+                continue
+            if growths[field] / scale > limit:
+                self.failures.append(f"{field} grew by {growths[field] / scale:.2f}{unit} (limit {limit}{unit})")
+        if len(steady) < MIN_SAMPLES:
+            self.failures.append(f"only {len(steady)} samples after the warmup, need {MIN_SAMPLES}. "
+                                 f"run longer or sample more often")
+
+        traffic_report = {}
+        if traffic.returncode != 0:
+            self.failures.append(f"the traffic process exited with {traffic.returncode}")
+        elif os.path.exists(report_path):
+            with open(report_path) as f:
+                traffic_report = json.load(f)
+            if not traffic_report.get("rounds"):
+                self.failures.append("the traffic process didn't finish a single round")
+
+        return {
+            "passed": not self.failures,
+            "failures": self.failures,
+            "growth": growths,
+            "final": final,
+            "top_growth": top,
+            "traffic": traffic_report,
+            "samples": self.samples,
+        }
+
+
+def print_report(report):
+    traffic = report["traffic"]
+    if traffic:
+        print(f"\n{traffic.get('rounds', 0)} rounds, {traffic['requests']} requests, {traffic['errors']} errors, "
+              f"{traffic['clients_failed']} failed rounds")
+    print("growth after the warmup (last third - first third):")
+    for field, value in report["growth"].items():
+        print(f"  {field:<14} {'-' if value is None else f'{value:,.0f}'}")
+    if report["top_growth"]:
+        print("allocation sites that grew the most:")
+        for line in report["top_growth"]:
+            print(f"  {line}")
+    print("PASSED" if report["passed"] else "FAILED")
+    for failure in report["failures"]:
+        print(f"  {failure}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="long running soak test of the mmn15 server")
+    parser.add_argument("--duration", type=parse_duration, default=DEFAULT_DURATION, help="e.g. 30m, 4h")
+    parser.add_argument("--warmup", type=parse_duration, default=DEFAULT_WARMUP,
+                        help="samples taken before this aren't used for the growth checks")
+    parser.add_argument("--interval", type=parse_duration, default=DEFAULT_INTERVAL, help="time between samples")
+    parser.add_argument("--clients", type=int, default=50, help="size of the client population")
+    parser.add_argument("--concurrency", type=int, default=10, help="clients running at the same time")
+    parser.add_argument("--size", type=loadgen.parse_size, default="16k", help="size of the uploaded files")
+    parser.add_argument("--dir", default=None, help="where the server keeps its files (a temporary one by default)")
+    parser.add_argument("--max-rss-growth", type=float, default=DEFAULT_MAX_RSS_GROWTH, help="MB")
+    parser.add_argument("--max-traced-growth", type=float, default=DEFAULT_MAX_TRACED_GROWTH, help="MB")
+    parser.add_argument("--max-fd-growth", type=int, default=DEFAULT_MAX_FD_GROWTH)
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the report to this file")
+    # used by the harness to run the traffic in a child process
+    parser.add_argument("--drive-port", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--drive-report", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.drive_port is not None:
+        report = asyncio.run(drive("127.0.0.1", args.drive_port, args.clients, args.concurrency, args.size,
+                                   args.duration))
+        with open(args.drive_report, "w") as f:
+            json.dump(report, f, indent=2)
+        return 0
+
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    work_dir = args.dir or tempfile.mkdtemp(prefix="mmn15-soak-")
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    print(f"soaking for {args.duration / 60:.1f} minutes in {work_dir}", flush=True)
+
+    soak = Soak(args)
+    try:
+        report = soak.run()
+    finally:
+        if soak.log_listener is not None:
+            soak.log_listener.stop()
+    print_report(report)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import os
+import time
+from checksum import checksum, ParallelChecksum, DEFAULT_MIN_PARALLEL_SIZE
+import metrics
+
+"""
+File system access for the server
+
+everything the request handlers do on disk goes through a Storage object
+the server runs these calls on its I/O thread pool so a slow disk only delays the request that's waiting for it,
+not every connection on the selector loop
+"""
+
+WRITE_BLOCK_SIZE = 1024 * 1024  # bytes written (and hashed) at a time when the file is hashed while it's written
+
+
+class Storage:
+    def __init__(self, checksum_workers=0, parallel_checksum_size=DEFAULT_MIN_PARALLEL_SIZE):
+        """
+        :param checksum_workers: processes used to checksum big files (0 to checksum in the calling thread)
+        :param parallel_checksum_size: files from this size up are checksummed by the processes
+        """
+        self.parallel_checksum = None
+        if checksum_workers > 1:
+            self.parallel_checksum = ParallelChecksum(checksum_workers, parallel_checksum_size)
+
+    def makedirs(self, path):
+        """
+        create a directory (and its parents) if it isn't there yet
+        :param path: directory path
+        """
+        os.makedirs(path, exist_ok=True)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def open_read(self, path):
+        """
+        :param path: file path
+        :return: tuple - (file object opened for binary reading, file size)
+        """
+        file = open(path, "rb")
+        return file, os.fstat(file.fileno()).st_size
+
+    def read(self, file, size):
+        """
+        :param file: file object from open_read
+        :return: (bytes) up to size bytes, fewer only at the end of the file
+        """
+        return file.read(size)
+
+    def write(self, path, data, hasher=None):
+        """
+        write a whole file, replacing it if it's already there
+        :param path: file path
+        :param data: (bytes) file content
+        :param hasher: optional (see integrity.py), fed every block right after it's written
+        """
+        with open(path, "wb") as f:
+            if hasher is None:
+                f.write(data)
+                return
+            view = memoryview(data)
+            hash_time = 0
+            for offset in range(0, len(view), WRITE_BLOCK_SIZE):
+                block = view[offset:offset + WRITE_BLOCK_SIZE]
+                f.write(block)
+                start = time.perf_counter()
+                hasher.update(block)
+                hash_time += time.perf_counter() - start
+            metrics.CRC_SECONDS.observe(hash_time)
+
+    def checksum(self, path):
+        """
+        :param path: file path
+        :return: tuple - (cksum of the file, file size)
+        """
+        start = time.perf_counter()
+        if self.parallel_checksum is not None:
+            result = self.parallel_checksum(str(path))
+        else:
+            result = checksum(str(path))
+        metrics.CRC_SECONDS.observe(time.perf_counter() - start)
+        return result
@@ -0,0 +1,159 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+from Crypto.PublicKey import RSA
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+import config
+import loadgen
+import protocol
+import server
+import transport
+
+"""
+Shared fixtures for the server tests
+
+the tests run a Server over loopback connections (see transport.py) in a temporary directory,
+requests are built with loadgen's ProtocolClient so they're exactly what a client puts on the wire.
+the few that need real sockets run main.py in a process of its own (live_server)
+"""
+
+SERVER_START_TIMEOUT = 10  # seconds
+
+
+def packet(data):
+    return data.ljust(loadgen.PACKET_SIZE, b'\0')
+
+
+class LoopbackServer:
+    """
+    a Server on loopback connections, with helpers to talk the protocol to it
+    """
+    def __init__(self, rsa_key, settings, file_storage=None):
+        self.rsa_key = rsa_key
+        self.server = server.Server(settings, file_storage, transport.LoopbackSelector())
+        self.harness = transport.LoopbackHarness(self.server)
+
+    def connect(self, data):
+        return self.harness.connect(data)
+
+    def request(self, data):
+        """
+        :param data: (bytes) a whole request
+        :return: tuple - (response code, response payload)
+        """
+        conn = self.connect(data)
+        self.harness.run()
+        return conn.response()
+
+    def register(self, name):
+        code = protocol.RequestCodes.REQUEST_REGISTRATION.value
+        return packet(loadgen.ProtocolClient(None, None, name, None).header(code, protocol.NAME_SIZE) +
+                      loadgen.fixed_str(name, protocol.NAME_SIZE))
+
+    def client(self, name, version=loadgen.CLIENT_VERSION, algorithm=None, chunk_size=loadgen.STREAM_CHUNK_SIZE):
+        """
+        :return: loadgen.ProtocolClient that's registered and has its session key
+        """
+        client = loadgen.ProtocolClient(None, None, name, None, version, algorithm=algorithm, chunk_size=chunk_size)
+        code, payload = self.request(self.register(name))
+        assert code == protocol.ResponseCodes.RESPONSE_REGISTRATION.value
+        client.client_id = payload[:protocol.CLIENT_ID_SIZE]
+        client.rsa_key = self.rsa_key
+        code = protocol.RequestCodes.REQUEST_PUBLIC_KEY.value
+        public_key = self.rsa_key.publickey().export_key("DER")
+        code, payload = self.request(packet(client.header(code, protocol.NAME_SIZE + protocol.PUBLIC_KEY_SIZE) +
+                                            loadgen.fixed_str(name, protocol.NAME_SIZE) +
+                                            loadgen.fixed_str(public_key, protocol.PUBLIC_KEY_SIZE)))
+        assert code == protocol.ResponseCodes.RESPONSE_PUBLIC_KEY.value
+        client.take_session_key(payload)
+        return client
+
+    @staticmethod
+    def upload(client, file_name, content):
+        """
+        :return: (bytes) the whole 1103 request of client uploading content
+        """
+        first_packet, chunks = client.file_packets(file_name, content)
+        if client.version >= protocol.STREAM_VERSION:
+            return packet(first_packet) + b"".join(chunks)
+        return b"".join(packet(chunk) for chunk in (first_packet, *chunks))
+
+    def close(self):
+        self.harness.close()
+
+
+class LiveServer:
+    """
+    main.py running in a directory of its own, listening on a free port
+    """
+    def __init__(self, directory, **settings):
+        os.makedirs(directory, exist_ok=True)
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        env = dict(os.environ, MMN15_PORT=str(self.port), MMN15_METRICS_PORT="0", MMN15_LOG_LEVEL="ERROR")
+        env.update({f"MMN15_{name.upper()}": str(value) for name, value in settings.items()})
+        self.process = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, "main.py")], cwd=directory, env=env)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("the server didn't start")
+                time.sleep(0.05)
+
+    def stop(self):
+        """
+        :return: the exit code of the server
+        """
+        if self.process.poll() is None:
+            self.process.terminate()
+        return self.process.wait(SERVER_START_TIMEOUT)
+
+
+@pytest.fixture(scope="session")
+def rsa_key():
+    return RSA.generate(loadgen.RSA_BITS, e=loadgen.RSA_EXPONENT)
+
+
+@pytest.fixture
+def loopback(tmp_path, monkeypatch, rsa_key):
+    """
+    :return: function(file_storage=None, **settings) -> LoopbackServer, running in a temporary directory
+    """
+    monkeypatch.chdir(tmp_path)
+    servers = []
+
+    def make(file_storage=None, **settings):
+        settings = config.ServerConfig(**{"port": 0, "metrics_port": 0, **settings})
+        servers.append(LoopbackServer(rsa_key, settings, file_storage))
+        return servers[-1]
+
+    yield make
+    for instance in servers:
+        instance.close()
+
+
+@pytest.fixture
+def live_server(tmp_path):
+    """
+    :return: function(name, **settings) -> LiveServer, running in tmp_path / name. stopped after the test
+    """
+    servers = []
+
+    def make(name, **settings):
+        servers.append(LiveServer(tmp_path / name, **settings))
+        return servers[-1]
+
+    yield make
+    for instance in servers:
+        instance.stop()
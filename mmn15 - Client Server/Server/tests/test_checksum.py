@@ -0,0 +1,53 @@
+import os
+import threading
+import time
+import checksum
+
+"""
+ParallelChecksum gives cksum's result to the bit, and its pool is shared by the threads calling it
+"""
+
+MIN_SIZE = 64 * 1024
+
+
+def test_parallel_matches_cksum(tmp_path):
+    parallel = checksum.ParallelChecksum(workers=2, min_size=MIN_SIZE)
+    try:
+        for size in (MIN_SIZE - 1, MIN_SIZE, 3 * MIN_SIZE + 7):
+            path = tmp_path / f"{size}.bin"
+            path.write_bytes(os.urandom(size))
+            assert parallel(str(path)) == checksum.checksum(str(path))
+    finally:
+        parallel.close()
+
+
+def test_one_pool_for_concurrent_calls(tmp_path, monkeypatch):
+    pools = []
+
+    class CountingPool(checksum.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            time.sleep(0.05)  # starting the pool takes a while, long enough for the other threads to get there
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(checksum, "ProcessPoolExecutor", CountingPool)
+    path = tmp_path / "big.bin"
+    path.write_bytes(os.urandom(2 * MIN_SIZE))
+    parallel = checksum.ParallelChecksum(workers=2, min_size=MIN_SIZE)
+    start = threading.Barrier(8)
+    results = []
+
+    def run():
+        start.wait()
+        results.append(parallel(str(path)))
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        parallel.close()
+    assert len(pools) == 1
+    assert results == [checksum.checksum(str(path))] * 8
@@ -0,0 +1,83 @@
+import os
+import struct
+import pytest
+import checksum
+import integrity
+import loadgen
+import protocol
+from conftest import packet
+
+"""
+the integrity check in 2103: cksum as a number for older clients, the algorithm the client asked for
+and its digest from protocol version 4 up. and the version every response carries, which is the client's
+"""
+
+CONTENT = os.urandom(5000)  # a few packets, with a partial last block
+CHECKSUM_OFFSET = protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE
+UNKNOWN_ALGORITHM = 9  # not an IntegrityAlgorithms value
+
+
+def response_header(instance, data):
+    """
+    :return: tuple - (version, code) in the header of the response to data
+    """
+    conn = instance.connect(data)
+    instance.harness.run()
+    return struct.unpack("<BH", conn.outbound[:struct.calcsize("<BH")])
+
+
+def registration(client):
+    code = protocol.RequestCodes.REQUEST_REGISTRATION.value
+    return packet(client.header(code, protocol.NAME_SIZE) + loadgen.fixed_str(client.name, protocol.NAME_SIZE))
+
+
+def test_legacy_cksum(loopback):
+    instance = loopback()
+    client = instance.client("legacy", protocol.LEGACY_VERSION)
+    code, payload = instance.request(instance.upload(client, "file.bin", CONTENT))
+    assert code == protocol.ResponseCodes.RESPONSE_FILE.value
+    assert struct.unpack("<L", payload[CHECKSUM_OFFSET:CHECKSUM_OFFSET + protocol.CHECK_SUM_SIZE])[0] == \
+        checksum.memcrc(CONTENT)
+
+
+@pytest.mark.parametrize("version", [protocol.INTEGRITY_VERSION, protocol.STREAM_VERSION])
+@pytest.mark.parametrize("algorithm", list(protocol.IntegrityAlgorithms))
+def test_digest(loopback, version, algorithm):
+    instance = loopback()
+    client = instance.client("integrity", version, algorithm.value)
+    code, payload = instance.request(instance.upload(client, "file.bin", CONTENT))
+    assert code == protocol.ResponseCodes.RESPONSE_FILE.value
+    assert payload[CHECKSUM_OFFSET] == algorithm.value
+    digest = integrity.digest_of(algorithm.value, CONTENT)
+    offset = CHECKSUM_OFFSET + protocol.ALGORITHM_SIZE
+    assert bytes(payload[offset:offset + len(digest)]) == digest
+
+
+def test_unknown_algorithm(loopback):
+    instance = loopback()
+    client = instance.client("unknown", protocol.INTEGRITY_VERSION, UNKNOWN_ALGORITHM)
+    code, _ = instance.request(instance.upload(client, "file.bin", CONTENT))
+    assert code == protocol.ResponseCodes.RESPONSE_ERROR.value
+
+
+@pytest.mark.parametrize("version", [protocol.LEGACY_VERSION, protocol.INTEGRITY_VERSION])
+def test_response_version(loopback, version):
+    # responses carry the version of the request, a client isn't answered with one it doesn't speak
+    instance = loopback()
+    client = instance.client("versions", version)
+    # prebuilt 2101, the name is taken
+    assert response_header(instance, registration(client)) == \
+        (version, protocol.ResponseCodes.RESPONSE_FAILED_REGISTRATION.value)
+    assert response_header(instance, instance.upload(client, "file.bin", CONTENT)) == \
+        (version, protocol.ResponseCodes.RESPONSE_FILE.value)
+    # prebuilt 2107
+    missing = packet(client.header(protocol.RequestCodes.REQUEST_ERROR_CRC.value, protocol.NAME_SIZE) +
+                     loadgen.fixed_str("missing.bin", protocol.NAME_SIZE))
+    assert response_header(instance, missing) == (version, protocol.ResponseCodes.RESPONSE_ERROR.value)
+
+
+def test_newer_client_version(loopback):
+    instance = loopback()
+    client = loadgen.ProtocolClient(None, None, "newer", None, protocol.SERVER_VERSION + 1)
+    assert response_header(instance, registration(client)) == \
+        (protocol.SERVER_VERSION, protocol.ResponseCodes.RESPONSE_REGISTRATION.value)
@@ -0,0 +1,110 @@
+import os
+import struct
+import threading
+import time
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+import loadgen
+import protocol
+import storage
+from conftest import packet
+
+"""
+disk work runs on the I/O pool, so a slow disk only delays the request waiting for it
+"""
+
+DELAY = 2.0  # seconds every slow write or read takes
+
+
+class SlowStorage(storage.Storage):
+    def __init__(self):
+        super().__init__()
+        self.slow = False
+        self.writing = threading.Event()
+        self.reading = threading.Event()
+
+    def write(self, path, data, hasher=None):
+        if self.slow:
+            self.writing.set()
+            time.sleep(DELAY)
+        super().write(path, data, hasher)
+
+    def read(self, file, size):
+        if self.slow:
+            self.reading.set()
+            time.sleep(DELAY)
+        return super().read(file, size)
+
+
+def run_until(instance, event, timeout=10):
+    """
+    run the loop of a loopback server (and whatever the I/O pool finished) until event is set
+    """
+    deadline = time.monotonic() + timeout
+    while not event.wait(0.001):
+        assert time.monotonic() < deadline, "timed out"
+        instance.server.run_events(instance.server.sel.select(0), time.perf_counter())
+        instance.server.run_completions(instance.server.wake_reader)
+
+
+def time_registrations(instance, count=5):
+    """
+    :return: seconds it took to register count users
+    """
+    start = time.perf_counter()
+    registrations = [instance.connect(instance.register(f"user-{i}")) for i in range(count)]
+    instance.harness.run(connections=registrations)
+    elapsed = time.perf_counter() - start
+    assert [conn.response()[0] for conn in registrations] == \
+        [protocol.ResponseCodes.RESPONSE_REGISTRATION.value] * count
+    return elapsed
+
+
+def test_registrations_during_slow_write(loopback):
+    slow = SlowStorage()
+    instance = loopback(file_storage=slow)
+    client = instance.client("uploader")
+    slow.slow = True
+    upload = instance.connect(instance.upload(client, "slow.bin", os.urandom(64 * 1024)))
+    run_until(instance, slow.writing)
+
+    elapsed = time_registrations(instance)
+    assert not upload.closed, "the upload should still be waiting for its write"
+    assert elapsed < DELAY / 4
+
+    instance.harness.run()
+    assert upload.response()[0] == protocol.ResponseCodes.RESPONSE_FILE.value
+
+
+def test_registrations_during_slow_download(loopback):
+    slow = SlowStorage()
+    instance = loopback(file_storage=slow, stream_read_size=16 * 1024)
+    client = instance.client("downloader")
+    content = os.urandom(40 * 1024)
+    assert instance.request(instance.upload(client, "slow.bin", content))[0] == \
+        protocol.ResponseCodes.RESPONSE_FILE.value
+    code = protocol.RequestCodes.REQUEST_VALID_CRC.value
+    assert instance.request(packet(client.header(code, protocol.NAME_SIZE) +
+                                   loadgen.fixed_str("slow.bin", protocol.NAME_SIZE)))[0] == \
+        protocol.ResponseCodes.RESPONSE_RECEIVED.value
+
+    slow.slow = True
+    code = protocol.RequestCodes.REQUEST_GET_FILE.value
+    download = instance.connect(packet(client.header(code, protocol.NAME_SIZE) +
+                                       loadgen.fixed_str("slow.bin", protocol.NAME_SIZE)))
+    run_until(instance, slow.reading)
+
+    elapsed = time_registrations(instance)
+    assert not download.closed, "the download should still be waiting for the disk"
+    assert elapsed < DELAY / 4
+
+    slow.slow = False
+    instance.harness.run()
+    code, payload = download.response()
+    assert code == protocol.ResponseCodes.RESPONSE_GET_FILE.value
+    offset = protocol.CLIENT_ID_SIZE
+    content_size = struct.unpack("<L", payload[offset:offset + protocol.CONTENT_SIZE_SIZE])[0]
+    offset += protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE
+    iv = payload[offset:offset + protocol.IV_SIZE]
+    encrypted = payload[offset + protocol.IV_SIZE:offset + protocol.IV_SIZE + content_size]
+    assert unpad(AES.new(client.session_key, AES.MODE_CBC, iv).decrypt(encrypted), AES.block_size) == content
@@ -0,0 +1,71 @@
+import csv
+import sqlite3
+import uuid
+import pytest
+import database
+
+"""
+bulk registration with Database.provision, and its command line
+"""
+
+
+def clients(db):
+    return dict(db.query_with_result(f"SELECT Name, ID FROM clients", []))
+
+
+def test_skipped_names(tmp_path):
+    db = database.Database(str(tmp_path / "server.db"))
+    created, skipped = db.provision(["alice", "bob"])
+    assert [name for name, _ in created] == ["alice", "bob"]
+    assert skipped == []
+
+    created, skipped = db.provision(["carol", "alice", "", "carol", "x" * 255, "dave"])
+    assert [name for name, _ in created] == ["carol", "dave"]
+    assert skipped == [("", "empty"), ("carol", "duplicate"), ("x" * 255, "too long"), ("alice", "taken")]
+    assert sorted(clients(db)) == ["alice", "bob", "carol", "dave"]
+    assert all(clients(db)[name] == user_id for name, user_id in created)
+
+
+def test_quota_rows(tmp_path):
+    db = database.Database(str(tmp_path / "server.db"))
+    created, _ = db.provision(["alice"])
+    # no quota given, the configured ones apply and the row is added with the first upload
+    assert db.query_with_result(f"SELECT * FROM usage", []) == []
+
+    created, _ = db.provision(["bob", "carol"], quota_bytes=1000)
+    rows = db.query_with_result(f"SELECT ID, Bytes, Files, QuotaBytes, QuotaFiles FROM usage ORDER BY ID", [])
+    assert rows == sorted((user_id, 0, 0, 1000, None) for _, user_id in created)
+
+    created, _ = db.provision(["dave"], quota_files=3)
+    assert db.query_with_result(f"SELECT QuotaBytes, QuotaFiles FROM usage WHERE ID = ?",
+                                [created[0][1]]) == [(None, 3)]
+
+
+def test_rollback(tmp_path, monkeypatch):
+    db = database.Database(str(tmp_path / "server.db"))
+    # the second new user gets an id that already has a usage row, so its insert fails halfway through
+    db.query(f"INSERT INTO usage (ID, Bytes, Files) VALUES (?, 0, 0)", ["0" * 32])
+    ids = iter([uuid.UUID(int=1), uuid.UUID(int=0)])
+    monkeypatch.setattr(uuid, "uuid4", lambda: next(ids))
+    with pytest.raises(sqlite3.IntegrityError):
+        db.provision(["alice", "bob"], quota_files=1)
+    assert clients(db) == {}
+    assert db.query_with_result(f"SELECT ID FROM usage", []) == [("0" * 32,)]
+
+    monkeypatch.undo()
+    created, skipped = db.provision(["alice", "bob"], quota_files=1)
+    assert len(created) == 2 and skipped == []
+
+
+def test_command_line(tmp_path):
+    names = tmp_path / "names.txt"
+    names.write_text("# new site\nalice\n\nbob\nalice\n", encoding="utf-8")
+    output = tmp_path / "ids.csv"
+    db_path = str(tmp_path / "site.db")
+    assert database.main(["provision", str(names), "--output", str(output), "--database", db_path,
+                          "--quota-bytes", "500"]) == 1
+    with open(output, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["name", "id"]
+    assert dict(rows[1:]) == clients(database.Database(db_path))
+    assert sorted(dict(rows[1:])) == ["alice", "bob"]
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import database
+import loadgen
+import protocol
+from conftest import packet
+
+"""
+per user quotas of file_request, and the usage accounting that backs them
+"""
+
+RESPONSE_FILE = protocol.ResponseCodes.RESPONSE_FILE.value
+RESPONSE_ERROR = protocol.ResponseCodes.RESPONSE_ERROR.value
+
+
+def usage(instance, client):
+    """
+    :return: tuple - (Bytes, Files) of the usage row of client, the row is added with the first upload
+    """
+    query = instance.server.backup_db.query_with_result(f"SELECT Bytes, Files FROM usage WHERE ID = ?",
+                                                        [client.client_id.hex()])
+    return tuple(query[0]) if query else (0, 0)
+
+
+def failed_crc(client, file_name):
+    code = protocol.RequestCodes.REQUEST_ERROR_CRC.value
+    return packet(client.header(code, protocol.NAME_SIZE) + loadgen.fixed_str(file_name, protocol.NAME_SIZE))
+
+
+def stored_path(client, file_name):
+    return os.path.join(client.client_id.hex(), file_name)
+
+
+def test_byte_quota(loopback):
+    # content_size is the encrypted size, so a little room is left over the contents
+    instance = loopback(quota_bytes=5000)
+    client = instance.client("quota")
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(3000)))[0] == RESPONSE_FILE
+    assert instance.request(instance.upload(client, "b.bin", os.urandom(3000)))[0] == RESPONSE_ERROR
+    assert not os.path.exists(stored_path(client, "b.bin"))
+    assert instance.request(instance.upload(client, "b.bin", os.urandom(1000)))[0] == RESPONSE_FILE
+    assert usage(instance, client) == (4000, 2)
+
+
+def test_file_quota_and_rewrite(loopback):
+    instance = loopback(quota_files=1)
+    client = instance.client("quota")
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(3000)))[0] == RESPONSE_FILE
+    assert instance.request(instance.upload(client, "b.bin", os.urandom(100)))[0] == RESPONSE_ERROR
+    # a rewrite of a file that's pending its CRC replaces it, it isn't another file
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(100)))[0] == RESPONSE_FILE
+    assert usage(instance, client) == (100, 1)
+
+
+def test_user_quota_wins(loopback):
+    instance = loopback(quota_bytes=100000)
+    client = instance.client("quota")
+    instance.server.backup_db.query(f"INSERT INTO usage (ID, Bytes, Files, QuotaBytes) VALUES (?, 0, 0, ?)",
+                                    [client.client_id.hex(), 1000])
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(3000)))[0] == RESPONSE_ERROR
+    assert usage(instance, client) == (0, 0)
+
+
+def test_usage_accounting(loopback):
+    instance = loopback()
+    client = instance.client("usage")
+    assert usage(instance, client) == (0, 0)
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(3000)))[0] == RESPONSE_FILE
+    assert usage(instance, client) == (3000, 1)
+    # the usage changes by the difference
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(1200)))[0] == RESPONSE_FILE
+    assert usage(instance, client) == (1200, 1)
+    assert instance.request(instance.upload(client, "b.bin", os.urandom(500)))[0] == RESPONSE_FILE
+    assert usage(instance, client) == (1700, 2)
+
+    code, _ = instance.request(failed_crc(client, "a.bin"))
+    assert code == protocol.ResponseCodes.RESPONSE_RECEIVED.value
+    assert usage(instance, client) == (500, 1)
+    assert not os.path.exists(stored_path(client, "a.bin"))
+    # nothing left to remove, the usage stays as it is
+    assert instance.request(failed_crc(client, "a.bin"))[0] == RESPONSE_ERROR
+    assert usage(instance, client) == (500, 1)
+
+
+def test_failed_transaction(loopback, monkeypatch):
+    # the client gets 2107 instead of a CRC for a file nobody knows about, and the file is removed
+    instance = loopback()
+    client = instance.client("usage")
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(3000)))[0] == RESPONSE_FILE
+
+    add_usage = database.add_usage
+
+    def locked(conn, client_id, size, files):
+        # recording an upload fails, removing one doesn't
+        if files >= 0:
+            raise sqlite3.OperationalError("database is locked")
+        add_usage(conn, client_id, size, files)
+    monkeypatch.setattr(database, "add_usage", locked)
+    assert instance.request(instance.upload(client, "b.bin", os.urandom(500)))[0] == RESPONSE_ERROR
+    assert not os.path.exists(stored_path(client, "b.bin"))
+    # a rewrite that isn't recorded takes the previous attempt with it
+    assert instance.request(instance.upload(client, "a.bin", os.urandom(500)))[0] == RESPONSE_ERROR
+    assert not os.path.exists(stored_path(client, "a.bin"))
+
+    assert usage(instance, client) == (0, 0)
+    assert instance.server.backup_db.query_with_result(f"SELECT * FROM files WHERE ID = ?",
+                                                       [client.client_id.hex()]) == []
+    assert instance.server.pending_crc == []
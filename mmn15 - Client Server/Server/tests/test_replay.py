@@ -0,0 +1,39 @@
+import asyncio
+import pytest
+import loadgen
+import protocol
+import replay
+
+"""
+a capture replayed against a server that starts from the same (empty) database gets the same responses,
+even though the replayed server gives out its own client ids and session keys
+"""
+
+CLIENTS = 4
+FILES = 2
+
+
+@pytest.mark.parametrize("version, algorithm, chunk_size", [
+    (protocol.LEGACY_VERSION, None, loadgen.STREAM_CHUNK_SIZE),
+    (protocol.STREAM_VERSION, protocol.IntegrityAlgorithms.CRC32.value, 4096),
+])
+def test_replay_same_responses(live_server, tmp_path, version, algorithm, chunk_size):
+    capture_file = tmp_path / "traffic.cap"
+    recorded = live_server("recorded", capture_file=capture_file)
+    generator = loadgen.LoadGenerator("127.0.0.1", recorded.port, CLIENTS, CLIENTS, FILES,
+                                      loadgen.size_distribution("choice:1000,20000"), key_pool=2, seed=1,
+                                      version=version, fetch=True, algorithm=algorithm, chunk_size=chunk_size)
+    assert asyncio.run(generator.run())["clients_done"] == CLIENTS
+    recorded.stop()
+
+    connections = replay.load_connections(capture_file)
+    fresh = live_server("fresh")
+    # everything at once, every client's requests still wait for the ones before them
+    replayer = replay.Replayer(connections, "127.0.0.1", fresh.port, speed=0)
+    report = replayer.report(asyncio.run(replayer.run()))
+
+    assert report["failed"] == 0 and report["sent_as_recorded"] == 0
+    assert report["connections"] == len(connections)
+    assert {"1100", "1101", "1102", "1103", "1104", "1107"} <= set(report["codes"])
+    for code, row in report["codes"].items():
+        assert (code, row["code_mismatches"], row["payload_mismatches"]) == (code, 0, 0)
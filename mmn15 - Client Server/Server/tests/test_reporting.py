@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import threading
+import time
+import database
+import reporting
+
+"""
+the reporting snapshot gets done while the server keeps writing
+"""
+
+USERS = 60000  # a database of about 25 MB
+WRITE_INTERVAL = 0.002  # seconds
+TIMEOUT = 5  # seconds the refresh gets. without the one step fallback it never finishes under the writes
+
+
+def make_database(path):
+    db = database.Database(path)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO clients (ID, Name, PublicKey, AESKey) VALUES (?, ?, ?, ?)",
+                     [(os.urandom(16).hex(), f"user-{i}", os.urandom(300), os.urandom(16)) for i in range(USERS)])
+    conn.commit()
+    conn.close()
+    return db
+
+
+def test_snapshot_under_writes(tmp_path):
+    path = str(tmp_path / "server.db")
+    db = make_database(path)
+    stopping = threading.Event()
+    writes = []
+
+    def write():
+        while not stopping.is_set():
+            writes.append(db.query("UPDATE clients SET LastSeen = ? WHERE Name = ?", [str(time.time()), "user-1"]))
+            time.sleep(WRITE_INTERVAL)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    snapshot = str(tmp_path / "snapshot.db")
+    refresh = threading.Thread(target=reporting.SnapshotWriter(path, snapshot).refresh, daemon=True)
+    try:
+        time.sleep(0.1)
+        refresh.start()
+        refresh.join(TIMEOUT)
+    finally:
+        stopping.set()
+        writer.join()
+    assert not refresh.is_alive(), "the snapshot didn't finish under the writes"
+    assert writes and all(writes)
+
+    columns, rows = reporting.Reports(snapshot).query("SELECT COUNT(*), COUNT(AESKey) FROM clients")
+    assert rows == [(USERS, 0)]
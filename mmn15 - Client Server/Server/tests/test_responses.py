@@ -0,0 +1,96 @@
+import os
+import pytest
+import protocol
+
+"""
+responses packed into pooled packets, and the prebuilt frames. both have to be byte for byte what pack() gives
+"""
+
+PACKET_SIZE = 1024
+
+
+def generic():
+    response = protocol.GenericResponse()
+    response.client_id = os.urandom(protocol.CLIENT_ID_SIZE)
+    return response
+
+
+def registration():
+    response = protocol.RegistrationResponse()
+    response.client_id = os.urandom(protocol.CLIENT_ID_SIZE)
+    return response
+
+
+def public_key():
+    response = protocol.PublicKeyResponse()
+    response.client_id = os.urandom(protocol.CLIENT_ID_SIZE)
+    response.symmetric_key = os.urandom(128)
+    response.header.payload_size = protocol.CLIENT_ID_SIZE + len(response.symmetric_key)
+    return response
+
+
+def crc(algorithm=None):
+    response = protocol.CRCResponse()
+    response.client_id = os.urandom(protocol.CLIENT_ID_SIZE)
+    response.content_size = 5008
+    response.file_name = b"file.bin"
+    response.cksum = 0xDEADBEEF
+    response.algorithm = algorithm
+    response.digest = os.urandom(32)
+    return response
+
+
+RESPONSES = [generic, registration, public_key, crc, lambda: crc(protocol.IntegrityAlgorithms.BLAKE2B.value),
+             protocol.RegistrationFailedResponse, protocol.LoginFailedResponse, protocol.ErrorResponse]
+
+
+@pytest.mark.parametrize("make", RESPONSES)
+def test_pack_into(make):
+    response = make()
+    pool = protocol.BufferPool(PACKET_SIZE)
+    buffer = pool.take()
+    used = response.pack_into(buffer)
+    assert used == len(response.pack())
+    assert bytes(buffer) == response.pack().ljust(PACKET_SIZE, b'\0')
+
+
+def test_reused_buffer_is_clean():
+    # a small response packed into the buffer a big one was in has nothing left of it
+    pool = protocol.BufferPool(PACKET_SIZE)
+    buffer = pool.take()
+    pool.give(buffer, crc().pack_into(buffer))
+    assert pool.take() is buffer
+    response = protocol.ErrorResponse()
+    response.pack_into(buffer)
+    assert bytes(buffer) == response.pack().ljust(PACKET_SIZE, b'\0')
+
+
+def test_pool_limit():
+    pool = protocol.BufferPool(PACKET_SIZE, limit=2)
+    buffers = [pool.take() for _ in range(3)]
+    assert len({id(buffer) for buffer in buffers}) == 3
+    for buffer in buffers:
+        pool.give(buffer, 0)
+    # the third one is past the limit, left to the garbage collector
+    assert len(pool.free) == 2
+    assert {id(pool.take()), id(pool.take())} == {id(buffers[0]), id(buffers[1])}
+    fresh = pool.take()
+    assert all(fresh is not buffer for buffer in buffers) and fresh == bytearray(PACKET_SIZE)
+
+
+def test_no_pool():
+    pool = protocol.BufferPool(PACKET_SIZE, limit=0)
+    buffer = pool.take()
+    pool.give(buffer, 0)
+    assert pool.take() is not buffer
+
+
+@pytest.mark.parametrize("make", [protocol.ErrorResponse, protocol.RegistrationFailedResponse])
+@pytest.mark.parametrize("version", [protocol.LEGACY_VERSION, protocol.SERVER_VERSION])
+def test_frame(make, version):
+    frame = protocol.frame(make(), PACKET_SIZE, version)
+    response = make()
+    response.header.version = version
+    assert len(frame) == PACKET_SIZE
+    assert frame == response.pack().ljust(PACKET_SIZE, b'\0')
+    assert frame[0] == version
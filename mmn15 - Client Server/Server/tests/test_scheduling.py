@@ -0,0 +1,46 @@
+import os
+import time
+import protocol
+
+"""
+every loop turn runs the ready control requests first, and moves at most bulk_turn_bytes of each transfer,
+so a request that arrives in the middle of a large upload waits for a turn, not for the upload
+"""
+
+TURN_BYTES = 16 * 1024
+UPLOAD_SIZE = 2 * 1024 * 1024  # 128 turns
+
+
+def turn(instance):
+    instance.server.run_events(instance.server.sel.select(0), time.perf_counter())
+
+
+def test_control_request_during_upload(loopback):
+    instance = loopback(bulk_turn_bytes=TURN_BYTES)
+    client = instance.client("uploader", protocol.STREAM_VERSION, protocol.IntegrityAlgorithms.CRC32.value)
+    upload = instance.connect(instance.upload(client, "big.bin", os.urandom(UPLOAD_SIZE)))
+    turn(instance)  # the first packet, the rest of the upload is a bulk transfer from now on
+    assert upload in instance.server.bulk_connections
+
+    registration = instance.connect(instance.register("impatient"))
+    turn(instance)
+    assert registration.closed, "the registration should be answered in the turn it arrived in"
+    assert registration.response()[0] == protocol.ResponseCodes.RESPONSE_REGISTRATION.value
+    assert not upload.closed and upload.inbound, "the upload should still be going"
+    # it moved a turn's worth meanwhile
+    assert len(upload.inbound) >= UPLOAD_SIZE - TURN_BYTES
+
+    instance.harness.run()
+    assert upload.response()[0] == protocol.ResponseCodes.RESPONSE_FILE.value
+
+
+def test_bulk_moves_a_turn_at_a_time(loopback):
+    instance = loopback(bulk_turn_bytes=TURN_BYTES)
+    client = instance.client("uploader", protocol.STREAM_VERSION, protocol.IntegrityAlgorithms.CRC32.value)
+    upload = instance.connect(instance.upload(client, "big.bin", os.urandom(UPLOAD_SIZE)))
+    turn(instance)
+    left = len(upload.inbound)
+    for _ in range(5):
+        turn(instance)
+        assert left - len(upload.inbound) == TURN_BYTES
+        left = len(upload.inbound)
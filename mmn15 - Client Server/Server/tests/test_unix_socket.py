@@ -0,0 +1,41 @@
+import asyncio
+import os
+import socket
+import pytest
+import loadgen
+import protocol
+
+"""
+the server also listens on a unix socket when unix_socket is set, same handlers as TCP
+"""
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no unix sockets here")
+
+
+async def register(unix_path, name):
+    client = loadgen.ProtocolClient(None, None, name, loadgen.Stats(), unix_path=unix_path)
+    await client.register()
+    return client.client_id
+
+
+def test_requests_over_unix_socket(live_server, tmp_path):
+    path = str(tmp_path / "server.sock")
+    instance = live_server("server", unix_socket=path)
+    assert len(asyncio.run(register(path, "unix-user"))) == protocol.CLIENT_ID_SIZE
+
+    # SIGTERM ends the loop, and the socket file goes with the server
+    assert instance.stop() == 0
+    assert not os.path.exists(path)
+
+
+def test_stale_socket_file_replaced(live_server, tmp_path):
+    # left behind by a server that was killed
+    path = str(tmp_path / "server.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    instance = live_server("server", unix_socket=path)
+    asyncio.run(register(path, "unix-user"))
+    assert instance.stop() == 0
+    assert not os.path.exists(path)
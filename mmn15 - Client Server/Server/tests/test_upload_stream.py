@@ -0,0 +1,73 @@
+import os
+import struct
+import pytest
+import checksum
+import integrity
+import loadgen
+import protocol
+from conftest import packet
+from test_integrity import response_header
+
+"""
+uploads of protocol version 5 and up, one CBC stream that's decrypted while it's read
+"""
+
+CRC32 = protocol.IntegrityAlgorithms.CRC32.value
+
+
+@pytest.mark.parametrize("size", [0, 15, 16, 5000, 200 * 1024])
+def test_stream_split_mid_block(loopback, size):
+    # reads of 1000 bytes end in the middle of an AES block most of the time
+    instance = loopback(bulk_turn_bytes=1000)
+    client = instance.client("stream", protocol.STREAM_VERSION, CRC32, chunk_size=4096)
+    content = os.urandom(size)
+    code, payload = instance.request(instance.upload(client, "file.bin", content))
+    assert code == protocol.ResponseCodes.RESPONSE_FILE.value
+    offset = protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE + protocol.ALGORITHM_SIZE
+    assert bytes(payload[offset:offset + 4]) == integrity.digest_of(CRC32, content)
+
+
+@pytest.mark.parametrize("chunk_size", [16, 2 * 1024 * 1024])
+def test_any_whole_block_chunk_size(loopback, chunk_size):
+    instance = loopback()
+    client = instance.client("stream", protocol.STREAM_VERSION, chunk_size=chunk_size)
+    content = os.urandom(3000)
+    code, payload = instance.request(instance.upload(client, "file.bin", content))
+    assert code == protocol.ResponseCodes.RESPONSE_FILE.value
+    offset = protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE + protocol.NAME_SIZE + protocol.ALGORITHM_SIZE
+    assert int.from_bytes(payload[offset:offset + 4], "little") == checksum.memcrc(content)
+
+
+def test_chunk_size_not_whole_blocks(loopback):
+    # refused after the first packet, which ends with the chunk size
+    instance = loopback()
+    client = instance.client("stream", protocol.STREAM_VERSION)
+    first_packet, _ = client.file_packets("file.bin", os.urandom(3000))
+    first_packet = first_packet[:-protocol.CHUNK_SIZE_SIZE] + struct.pack("<L", 1000)
+    assert instance.request(packet(first_packet))[0] == protocol.ResponseCodes.RESPONSE_ERROR.value
+
+
+def test_stream_without_session_key(loopback):
+    # registered but never exchanged keys, refused before the content is read
+    instance = loopback()
+    client = loadgen.ProtocolClient(None, None, "keyless", None, protocol.STREAM_VERSION)
+    code, payload = instance.request(instance.register("keyless"))
+    assert code == protocol.ResponseCodes.RESPONSE_REGISTRATION.value
+    client.client_id = payload[:protocol.CLIENT_ID_SIZE]
+    client.session_key = bytes(protocol.SYMMETRIC_KEY_SIZE)
+    first_packet, _ = client.file_packets("file.bin", os.urandom(3000))
+    assert instance.request(packet(first_packet))[0] == protocol.ResponseCodes.RESPONSE_ERROR.value
+
+
+@pytest.mark.parametrize("version", [protocol.LEGACY_VERSION, protocol.STREAM_VERSION])
+def test_stream_response_version(loopback, version):
+    # the 2108 header is packed with the stream instead of respond(), and still carries the client's version
+    instance = loopback()
+    client = instance.client("stream", version)
+    assert response_header(instance, instance.upload(client, "file.bin", os.urandom(3000))) == \
+        (version, protocol.ResponseCodes.RESPONSE_FILE.value)
+    valid, fetch = (packet(client.header(code.value, protocol.NAME_SIZE) +
+                           loadgen.fixed_str("file.bin", protocol.NAME_SIZE))
+                    for code in (protocol.RequestCodes.REQUEST_VALID_CRC, protocol.RequestCodes.REQUEST_GET_FILE))
+    assert response_header(instance, valid) == (version, protocol.ResponseCodes.RESPONSE_RECEIVED.value)
+    assert response_header(instance, fetch) == (version, protocol.ResponseCodes.RESPONSE_GET_FILE.value)
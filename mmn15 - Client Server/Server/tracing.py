@@ -0,0 +1,232 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+Per request tracing
+
+a sampled request gets a root span when the server dispatches it, and every step it goes through
+(framing, unpacking, decrypting, disk, database, writing the response...) is a child span of it
+a span is written out when it ends, one JSON object per line:
+    {"trace": "...", "span": "...", "parent": "...", "name": "decrypt", "start": 1697040000.123456,
+     "duration_ms": 12.5, "attributes": {"code": 1103, "client_id": "..."}, "error": null}
+all the spans of a request share its trace id, so grep for it to see where the time went
+
+the code being traced doesn't pass spans around. each thread has a current span:
+    with tracing.span("decrypt", size=len(content)):
+        ...
+is a child of whatever is current on this thread, and costs (almost) nothing when nothing is
+(the request isn't sampled or tracing is off). activate() makes a span current without ending it,
+and wrap() carries the current span over to another thread (the I/O pool)
+
+spans are handed to a queue and a background thread formats and writes them, like logs.py does with the logs.
+the file rotates when it gets to max_bytes. if the writer can't keep up, spans are dropped (and counted)
+instead of slowing the requests down
+"""
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+QUEUE_SIZE = 10000  # spans waiting to be written before new ones are dropped
+
+current = threading.local()
+
+
+class Span:
+    """
+    one timed step of a request. use it as a context manager (it ends at the end of the block),
+    or call end() yourself for spans that outlive a function (the root span of a request)
+    """
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "attributes", "start", "start_perf",
+                 "error", "ended", "previous")
+
+    recording = True
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.start_perf = time.perf_counter()
+        self.error = None
+        self.ended = False
+        self.previous = None
+
+    def child(self, name, **attributes):
+        return Span(self.tracer, name, self.trace_id, self.span_id, attributes)
+
+    def set(self, name, value):
+        self.attributes[name] = value
+
+    def end(self):
+        if self.ended:
+            return
+        self.ended = True
+        self.tracer.export({
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": (time.perf_counter() - self.start_perf) * 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        })
+
+    def __enter__(self):
+        self.previous = getattr(current, "span", None)
+        current.span = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current.span = self.previous
+        self.previous = None
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.end()
+        return False
+
+
+class NoopSpan:
+    """
+    what you get when the request isn't traced. every method does nothing
+    """
+    recording = False
+
+    def child(self, name, **attributes):
+        return self
+
+    def set(self, name, value):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(name, **attributes):
+    """
+    :param name: what this step is, e.g. "decrypt" or "db.query"
+    :return: a child span of the current span of this thread (NOOP_SPAN if there's none)
+    """
+    parent = getattr(current, "span", None)
+    if parent is None:
+        return NOOP_SPAN
+    return parent.child(name, **attributes)
+
+
+class activate:
+    """
+    make a span the current one of this thread for a block, without ending it
+        with tracing.activate(root):
+            handler(...)
+    None or NOOP_SPAN leave this thread without a current span for the block
+    """
+    __slots__ = ("span", "previous")
+
+    def __init__(self, span):
+        self.span = span if span is not None and span.recording else None
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(current, "span", None)
+        current.span = self.span
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        current.span = self.previous
+        return False
+
+
+def wrap(func):
+    """
+    :param func: function that's going to run on another thread
+    :return: func, running with the current span of the calling thread as its current span
+    """
+    parent = getattr(current, "span", None)
+    if parent is None:
+        return func
+
+    def traced(*args, **kwargs):
+        with activate(parent):
+            return func(*args, **kwargs)
+    return traced
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, separators=(",", ":"), default=str)
+
+
+class SpanListener(logging.handlers.QueueListener):
+    """
+    the stock listener can't be stopped while the queue is full (it puts the stop marker without waiting),
+    which is exactly when a busy server has a backlog of spans. wait for room instead
+    """
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class Tracer:
+    def __init__(self, path="", sample_rate=DEFAULT_SAMPLE_RATE, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        """
+        :param path: JSONL file the spans are written to. empty to turn tracing off
+        :param sample_rate: part of the requests that are traced (0 - 1)
+        :param max_bytes: size the file rotates at
+        :param backups: rotated files kept (path.1, path.2...)
+        """
+        self.sample_rate = sample_rate if path else 0
+        self.queue = None
+        self.handler = None
+        self.listener = None
+        if path:
+            self.queue = queue.Queue(QUEUE_SIZE)
+            self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                                delay=True)
+            self.handler.setFormatter(JsonFormatter())
+            self.listener = SpanListener(self.queue, self.handler)
+            self.listener.start()
+            logger.info("Tracing %.1f%% of the requests into %s", self.sample_rate * 100, path)
+
+    def start(self, name, **attributes):
+        """
+        start the root span of a request, if it's sampled
+        :return: Span, or NOOP_SPAN for requests that aren't traced
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(self, name, os.urandom(16).hex(), None, attributes)
+
+    def export(self, record):
+        try:
+            self.queue.put_nowait(logging.makeLogRecord({"msg": record}))
+        except queue.Full:
+            metrics.TRACE_SPANS_DROPPED.inc()
+
+    def close(self):
+        """
+        write whatever is still waiting and stop the writer thread
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.handler.close()
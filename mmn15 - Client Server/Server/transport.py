@@ -0,0 +1,215 @@
+import itertools
+import queue
+import selectors
+import socket
+import struct
+import time
+from abc import ABC, abstractmethod
+import protocol
+
+"""
+Connections the request handlers talk to
+
+a handler only ever calls recv / send / close on its connection (and the loop registers it with the selector),
+so anything with those is a Transport:
+    socket.socket         what accept() gives us, a Transport as is (registered below, no wrapper)
+    RecordingConnection   capture.py, a socket that records its traffic
+    LoopbackTransport     an in-memory connection, for running the handlers without the kernel
+
+LoopbackSelector and LoopbackHarness drive a Server over loopback connections in this process:
+    harness = LoopbackHarness(server.Server(settings, selector=LoopbackSelector()))
+    conn = harness.connect(request_bytes)            # prebuilt frames, as the client would send them
+    harness.run()                                    # until every connection was closed by the server
+    code, payload = conn.response()
+no sockets, no select(), so benchmarks of the handlers measure the handlers (plus their disk and database work)
+"""
+
+FDS = itertools.count(1_000_000)  # made up descriptors for loopback connections, far from the real ones
+DEFAULT_RUN_TIMEOUT = 30.0  # seconds LoopbackHarness.run waits for disk work before giving up
+
+
+class Transport(ABC):
+    """
+    what a connection has to do for the server. same semantics as the socket methods
+    """
+    @abstractmethod
+    def recv(self, size):
+        """
+        :return: up to size bytes, b'' once the client closed its side. raises BlockingIOError if nothing is there yet
+        """
+
+    @abstractmethod
+    def send(self, data):
+        """
+        :return: how many bytes of data were taken. raises BlockingIOError if none could be
+        """
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    @abstractmethod
+    def fileno(self):
+        """
+        :return: the descriptor the selector knows the connection by
+        """
+
+
+Transport.register(socket.socket)
+
+
+class LoopbackTransport(Transport):
+    """
+    a connection that lives in memory. the client side is whatever was given to the constructor (or feed()),
+    and everything the server sends is collected in outbound
+    """
+    def __init__(self, inbound=b'', eof=False):
+        """
+        :param inbound: (bytes) what the client sends, e.g. a whole request
+        :param eof: has the client shut down its side after that? (recv returns b'' then, not BlockingIOError)
+        """
+        self.inbound = bytearray(inbound)
+        self.eof = eof
+        self.outbound = bytearray()
+        self.closed = False
+        self.fd = next(FDS)
+
+    def feed(self, data):
+        """
+        the client sends some more
+        """
+        self.inbound += data
+
+    def recv(self, size):
+        if self.closed:
+            raise OSError("recv on a closed loopback connection")
+        if not self.inbound:
+            if self.eof:
+                return b''
+            raise BlockingIOError()
+        data = bytes(self.inbound[:size])
+        del self.inbound[:size]
+        return data
+
+    def send(self, data):
+        if self.closed:
+            raise OSError("send on a closed loopback connection")
+        self.outbound += data
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+    def fileno(self):
+        return self.fd
+
+    def ready(self, events):
+        """
+        :return: the selector events this connection is ready for
+        """
+        mask = 0
+        if events & selectors.EVENT_READ and (self.inbound or self.eof):
+            mask |= selectors.EVENT_READ
+        if events & selectors.EVENT_WRITE and not self.closed:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def response(self):
+        """
+        :return: tuple - (response code, response payload) of what the server sent, code is None if it sent nothing
+        """
+        if len(self.outbound) < protocol.HEADER_SIZE:
+            return None, b''
+        _, code, payload_size = struct.unpack("<BHL", self.outbound[:protocol.HEADER_SIZE])
+        return code, bytes(self.outbound[protocol.HEADER_SIZE:protocol.HEADER_SIZE + payload_size])
+
+    def __repr__(self):
+        return f"<LoopbackTransport {self.fd}>"
+
+
+class LoopbackSelector(selectors.BaseSelector):
+    """
+    selector for loopback connections. select() never waits, it returns whatever is ready right now
+    """
+    def __init__(self):
+        self.keys = {}  # fd -> SelectorKey
+
+    def register(self, fileobj, events, data=None):
+        key = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+        if key.fd in self.keys:
+            raise KeyError(f"{fileobj!r} is already registered")
+        self.keys[key.fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self.keys.pop(fileobj.fileno())
+
+    def modify(self, fileobj, events, data=None):
+        if fileobj.fileno() not in self.keys:
+            raise KeyError(f"{fileobj!r} is not registered")
+        key = self.keys[fileobj.fileno()] = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+        return key
+
+    def select(self, timeout=None):
+        ready = []
+        for key in list(self.keys.values()):
+            events = key.fileobj.ready(key.events)
+            if events:
+                ready.append((key, events))
+        return ready
+
+    def get_map(self):
+        return self.keys
+
+    def close(self):
+        self.keys.clear()
+
+
+class LoopbackHarness:
+    """
+    runs a Server over loopback connections, on the calling thread
+    disk work still goes to the server's I/O pool, run() waits for it like the selector loop would
+    """
+    def __init__(self, server):
+        """
+        :param server: Server created with selector=LoopbackSelector()
+        """
+        self.server = server
+        self.connections = []
+
+    def connect(self, inbound, eof=False):
+        """
+        a client connects and sends inbound (it's read once run() is called)
+        :return: the LoopbackTransport
+        """
+        conn = LoopbackTransport(inbound, eof)
+        self.connections.append(conn)
+        self.server.add_connection(conn)
+        return conn
+
+    def run(self, timeout=DEFAULT_RUN_TIMEOUT, connections=None):
+        """
+        run the server until it closed every connection
+        :param timeout: seconds to wait for the I/O pool at a time. raises TimeoutError if nothing happens by then
+                        (e.g. a connection waits for data that was never fed)
+        :param connections: only run until these were closed, the others may still be open then
+        """
+        waiting_for = self.connections if connections is None else connections
+        while any(not conn.closed for conn in waiting_for):
+            events = self.server.sel.select(0)
+            if events:
+                self.server.run_events(events, time.perf_counter())
+                continue
+            # nothing to read or write, so the open connections wait for disk work
+            try:
+                callback = self.server.completions.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("the server is stuck, open connections aren't ready and no disk work finished")
+            # back on the queue, run_completions runs it with whatever else finished meanwhile
+            self.server.call_soon(callback)
+            self.server.run_completions(self.server.wake_reader)
+        self.connections = [conn for conn in self.connections if not conn.closed]
+
+    def close(self):
+        self.server.io_pool.shutdown()
+        self.server.tracer.close()
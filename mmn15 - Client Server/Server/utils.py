@@ -1,3 +1,7 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 def get_port(port_file):
     """
@@ -11,11 +15,11 @@ def get_port(port_file):
             port = int(data)
 
     except FileNotFoundError:
-        print(f"Warning! {port_file} file is missing in directory")
+        logger.warning("%s file is missing in directory", port_file)
     except ValueError:
-        print("Warning in port file. Not a number")
+        logger.warning("Warning in port file. Not a number")
     except:
-        print(f"Warning! unknown problem with {port_file} file")
+        logger.warning("unknown problem with %s file", port_file)
     finally:
         return port
 